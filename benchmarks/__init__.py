@@ -0,0 +1,4 @@
+"""
+mfbatch benchmarks - Timings of scanning, parsing and writing over a
+synthetic corpus of FLAC files
+"""
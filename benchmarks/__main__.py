@@ -0,0 +1,319 @@
+"""
+mfbatch benchmarks - Run the benchmark suite
+
+    python -m benchmarks --sizes 1000,10000 --output results.json
+
+Each size generates a fresh corpus in a temporary directory. Results are
+written as JSON, and can be compared against an earlier run with
+`--baseline`.
+"""
+
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from mfbatch import metaflac
+from mfbatch.backend import NativeBackend
+from mfbatch.__main__ import WriteOptions, create_batch_list, \
+    execute_batch_list
+from mfbatch.durable import DIRECTORIES
+from mfbatch.util import readline_with_escaped_newlines
+from mfbatch.walk import walk_flac_files
+
+from benchmarks.corpus import CorpusSpec, generate_corpus
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_METAFLAC = os.path.join(ROOT, 'benchmarks', 'stub_metaflac.py')
+DEFAULT_SPEC = CorpusSpec()
+
+
+class Run(NamedTuple):
+    """
+    The corpus directory, batchfile and tools used for the benchmarks of one
+    corpus size
+    """
+    workdir: str
+    paths: List[str]
+    metaflac_path: str
+    jobs: int
+    sample: int
+
+
+def timed(name: str, operations: int, func: Callable[[], object]) -> dict:
+    """
+    Call `func` and measure it. CPU time includes that of any subprocesses.
+    """
+    before = os.times()
+    start = time.perf_counter()
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+            redirect_stdout(devnull), redirect_stderr(devnull):
+        func()
+    wall = time.perf_counter() - start
+    after = os.times()
+    cpu = sum(after[:4]) - sum(before[:4])
+
+    return {'benchmark': name, 'operations': operations,
+            'wall_seconds': round(wall, 6), 'cpu_seconds': round(cpu, 6),
+            'per_operation_ms': round(wall * 1000 / max(operations, 1), 6)}
+
+
+def stub_metaflac(workdir: str) -> str:
+    """
+    Write a wrapper script that runs `stub_metaflac.py` with this
+    interpreter, and return its path.
+    """
+    path = os.path.join(workdir, 'metaflac')
+    with open(path, mode='w', encoding='utf-8') as f:
+        f.write("#!/bin/sh\n"
+                f"PYTHONPATH={shlex.quote(ROOT)}${{PYTHONPATH:+:$PYTHONPATH}}"
+                "\nexport PYTHONPATH\n"
+                f"exec {shlex.quote(sys.executable)} "
+                f"{shlex.quote(STUB_METAFLAC)} \"$@\"\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+def find_metaflac(requested: Optional[str], use_stub: bool,
+                  workdir: str) -> Tuple[str, bool]:
+    """
+    The `metaflac` to benchmark: the one requested, or the one on $PATH, or
+    else the stub.
+
+    :returns: The path and whether it is the stub.
+    """
+    if not use_stub:
+        found = requested or shutil.which('metaflac')
+        if found is not None:
+            return found, False
+
+    return stub_metaflac(workdir), True
+
+
+def batchfile_benchmarks(run: Run) -> List[dict]:
+    """
+    Create a batchfile for the corpus, then parse it and execute it.
+    """
+    files = walk_flac_files(os.path.join(run.workdir, 'corpus'))
+    batchfile = os.path.join(run.workdir, 'MFBATCH_LIST')
+    count = len(run.paths)
+    backend = NativeBackend(run.metaflac_path)
+
+    def read_batchfile():
+        with open(batchfile, mode='r', encoding='utf-8') as f:
+            for _ in readline_with_escaped_newlines(f):
+                pass
+
+    def change_every_file(value: int):
+        with open(batchfile, mode='r', encoding='utf-8') as f:
+            lines = [line for line in f
+                     if not line.startswith(":set MFBATCH_BENCHMARK ")]
+        with open(batchfile, mode='w', encoding='utf-8') as f:
+            f.writelines(lines[:1] + [f":set MFBATCH_BENCHMARK {value}\n"] +
+                         lines[1:])
+
+    results = [
+        timed('create_batch_list', count,
+              lambda: create_batch_list(files, batchfile, jobs=run.jobs,
+                                        backend=backend)),
+        timed('readline_with_escaped_newlines', count, read_batchfile),
+        timed('execute_batch_list_dry_run', count,
+              lambda: execute_batch_list(batchfile, True, False,
+                                         WriteOptions(jobs=run.jobs,
+                                                      backend=backend)))]
+    change_every_file(1)
+    results.append(timed('execute_batch_list', count,
+                         lambda: execute_batch_list(
+                             batchfile, False, False,
+                             WriteOptions(jobs=run.jobs, backend=backend))))
+    change_every_file(2)
+    results.append(timed('execute_batch_list_safe_write', count,
+                         lambda: execute_batch_list(
+                             batchfile, False, False,
+                             WriteOptions(jobs=run.jobs, safe_write=True,
+                                          backend=backend))))
+    return results
+
+
+def metaflac_benchmarks(run: Run) -> List[dict]:
+    """
+    Read and write the corpus with each function of `mfbatch.metaflac`.
+    Functions that start a subprocess for every file only act on the first
+    `run.sample` files.
+    """
+    paths = run.paths
+    sample = paths[:run.sample]
+    tool = run.metaflac_path
+    data = {'ALBUM': 'Benchmark', 'TITLE': 'Benchmark'}
+
+    def each(func: Callable, files: List[str], *args):
+        return lambda: [func(path, *args) for path in files]
+
+    return [
+        timed('read_metadata', len(paths),
+              each(metaflac.read_metadata, paths, tool)),
+        timed('read_metadata_batch', len(paths),
+              lambda: metaflac.read_metadata_batch(paths, tool)),
+        timed('read_metadata_metaflac', len(sample),
+              each(metaflac.read_metadata_metaflac, sample, tool)),
+        timed('read_metadata_batch_metaflac', len(paths),
+              lambda: metaflac.read_metadata_batch_metaflac(paths, tool)),
+        timed('write_metadata', len(paths),
+              each(metaflac.write_metadata, paths, data, tool)),
+        timed('write_metadata_safe', len(paths),
+              lambda: write_safely(paths, data, tool)),
+        timed('write_metadata_metaflac', len(sample),
+              each(metaflac.write_metadata_metaflac, sample, data, tool)),
+        timed('write_metadata_batch_metaflac', len(paths),
+              lambda: metaflac.write_metadata_batch_metaflac(paths, data,
+                                                             tool))]
+
+
+def write_safely(paths: List[str], data: Dict[str, str], tool: str):
+    """
+    Write each file with `metaflac.write_metadata()` in safe mode, syncing
+    their directories at the end like a run of mfbatch
+    """
+    for path in paths:
+        metaflac.write_metadata(path, data, tool, safe=True)
+    DIRECTORIES.sync()
+
+
+def run_size(count: int, spec: CorpusSpec, options) -> List[dict]:
+    """
+    Generate a corpus of `count` files and run every benchmark on it.
+    """
+    with tempfile.TemporaryDirectory(prefix='mfbatch-bench-') as workdir:
+        tool, _ = find_metaflac(options.metaflac, options.stub, workdir)
+        run = Run(workdir=workdir,
+                  paths=generate_corpus(os.path.join(workdir, 'corpus'),
+                                        count, spec),
+                  metaflac_path=tool, jobs=options.jobs,
+                  sample=options.sample)
+
+        results = batchfile_benchmarks(run) + metaflac_benchmarks(run)
+        for result in results:
+            result['files'] = count
+
+        return results
+
+
+def git_revision() -> Optional[str]:
+    """
+    The commit being benchmarked, if it can be found
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                capture_output=True, check=True)
+        return result.stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(results: List[dict], baseline_path: str):
+    """
+    Print the wall time of each result beside that of the same benchmark in
+    an earlier run.
+    """
+    with open(baseline_path, mode='r', encoding='utf-8') as f:
+        baseline: Dict[Tuple[str, int], dict] = {
+            (r['benchmark'], r['files']): r for r in json.load(f)['results']}
+
+    print(f"{'benchmark':<32}{'files':>8}{'seconds':>12}{'baseline':>12}"
+          f"{'ratio':>8}")
+    for result in results:
+        before = baseline.get((result['benchmark'], result['files']))
+        line = f"{result['benchmark']:<32}{result['files']:>8}" \
+            f"{result['wall_seconds']:>12.3f}"
+        if before is not None and before['wall_seconds'] > 0:
+            line += f"{before['wall_seconds']:>12.3f}" \
+                f"{result['wall_seconds'] / before['wall_seconds']:>8.2f}"
+        print(line)
+
+
+def make_option_parser() -> ArgumentParser:
+    """
+    The benchmark command line options
+    """
+    op = ArgumentParser(prog='python -m benchmarks',
+                        description='Time mfbatch over synthetic FLAC files')
+    op.add_argument('--sizes', default='1000,10000,100000',
+                    help='comma-separated numbers of files to benchmark. '
+                    '(default: %(default)s)')
+    op.add_argument('--tags', type=int, default=DEFAULT_SPEC.tags,
+                    help='comments in each file. (default: %(default)s)')
+    op.add_argument('--value-size', type=int, default=DEFAULT_SPEC.value_size,
+                    help='length of each extra comment value. '
+                    '(default: %(default)s)')
+    op.add_argument('--padding', type=int, default=DEFAULT_SPEC.padding,
+                    help='size of the PADDING block in each file, -1 for '
+                    'none. (default: %(default)s)')
+    op.add_argument('--picture-size', type=int,
+                    default=DEFAULT_SPEC.picture_size,
+                    help='size of a PICTURE block in each file, 0 for none. '
+                    '(default: %(default)s)')
+    op.add_argument('--audio-size', type=int, default=DEFAULT_SPEC.audio_size,
+                    help='bytes standing in for audio after the metadata of '
+                    'each file. (default: %(default)s)')
+    op.add_argument('-j', '--jobs', type=int, default=1,
+                    help='threads for scanning and writing. '
+                    '(default: %(default)s)')
+    op.add_argument('--sample', type=int, default=50,
+                    help='files acted on by benchmarks that run metaflac '
+                    'once per file. (default: %(default)s)')
+    op.add_argument('--metaflac', metavar='PATH', default=None,
+                    help='metaflac to benchmark, by default the one on $PATH '
+                    'or else the stub.')
+    op.add_argument('--stub', action='store_true', default=False,
+                    help='always use the stub metaflac.')
+    op.add_argument('-o', '--output', metavar='FILE', default=None,
+                    help='write results to FILE instead of stdout.')
+    op.add_argument('--baseline', metavar='FILE', default=None,
+                    help='print a comparison with the results in FILE.')
+    return op
+
+
+def main():
+    """
+    Entry point
+    """
+    options = make_option_parser().parse_args()
+    spec = CorpusSpec(tags=options.tags, value_size=options.value_size,
+                      padding=options.padding,
+                      picture_size=options.picture_size,
+                      audio_size=options.audio_size)
+
+    results = []
+    for size in options.sizes.split(','):
+        print(f"Benchmarking {int(size)} files...", file=sys.stderr)
+        results.extend(run_size(int(size), spec, options))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        _, is_stub = find_metaflac(options.metaflac, options.stub, workdir)
+
+    report = {'revision': git_revision(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'metaflac_stub': is_stub,
+              'jobs': options.jobs, 'corpus': spec._asdict(),
+              'results': results}
+
+    if options.output is not None:
+        with open(options.output, mode='w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if options.baseline is not None:
+        print_comparison(results, options.baseline)
+
+
+if __name__ == '__main__':
+    main()
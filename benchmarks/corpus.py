@@ -0,0 +1,123 @@
+"""
+mfbatch benchmarks corpus - Generate minimal valid FLAC files
+"""
+
+import os
+from typing import List, NamedTuple, Tuple
+
+from mfbatch.native import FLAC_MARKER, STREAMINFO, PADDING, PICTURE, \
+    VORBIS_COMMENT, build_vorbis_comment
+
+ALBUM_SIZE = 12
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+class CorpusSpec(NamedTuple):
+    """
+    The shape of the files in a corpus
+
+    :param tags: Number of comments in each file, at least the five album and
+        track comments are always written.
+    :param value_size: Length of the value of each extra comment.
+    :param padding: Size of the PADDING block, or -1 for none.
+    :param picture_size: Size of the picture data in a PICTURE block, or 0 for
+        none.
+    :param audio_size: Number of bytes standing in for audio frames after the
+        metadata blocks.
+    """
+    tags: int = 12
+    value_size: int = 16
+    padding: int = 4096
+    picture_size: int = 0
+    audio_size: int = 0
+
+
+def _block(block_type: int, data: bytes, is_last: bool) -> bytes:
+    return bytes([block_type | (0x80 if is_last else 0)]) + \
+        len(data).to_bytes(3, 'big') + data
+
+
+def streaminfo(sample_rate: int = 44100, channels: int = 2,
+               bits_per_sample: int = 16) -> bytes:
+    """
+    The body of a STREAMINFO block for a stream with no samples
+    """
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | \
+        ((bits_per_sample - 1) << 36)
+    return (4096).to_bytes(2, 'big') * 2 + bytes(6) + \
+        packed.to_bytes(8, 'big') + bytes(16)
+
+
+def picture(size: int) -> bytes:
+    """
+    The body of a PICTURE block holding a front cover of `size` bytes of
+    PNG-signed data
+    """
+    mime = b'image/png'
+    data = (PNG_SIGNATURE + bytes(size))[:size]
+    fields = [(3).to_bytes(4, 'big'), len(mime).to_bytes(4, 'big'), mime,
+              (0).to_bytes(4, 'big')]
+    fields += [n.to_bytes(4, 'big') for n in (500, 500, 24, 0)]
+    return b''.join(fields + [len(data).to_bytes(4, 'big'), data])
+
+
+def corpus_comments(index: int, spec: CorpusSpec) -> List[Tuple[str, str]]:
+    """
+    The comments of the file at `index` in a corpus. Album comments are
+    shared by every `ALBUM_SIZE` consecutive files, the extra comments are
+    shared by every file.
+    """
+    album, track = divmod(index, ALBUM_SIZE)
+    comments = [('ALBUM', f"Album {album}"),
+                ('ARTIST', f"Artist {album % 97}"),
+                ('DATE', str(1950 + album % 70)),
+                ('TITLE', f"Track {track + 1} of album {album}"),
+                ('TRACKNUMBER', str(track + 1))]
+    for n in range(spec.tags - len(comments)):
+        comments.append((f"EXTRA{n:03d}",
+                         (f"value{n}-" * spec.value_size)[:spec.value_size]))
+
+    return comments
+
+
+def flac_file(comments: List[Tuple[str, str]], spec: CorpusSpec) -> bytes:
+    """
+    The contents of a FLAC file with the given comments, followed by
+    `spec.audio_size` bytes in place of audio frames
+    """
+    blocks = [(STREAMINFO, streaminfo())]
+    if spec.picture_size > 0:
+        blocks.append((PICTURE, picture(spec.picture_size)))
+
+    blocks.append((VORBIS_COMMENT, build_vorbis_comment('mfbatch benchmark',
+                                                        comments)))
+    if spec.padding >= 0:
+        blocks.append((PADDING, bytes(spec.padding)))
+
+    return FLAC_MARKER + b''.join(
+        _block(block_type, data, i == len(blocks) - 1)
+        for i, (block_type, data) in enumerate(blocks)) + \
+        bytes(spec.audio_size)
+
+
+def generate_corpus(root: str, count: int, spec: CorpusSpec) -> List[str]:
+    """
+    Write `count` FLAC files into album directories under `root`.
+
+    :returns: The paths of the files, in order.
+    """
+    paths = []
+    for index in range(count):
+        album, track = divmod(index, ALBUM_SIZE)
+        dirname = os.path.join(root, f"album{album:05d}")
+        if track == 0:
+            os.makedirs(dirname, exist_ok=True)
+
+        path = os.path.join(dirname, f"{track + 1:02d} track.flac")
+        with open(path, 'wb') as f:
+            f.write(flac_file(corpus_comments(index, spec), spec))
+
+        paths.append(path)
+
+    return paths
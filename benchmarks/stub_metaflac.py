@@ -0,0 +1,93 @@
+"""
+mfbatch benchmarks stub_metaflac - A stand-in for the `metaflac` binary
+
+Supports only the options mfbatch uses: `--list` with `--with-filename` and
+`--block-type`, `--remove-all-tags` and `--import-tags-from`. Metadata is read
+and written with `mfbatch.native`, so `mfbatch` must be importable.
+"""
+
+import sys
+from typing import List, Optional, Tuple
+
+from mfbatch import native
+
+BLOCK_NAMES = {native.STREAMINFO: 'STREAMINFO', native.PADDING: 'PADDING',
+               native.APPLICATION: 'APPLICATION',
+               native.SEEKTABLE: 'SEEKTABLE',
+               native.VORBIS_COMMENT: 'VORBIS_COMMENT',
+               native.CUESHEET: 'CUESHEET', native.PICTURE: 'PICTURE'}
+
+
+def list_file(path: str, prefix: str, block_types: Optional[List[str]]):
+    """
+    Print the metadata blocks of `path` like `metaflac --list`
+    """
+    with open(path, 'rb') as f:
+        blocks, _ = native.read_block_headers(f)
+        for number, block in enumerate(blocks):
+            name = BLOCK_NAMES.get(block.block_type, 'UNKNOWN')
+            if block_types is not None and name not in block_types:
+                continue
+
+            print(f"{prefix}METADATA block #{number}")
+            print(f"{prefix}  type: {block.block_type} ({name})")
+            print(f"{prefix}  is last: {str(block.is_last).lower()}")
+            print(f"{prefix}  length: {block.length}")
+            if block.block_type == native.VORBIS_COMMENT:
+                f.seek(block.offset + 4)
+                vendor, comments = native.parse_vorbis_comment(
+                    f.read(block.length))
+                print(f"{prefix}  vendor string: {vendor}")
+                print(f"{prefix}  comments: {len(comments)}")
+                for i, (key, value) in enumerate(comments):
+                    print(f"{prefix}    comment[{i}]: {key}={value}")
+
+
+def import_tags(source: str) -> List[Tuple[str, str]]:
+    """
+    Read KEY=VALUE lines from the file `source`, or stdin if it is '-'
+    """
+    if source == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, mode='r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+    return [(key, value) for key, _, value in
+            (line.partition('=') for line in lines if '=' in line)]
+
+
+def main(argv: List[str]) -> int:
+    """
+    Entry point
+    """
+    options = [a for a in argv if a.startswith('--')]
+    paths = [a for a in argv if not a.startswith('--')]
+    block_types = None
+    tags = None
+    for option in options:
+        if option.startswith('--block-type='):
+            block_types = option.split('=', 1)[1].split(',')
+        elif option.startswith('--import-tags-from='):
+            tags = import_tags(option.split('=', 1)[1])
+
+    status = 0
+    for path in paths:
+        try:
+            if '--list' in options:
+                prefix = path + ':' if '--with-filename' in options or \
+                    len(paths) > 1 else ''
+                list_file(path, prefix, block_types)
+            else:
+                comments = [] if '--remove-all-tags' in options else \
+                    list(native.read_metadata(path).items())
+                native.write_metadata(path, comments + (tags or []))
+        except (OSError, native.FlacFormatError) as exc:
+            print(f"{path}: ERROR: {exc}", file=sys.stderr)
+            status = 1
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
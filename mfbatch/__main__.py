@@ -3,57 +3,235 @@ mfbatch main - Command entrypoint for mfbatch
 """
 
 import os
-from glob import glob
 from subprocess import CalledProcessError, run
 import sys
 from argparse import ArgumentParser
 import shlex
-from typing import Callable, List, Tuple
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, \
+    Sequence, Sized, TextIO, Tuple, Union
+from functools import partial
 import inspect
+import json
 from io import StringIO
+from contextlib import ExitStack
 
 from tqdm import tqdm
 
-from mfbatch.util import readline_with_escaped_newlines
-import mfbatch.metaflac as metadata_funcs
-from mfbatch.commands import BatchfileParser
+from mfbatch.util import readline_with_escaped_newlines, ordered_map
+from mfbatch import native
+from mfbatch.backend import BACKENDS, DEFAULT_BACKEND, Backend, \
+    BackendError, select_backend
+from mfbatch.metaflac import FlacMetadata
+from mfbatch.picture import PICTURE_KEY
+from mfbatch.commands import BatchfileParser, CommandEnv
+from mfbatch.executor import WRITE_ERRORS, \
+    WriteExecutor, WriteOperation, WriteResult, metadata_unchanged
+from mfbatch.cache import ScanCache, CACHE_FILE
+from mfbatch.compact import BatchfileCompactor
+from mfbatch.durable import DIRECTORIES
+from mfbatch.journal import Journal, JOURNAL_SUFFIX
+from mfbatch.filelist import SORT_MODES, chunked, read_file_list, \
+    sorted_flac_files
+from mfbatch.renames import RenamePlanError
+from mfbatch.records import EXPORT_FORMATS, RecordError, read_records, \
+    write_records
+from mfbatch.report import REPORT_MODES, make_report
+from mfbatch.shard import SHARD_SUFFIX, shard_batch_list
+from mfbatch.stats import STATS, TimedStream
+from mfbatch.walk import FileRecord, WalkOptions, file_record, file_stat, \
+    walk_flac_files
+
+SCAN_CHUNK_SIZE = 64
+
+
+class WriteOptions(NamedTuple):
+    """
+    Options for `execute_batch_list()`
+
+    :param jobs: Number of files to write concurrently, only when not
+        interactive. The batch list is still evaluated in order.
+    :param fail_fast: Stop all writes at the first error, instead of counting
+        the failure and continuing.
+    :param resume: Skip the files recorded in the journal by an earlier run
+        of the same batch list.
+    :param min_padding: Rewrite any file that would be left with less than
+        this many bytes of padding.
+    :param report: How files are reported when not interactive, one of
+        `REPORT_MODES`.
+    :param safe_write: Never modify files in place, write a new copy of each
+        file and replace it once synced.
+    :param backend: What reads and writes the files.
+    """
+    jobs: int = 1
+    fail_fast: bool = False
+    resume: bool = False
+    min_padding: int = 0
+    report: str = 'full'
+    safe_write: bool = False
+    backend: Backend = DEFAULT_BACKEND
 
 
-def execute_batch_list(batch_list_path: str, dry_run: bool, interactive: bool):
-    "Acts on a batch list"
-    with open(batch_list_path, mode='r', encoding='utf-8') as f:
-        parser = BatchfileParser()
-        parser.dry_run = dry_run
-
-        for line, line_no in readline_with_escaped_newlines(f):
-            if len(line) > 0:
-                parser.eval(line, line_no, interactive)
+def check_backend(plan: List[WriteOperation], backend: Backend):
+    """
+    Check that `backend` can write every operation of `plan`.
 
+    :raises BackendError: if the plan sets pictures and the backend can't
+        write them.
+    """
+    if not backend.pictures and any(PICTURE_KEY in op.metadata
+                                    for op in plan):
+        raise BackendError(f"the {backend.name} backend can't write pictures")
 
-def sort_flac_files(file_list, mode):
-    "Sort flac files"
-    if mode == 'path':
-        return sorted(file_list)
-    if mode == 'mtime':
-        return sorted(file_list, key=os.path.getmtime)
-    if mode == 'ctime':
-        return sorted(file_list, key=os.path.getctime)
-    if mode == 'name':
-        return sorted(file_list, key=os.path.basename)
 
-    return file_list
+def execute_batch_list(batch_list_path: str, dry_run: bool, interactive: bool,
+                       options: WriteOptions = WriteOptions()):
+    """
+    Acts on a batch list. The whole batch list is evaluated and every command
+    validated before any file is written. Files whose metadata would not
+    change are not written. Every file written is recorded in a journal next
+    to the batch list. When not interactive, output is buffered and written
+    in batches, and consecutive files that get the same metadata are written
+    together where the backend can, even with one job.
+
+    Every rename is checked before any file is written, and files are
+    renamed once all of them have been written.
+
+    :raises RenamePlanError: if the renames can't all be performed.
+    :raises BackendError: if the batch list sets pictures and the backend
+        can't write them.
+    """
+    with open(batch_list_path, mode='r', encoding='utf-8') as f, \
+            ExitStack() as stack:
+        parser = BatchfileParser()
+        parser.dry_run = dry_run
+        parser.fail_fast = options.fail_fast
+        functions = options.backend.functions(
+            min_padding=options.min_padding, safe=options.safe_write)
+        parser.write_metadata_f = functions.write
+        parser.read_metadata_f = functions.read
+        if STATS.enabled:
+            parser.outstream = TimedStream(parser.outstream, STATS)
+
+        with STATS.phase('compile'):
+            plan = parser.compile(readline_with_escaped_newlines(f))
+
+        check_backend(plan, options.backend)
+
+        if not interactive:
+            stack.callback(parser.report_files(make_report(
+                options.report, parser.outstream, dry_run, total=len(plan))))
+
+        if not dry_run:
+            parser.journal = stack.enter_context(
+                Journal(batch_list_path, resume=options.resume,
+                        durable=options.safe_write))
+            stack.callback(DIRECTORIES.sync)
+
+        parser.plan_renames(plan)
+
+        with STATS.phase('execute'):
+            if interactive:
+                parser.env = CommandEnv()
+                f.seek(0)
+                for line, line_no in readline_with_escaped_newlines(f):
+                    if len(line) > 0:
+                        parser.eval(line, line_no, interactive)
+                parser.finish_review()
+            elif not dry_run:
+                with parser.concurrent_writes(options.jobs,
+                                              functions.write_batch):
+                    parser.execute(plan)
+            else:
+                parser.execute(plan)
+
+            if parser.renames is not None:
+                parser.rename_files()
+
+        for outcome, count in parser.counts.items():
+            STATS.count(f"files_{outcome}", count)
+
+        if parser.report is not None:
+            parser.report.finish()
+        elif not dry_run:
+            parser.outstream.write(f"\n{parser.counts['written']} files "
+                                   f"written, {parser.counts['skipped']} "
+                                   f"skipped, {parser.counts['failed']} "
+                                   "failed\n")
+
+
+def read_files_metadata(files: Sequence[Union[str, FileRecord]],
+                        cache: Optional[ScanCache] = None,
+                        backend: Backend = DEFAULT_BACKEND
+                        ) -> List[Union[FlacMetadata, Exception]]:
+    """
+    Read the metadata of `files` for the batchfile with `backend`, or the
+    error that prevented reading each one. Files are read together, so any
+    that must be read with `metaflac` take as few invocations as possible. If
+    a `cache` is given, files are only read if they have changed since they
+    were cached.
+    """
+    results: List[Union[FlacMetadata, Exception]] = []
+    misses = []
+    for record in map(file_record, files):
+        path = record.path
+        if cache is None:
+            misses.append((len(results), path, None))
+            results.append({})
+            continue
+
+        try:
+            st = file_stat(record)
+        except OSError as e:
+            results.append(e)
+            continue
+
+        metadata = cache.get(path, st)
+        if metadata is None:
+            misses.append((len(results), path, st))
+            metadata = {}
+        results.append(metadata)
+
+    read_results = backend.read_batch([path for _, path, _ in misses])
+    for (i, path, st), result in zip(misses, read_results):
+        results[i] = result
+        if cache is not None and not isinstance(result, Exception):
+            cache.put(path, st, result)
+
+    return results
+
+
+def scan_files(files: Sequence[Union[str, FileRecord]],
+               cache: Optional[ScanCache] = None,
+               backend: Backend = DEFAULT_BACKEND
+               ) -> List[Tuple[str, Union[FlacMetadata, Exception]]]:
+    """
+    The path of each of `files` with its metadata, or the error that
+    prevented reading it, as read by `read_files_metadata()`.
+    """
+    return list(zip((file_record(f).path for f in files),
+                    read_files_metadata(files, cache, backend)))
 
 
-def write_batchfile_entries_for_file(path, metadatums) -> Tuple[dict, str]:
-    "Create batchfile entries for `path`"
+def batchfile_entries(path: str, this_file_metadata: Union[FlacMetadata,
+                                                          Exception],
+                      metadatums: dict) -> Tuple[dict, str]:
+    """
+    Create batchfile entries for `path` from its metadata, as read by
+    `read_files_metadata()`, against the state of `metadatums` left by the
+    preceding files.
+    """
     buffer = StringIO()
 
-    try:
-        this_file_metadata = metadata_funcs.read_metadata(path)
+    if isinstance(this_file_metadata, CalledProcessError):
+        buffer.write(f"# !!! METAFLAC ERROR ({this_file_metadata.returncode}) "
+                     f"while reading metadata from the file {path}\n\n")
+        return metadatums, buffer.getvalue()
 
-    except CalledProcessError as e:
-        buffer.write(f"# !!! METAFLAC ERROR ({e.returncode}) while reading "
-                     f"metadata from the file {path}\n\n")
+    if isinstance(this_file_metadata, Exception):
+        error = getattr(this_file_metadata, 'strerror', None) or \
+            str(this_file_metadata)
+        buffer.write(f"# !!! ERROR ({error}) while "
+                     f"reading metadata from the file {path}\n\n")
         return metadatums, buffer.getvalue()
 
     for this_key, this_value in this_file_metadata.items():
@@ -79,120 +257,524 @@ def write_batchfile_entries_for_file(path, metadatums) -> Tuple[dict, str]:
     return metadatums, buffer.getvalue()
 
 
-def create_batch_list(flac_files: List[str], command_file: str,
-                      sort_mode='path'):
+def scan_chunks(flac_files: Iterable[Union[str, FileRecord]],
+                sort_mode='path', jobs=1, cache: Optional[ScanCache] = None,
+                backend: Backend = DEFAULT_BACKEND
+                ) -> Iterator[List[Tuple[str, Union[FlacMetadata,
+                                                    Exception]]]]:
+    """
+    Sort `flac_files` and read their metadata in chunks, showing the
+    progress. Each chunk is yielded as soon as it has been read, in order.
+
+    :param flac_files: Paths or `FileRecord`s of files to read, read as they
+        are needed
+    :param sort_mode: Order of the files. Either 'path', 'mtime', 'ctime',
+        'name', or 'none' to keep the order of `flac_files` and begin scanning
+        at once.
+    :param jobs: Number of files to read metadata from concurrently
+    :param cache: Cache of metadata from earlier scans, only files that have
+        changed are read. The cache is updated but not saved.
+    :param backend: What reads the files
+    :returns: Chunks of paths with their metadata, or the error that prevented
+        reading it.
+    """
+    total = len(flac_files) if isinstance(flac_files, Sized) else None
+    chunks = chunked(sorted_flac_files(flac_files, sort_mode),
+                     SCAN_CHUNK_SIZE)
+
+    with tqdm(total=total, unit='File',
+              desc='Scanning with metaflac...') as progress:
+        for chunk in ordered_map(partial(scan_files, cache=cache,
+                                         backend=backend), chunks, jobs):
+            for _, this_file_metadata in chunk:
+                STATS.count('files_scanned')
+                if isinstance(this_file_metadata, Exception):
+                    STATS.count('files_failed')
+
+            yield chunk
+            progress.update(len(chunk))
+
+
+def create_batch_list(flac_files: Iterable[Union[str, FileRecord]],  # pylint: disable=too-many-arguments
+                      command_file: str, sort_mode='path', jobs=1,
+                      cache: Optional[ScanCache] = None, *,
+                      backend: Backend = DEFAULT_BACKEND):
     """
     Read all FLAC files in the cwd and create a batchfile that re-creates all
-    of their metadata.
+    of their metadata. Files are read as they are needed from `flac_files`,
+    and the batchfile is written as they are scanned.
 
-    :param flac_files: Paths of files to create batchfile from 
+    :param flac_files: Paths or `FileRecord`s of files to create batchfile
+        from
     :param command_file: Name of new batchfile
     :param sort_mode: Order of paths in the batch list. Either 'path', 
-        'mtime', 'ctime', 'name'
-    :param input_files: FLAC files to scan
+        'mtime', 'ctime', 'name', or 'none' to keep the order of `flac_files`
+        and begin scanning at once.
+    :param jobs: Number of files to read metadata from concurrently. The
+        batchfile is written in the same order regardless.
+    :param cache: Cache of metadata from earlier scans, only files that have
+        changed are read. The cache is updated but not saved.
+    :param backend: What reads the files
+
+    Entries are compacted by `BatchfileCompactor`, so a file's entries are
+    written once the file after it has been scanned.
     """
-
-    flac_files = sort_flac_files(flac_files, sort_mode)
-
-    with open(command_file, mode='w', encoding='utf-8') as f:
-        metadatums = {}
+    with open(command_file, mode='w', encoding='utf-8') as f, \
+            STATS.phase('scan'):
+        compactor = BatchfileCompactor()
 
         f.write("# mfbatch\n\n")
 
-        for path in tqdm(flac_files, unit='File',
-                         desc='Scanning with metaflac...'):
+        for chunk in scan_chunks(flac_files, sort_mode, jobs, cache,
+                                 backend):
+            for path, this_file_metadata in chunk:
+                if isinstance(this_file_metadata, Exception):
+                    f.write(compactor.finish())
+                    f.write(batchfile_entries(path, this_file_metadata,
+                                              {})[1])
+                else:
+                    f.write(compactor.add(path, this_file_metadata))
 
-            metadatums, buffer = write_batchfile_entries_for_file(path,
-                                                                  metadatums)
-            f.write(buffer)
+            f.flush()
 
+        f.write(compactor.finish())
         f.write("# mfbatch: create batchlist operation complete\n")
 
 
-def main():
+def export_tags(chunks: Iterable[List[Tuple[str, Union[FlacMetadata,
+                                                       Exception]]]],
+                output: TextIO, fmt: str):
     """
-    Entry point implementation
+    Write the tags of each file read by `scan_chunks()` to `output` as a
+    record in `fmt`, one of `EXPORT_FORMATS`. Files that couldn't be read are
+    reported on stderr and left out.
+    """
+    def exported():
+        for chunk in chunks:
+            for path, this_file_metadata in chunk:
+                if isinstance(this_file_metadata, Exception):
+                    tqdm.write(f"{path}: Failed! {this_file_metadata}",
+                               file=sys.stderr)
+                else:
+                    yield path, this_file_metadata
+
+    with STATS.phase('scan'):
+        write_records(exported(), output, fmt)
+
+
+def import_records(records_path: str, dry_run: bool,
+                   options: WriteOptions = WriteOptions()) -> Dict[str, int]:
+    """
+    Write the tags of each record in the file at `records_path`, as written
+    by `export_tags()`, to its file, replacing all of its comments. Records
+    are read as they are written, so memory use doesn't grow with their
+    number. Files whose metadata would not change are not written.
+
+    :returns: The number of files written, skipped and failed. With `dry_run`
+        the files that would be written are counted, but not written.
+    """
+    counts = {'written': 0, 'skipped': 0, 'failed': 0}
+    ops = (WriteOperation(path=path, metadata=tags, new_basename=None,
+                          line=lineno)
+           for lineno, (path, tags) in read_records(records_path))
+
+    def complete(op: WriteOperation,
+                 result: Union[WriteResult, BaseException]):
+        if isinstance(result, BaseException):
+            if options.fail_fast or not isinstance(result, WRITE_ERRORS):
+                raise result
+
+            counts['failed'] += 1
+            tqdm.write(f"{op.path}: Failed! {result}", file=sys.stderr)
+        else:
+            counts['written' if result.written else 'skipped'] += 1
+
+    with STATS.phase('import'), \
+            tqdm(unit='File', desc='Importing...') as progress:
+        if dry_run:
+            for op in ops:
+                complete(op, WriteResult(
+                    written=not metadata_unchanged(
+                        op.path, op.metadata, options.backend.read),
+                    new_path=None))
+                progress.update()
+        else:
+            functions = options.backend.functions(
+                min_padding=options.min_padding, safe=options.safe_write)
+            try:
+                with WriteExecutor(functions, options.jobs,
+                                   on_complete=complete) as executor:
+                    for op in ops:
+                        executor.submit(op)
+                        progress.update()
+            finally:
+                DIRECTORIES.sync()
+
+    would = 'would be ' if dry_run else ''
+    print(f"{counts['written']} files {would}written, {counts['skipped']} "
+          f"skipped, {counts['failed']} failed")
+    return counts
+
+
+def repad_file(path: str, padding: int) -> str:
+    """
+    Repad one file, reporting any error.
+
+    :returns: The outcome of `native.repad()`, or 'failed'.
+    """
+    try:
+        return native.repad(path, padding)
+    except (OSError, native.FlacFormatError) as e:
+        tqdm.write(f"{path}: {e}", file=sys.stderr)
+        return 'failed'
+
+
+def repad_files(flac_files: Iterable[Union[str, FileRecord]], padding: int,
+                jobs: int = 1) -> Dict[str, int]:
+    """
+    Give every file at least `padding` bytes of padding, so that later writes
+    can be made in place. Files are repadded `jobs` at a time.
+
+    :returns: The number of files with each outcome.
+    """
+    counts = {native.REWRITTEN: 0, native.IN_PLACE: 0, native.UNCHANGED: 0,
+              'failed': 0}
+    total = len(flac_files) if isinstance(flac_files, Sized) else None
+    paths = (file_record(f).path for f in flac_files)
+    with STATS.phase('repad'):
+        for outcome in tqdm(ordered_map(partial(repad_file, padding=padding),
+                                        paths, jobs),
+                            total=total, unit='File',
+                            desc='Repadding...'):
+            counts[outcome] += 1
+
+    print(f"{counts[native.REWRITTEN]} files rewritten, "
+          f"{counts[native.IN_PLACE]} repadded in place, "
+          f"{counts[native.UNCHANGED]} unchanged, {counts['failed']} failed")
+    return counts
+
+
+def make_option_parser() -> ArgumentParser:
+    """
+    Create the command line option parser
     """
     op = ArgumentParser(
-        prog='mfbatch', usage='%(prog)s (-c | -e | -W) [options]')
+        prog='mfbatch',
+        usage='%(prog)s (-c | -e | -W | --repad SIZE | --export FORMAT | '
+        '--import FILE | --shard N) [options]')
 
     op.add_argument('-c', '--create', default=False,
                     action='store_true',
                     help='create a new list')
     op.add_argument('-F', '--from-file', metavar='FILE_LIST', action='store',
                     default=None, help="get file paths from FILE_LIST when "
-                    "creating, instead of scanning directory"
-                    "a new list")
+                    "creating, instead of scanning directory. If FILE_LIST "
+                    "is '-', paths are read from stdin as they arrive.")
+    op.add_argument('--exclude', metavar='PATTERN', action='append',
+                    default=[], help="when scanning, skip files and "
+                    "directories matching the glob PATTERN. May be given "
+                    "more than once.")
+    op.add_argument('--ignore-case', action='store_true', default=False,
+                    dest='ignore_case', help="when scanning, also find files "
+                    "with extensions like .FLAC")
+    op.add_argument('--no-follow-symlinks', action='store_false',
+                    default=True, dest='follow_symlinks',
+                    help="when scanning, don't follow symbolic links")
+    op.add_argument('--repad', metavar='SIZE', type=int, default=None,
+                    help="give every FLAC file at least SIZE bytes of "
+                    "padding, rewriting files that have less, so later writes "
+                    "can be made in place. Files are found like -c.")
+    op.add_argument('--export', metavar='FORMAT', default=None,
+                    choices=EXPORT_FORMATS, help="write the path and tags of "
+                    "every FLAC file to stdout as a record in FORMAT, 'jsonl' "
+                    "or 'csv'. Files are found like -c.")
+    op.add_argument('--import', metavar='FILE', default=None,
+                    dest='import_file', help="write the tags of each record "
+                    "in FILE, as written by --export, to its file. If FILE is "
+                    "'-', records are read from stdin. Takes -n, -j, "
+                    "--fail-fast and --min-padding like -W.")
     op.add_argument('-e', '--edit', action='store_true',
                     help="open batch file in the default editor",
                     default=False)
     op.add_argument('-W', '--write', default=False,
                     action='store_true',
                     help="execute batch list, write to files")
+    op.add_argument('--shard', metavar='N', type=int, default=None,
+                    help="split the batch list into N batch lists, named "
+                    f"like FILE{SHARD_SUFFIX}1, that can each be written "
+                    "with -W on a different host or at the same time, with "
+                    "the same result as writing the batch list.")
     op.add_argument('-p', '--path', metavar='DIR',
                     help='chdir to DIR before running',
                     default=None)
     op.add_argument('-s', '--sort', metavar='MODE', action='store',
-                    default='path', help="when creating, Set mode to sort "
+                    default='path', choices=SORT_MODES,
+                    help="when creating, Set mode to sort "
                     "files by. Default is 'path'. 'ctime, 'mtime' and 'name' "
-                    "are also options.")
+                    "are also options, 'none' keeps the order files are "
+                    "found in and starts scanning at once.")
+    op.add_argument('-j', '--jobs', metavar='N', action='store', type=int,
+                    default=1, help="read metadata from N files at a time "
+                    "when creating, repad N files at a time, or write N files "
+                    "at a time with -W -y or --import. "
+                    "Default is 1.")
+    op.add_argument('--report', metavar='MODE', default='full',
+                    choices=REPORT_MODES, help="with -W -y, how to report "
+                    "each file. 'full' displays its metadata, 'summary' shows "
+                    "a progress bar and only the files that failed, 'jsonl' "
+                    "writes a JSON record of each file's outcome. Default is "
+                    "'full'.")
+    op.add_argument('--fail-fast', action='store_true', default=False,
+                    dest='fail_fast', help="with -W, stop all writes at the "
+                    "first error, instead of reporting failed files and "
+                    "continuing.")
+    op.add_argument('--min-padding', metavar='SIZE', type=int, default=0,
+                    dest='min_padding', help="with -W, rewrite any file "
+                    "that would be left with less than SIZE bytes of "
+                    "padding. Default is 0.")
+    op.add_argument('--safe-write', action='store_true', default=False,
+                    dest='safe_write', help="with -W or --import, never "
+                    "modify a file in place: write a new copy beside it and "
+                    "replace it once synced, so a crash can't leave it "
+                    "partly written.")
+    op.add_argument('--backend', metavar='NAME', default='auto',
+                    choices=BACKENDS, dest='backend_name',
+                    help="what reads and writes metadata. 'native' parses "
+                    "files directly, 'metaflac' runs metaflac for every "
+                    "file, 'auto' parses files directly and runs metaflac "
+                    "for files it can't parse, if metaflac is found. Default "
+                    "is 'auto'.")
+    op.add_argument('--metaflac', metavar='PATH', default=None,
+                    help="run the metaflac at PATH instead of the one on "
+                    "$PATH.")
+    op.add_argument('--no-cache', action='store_false', default=True,
+                    dest='cache', help="when creating, read every file "
+                    f"instead of using metadata cached in {CACHE_FILE} by "
+                    "earlier scans.")
     op.add_argument('-n', '--dry-run', action='store_true',
                     help="dry-run -W.")
     op.add_argument('-f', '--batchfile', metavar='FILE',
                     help="use batch list FILE for reading and writing instead "
                     "of the default \"MFBATCH_LIST\"",
                     default='MFBATCH_LIST')
+    op.add_argument('--resume', action='store_true', default=False,
+                    help="with -W, skip the files already written by an "
+                    "interrupted run of the same batch list, as recorded in "
+                    f"its {JOURNAL_SUFFIX} file.")
     op.add_argument('-y', '--yes', default=False, action='store_true',
                     dest='yes', help="automatically confirm all prompts, "
                     "inhibits interactive editing in -W mode")
+    op.add_argument('--stats', action='store_true', default=False,
+                    help="print how long each phase of the run took, the "
+                    "number of subprocesses started, bytes read and written, "
+                    "and the latency of each file read and written.")
+    op.add_argument('--stats-json', metavar='FILE', default=None,
+                    dest='stats_json', help="write the statistics of the run "
+                    "to FILE as JSON.")
+    op.add_argument('--profile', metavar='PHASE', default=None,
+                    help="run the first instance of PHASE under cProfile and "
+                    "print the most expensive functions. Phases include walk, "
+                    "sort, scan, compile, execute, metaflac, rename and "
+                    "output.")
     op.add_argument('--help-commands', action='store_true', default=False,
                     dest='help_commands',
                     help='print a list of available commands for batch lists '
                     'and interactive writing.')
 
+    return op
+
+
+def print_command_help():
+    """
+    Print the help for every batchfile command
+    """
+    print("Command Help\n------------")
+    print(f"{inspect.cleandoc(BatchfileParser.__doc__ or '')}\n\n")
+    for command in sorted(BatchfileParser.commands()):
+        meth = getattr(BatchfileParser, command)
+        print(f"- {inspect.cleandoc(meth.__doc__ or '')}\n")
+
+
+def find_flac_files(options) -> Iterable[Union[str, FileRecord]]:
+    """
+    The files to create a batch list from: either read as needed from the
+    file list given by the options, or found by scanning the current
+    directory.
+    """
+    if options.from_file:
+        return read_file_list(options.from_file)
+
+    return walk_flac_files('.', WalkOptions(
+        follow_symlinks=options.follow_symlinks,
+        ignore_case=options.ignore_case,
+        exclude=options.exclude), jobs=options.jobs)
+
+
+def report_stats(options):
+    """
+    Print or write the statistics of the run, as requested by the options
+    """
+    if options.stats:
+        STATS.print_summary(sys.stderr)
+    if options.profile is not None:
+        STATS.print_profile(sys.stderr)
+    if options.stats_json is not None:
+        with open(options.stats_json, mode='w', encoding='utf-8') as f:
+            json.dump(STATS.report(), f, indent=2)
+
+
+def main():
+    """
+    Entry point implementation
+    """
+    op = make_option_parser()
     options = op.parse_args()
 
     if options.help_commands:
-        print("Command Help\n------------")
-        commands = [command for command in dir(BatchfileParser) if
-                    not command.startswith('_') and command != "eval"]
-        print(f"{inspect.cleandoc(BatchfileParser.__doc__ or '')}\n\n")
-        for command in commands:
-            meth = getattr(BatchfileParser, command)
-            if isinstance(meth, Callable):
-                print(f"- {inspect.cleandoc(meth.__doc__ or '')}\n")
-
+        print_command_help()
         sys.exit(0)
 
+    STATS.enabled = options.stats or options.stats_json is not None or \
+        options.profile is not None
+    STATS.profile_phase = options.profile
+    if options.stats_json is not None:
+        options.stats_json = os.path.abspath(options.stats_json)
+
+    try:
+        options.backend = select_backend(options.backend_name,
+                                         options.metaflac)
+    except BackendError as exc:
+        op.error(str(exc))
+
+    if options.min_padding and not options.backend.padding:
+        op.error(f"the {options.backend.name} backend can't restore padding, "
+                 "--min-padding can't be used")
+
+    try:
+        with STATS.phase('total'):
+            run_modes(op, options)
+    finally:
+        report_stats(options)
+
+
+def write_options(options) -> WriteOptions:
+    """
+    The `WriteOptions` given by the command line options
+    """
+    return WriteOptions(jobs=options.jobs, fail_fast=options.fail_fast,
+                        resume=options.resume,
+                        min_padding=options.min_padding,
+                        report=options.report,
+                        safe_write=options.safe_write,
+                        backend=options.backend)
+
+
+def exit_with_rename_problems(exc: RenamePlanError):
+    """
+    Report the renames of a batch list that can't be performed and exit
+    """
+    print("Nothing was written, these files can't be renamed:",
+          file=sys.stderr)
+    for problem in exc.problems:
+        print(f"  {problem}", file=sys.stderr)
+    sys.exit(-1)
+
+
+def write_batch_list(options):
+    """
+    Execute the batch list as requested by the options, or if its renames
+    can't all be performed, report them and exit without writing anything
+    """
+    try:
+        execute_batch_list(options.batchfile,
+                           dry_run=options.dry_run,
+                           interactive=not options.yes,
+                           options=write_options(options))
+    except RenamePlanError as exc:
+        exit_with_rename_problems(exc)
+    except BackendError as exc:
+        print(f"Nothing was written, {exc}", file=sys.stderr)
+        sys.exit(-1)
+
+
+def write_shards(op: ArgumentParser, options):
+    """
+    Split the batch list into shards as requested by the options, and print
+    the path of each
+    """
+    if options.shard < 1:
+        op.error("--shard N must be at least 1")
+
+    try:
+        paths = shard_batch_list(options.batchfile, options.shard)
+    except RenamePlanError as exc:
+        exit_with_rename_problems(exc)
+    else:
+        for path in paths:
+            print(path)
+
+
+def run_modes(op: ArgumentParser, options):
+    """
+    Create, edit and write batch lists as requested by the options
+    """
     mode_given = False
     if options.path is not None:
         os.chdir(options.path)
 
     if options.create:
         mode_given = True
-        flac_files: List[str] = []
+        with STATS.phase('cache'):
+            cache = ScanCache.load(CACHE_FILE) if options.cache else None
+        with STATS.phase('walk'):
+            flac_files = find_flac_files(options)
+        create_batch_list(flac_files, options.batchfile,
+                          sort_mode=options.sort, jobs=options.jobs,
+                          cache=cache, backend=options.backend)
+        if cache is not None:
+            with STATS.phase('cache'):
+                cache.save()
 
-        if options.from_file:
-            with open(options.from_file, mode='r',
-                      encoding='utf-8') as from_file:
-                flac_files = [line.strip() for line in from_file.readlines()]
-        else:
-            flac_files = glob('./**/*.flac', recursive=True)
+    if options.repad is not None:
+        mode_given = True
+        with STATS.phase('walk'):
+            flac_files = find_flac_files(options)
+        repad_files(flac_files, options.repad, jobs=options.jobs)
 
-        # print(flac_files)
-        create_batch_list(flac_files, options.batchfile,
-                          sort_mode=options.sort)
+    if options.export is not None:
+        mode_given = True
+        with STATS.phase('cache'):
+            cache = ScanCache.load(CACHE_FILE) if options.cache else None
+        with STATS.phase('walk'):
+            flac_files = find_flac_files(options)
+        export_tags(scan_chunks(flac_files, options.sort, options.jobs, cache,
+                                options.backend),
+                    sys.stdout, options.export)
+        if cache is not None:
+            with STATS.phase('cache'):
+                cache.save()
+
+    if options.import_file is not None:
+        mode_given = True
+        try:
+            import_records(options.import_file, options.dry_run,
+                           write_options(options))
+        except RecordError as exc:
+            print(f"Import stopped at {exc}", file=sys.stderr)
+            sys.exit(-1)
 
     if options.edit:
         mode_given = True
         editor_command = [os.getenv('EDITOR'), options.batchfile]
         run(editor_command, check=True)
 
+    if options.shard is not None:
+        mode_given = True
+        write_shards(op, options)
+
     if options.write:
         mode_given = True
-        execute_batch_list(options.batchfile,
-                           dry_run=options.dry_run,
-                           interactive=not options.yes)
+        write_batch_list(options)
 
     if not mode_given:
         op.print_usage()
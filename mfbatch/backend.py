@@ -0,0 +1,195 @@
+"""
+mfbatch backend - The engines that read and write FLAC metadata
+"""
+
+import shutil
+from abc import ABC, abstractmethod
+from functools import partial
+from typing import List, Optional, Sequence, Union
+
+from mfbatch import metaflac
+from mfbatch.executor import MetadataFunctions
+from mfbatch.metaflac import FlacMetadata, METAFLAC_PATH
+
+BACKENDS = ('auto', 'native', 'metaflac')
+
+
+class BackendError(Exception):
+    """
+    The requested backend isn't available
+    """
+
+
+class Backend(ABC):
+    """
+    Reads and writes the metadata of FLAC files. Writing a `PICTURE_KEY`
+    replaces the pictures of a file, or removes them if it is empty, if the
+    backend can write `pictures`.
+    """
+
+    name: str = ''
+
+    # Writes a `PICTURE_KEY`
+    pictures: bool = False
+    # Rewrites files to restore `min_padding` bytes of padding
+    padding: bool = False
+    # Writes many files with each call to `write_batch()`
+    batch_writes: bool = False
+    # Reads and writes files that can't be parsed directly
+    fallback: bool = False
+
+    @abstractmethod
+    def read(self, path: str) -> FlacMetadata:
+        """
+        Read the metadata of a FLAC file
+        """
+
+    @abstractmethod
+    def read_batch(self, paths: Sequence[str]
+                   ) -> List[Union[FlacMetadata, Exception]]:
+        """
+        Read the metadata of many FLAC files
+
+        :returns: The metadata of each file in `paths`, or the error that
+            prevented reading it.
+        """
+
+    @abstractmethod
+    def write(self, path: str, data: FlacMetadata, min_padding: int = 0,
+              safe: bool = False):
+        """
+        Write metadata to a FLAC file. A file left with less than
+        `min_padding` bytes of padding is rewritten to restore it, if the
+        backend restores `padding`. If `safe`, the file is never modified in
+        place, like `metaflac.write_metadata()`.
+        """
+
+    @abstractmethod
+    def write_batch(self, paths: Sequence[str], data: FlacMetadata,
+                    min_padding: int = 0, safe: bool = False):
+        """
+        Write the same metadata to many FLAC files, like `write()`
+        """
+
+    def functions(self, min_padding: int = 0, safe: bool = False
+                  ) -> MetadataFunctions:
+        """
+        The functions of this backend for a `WriteExecutor`, writing with
+        `min_padding` and `safe`. Files are only written in batches if the
+        backend has `batch_writes`.
+        """
+        write = partial(self.write, min_padding=min_padding, safe=safe)
+        write_batch = partial(self.write_batch, min_padding=min_padding,
+                              safe=safe) if self.batch_writes else None
+        return MetadataFunctions(write=write, read=self.read,
+                                 write_batch=write_batch)
+
+
+class NativeBackend(Backend):
+    """
+    Parses and writes the metadata blocks of files directly. Files that
+    can't be parsed are read and written with `metaflac` at `metaflac_path`,
+    or fail if it is None.
+    """
+
+    name = 'native'
+    pictures = True
+    padding = True
+    batch_writes = True
+    metaflac_path: Optional[str]
+
+    def __init__(self, metaflac_path: Optional[str] = None) -> None:
+        self.metaflac_path = metaflac_path
+        self.fallback = metaflac_path is not None
+
+    def read(self, path: str) -> FlacMetadata:
+        return metaflac.read_metadata(path, self.metaflac_path)
+
+    def read_batch(self, paths: Sequence[str]
+                   ) -> List[Union[FlacMetadata, Exception]]:
+        return metaflac.read_metadata_batch(paths, self.metaflac_path)
+
+    def write(self, path: str, data: FlacMetadata, min_padding: int = 0,
+              safe: bool = False):
+        metaflac.write_metadata(path, data, self.metaflac_path,
+                                min_padding=min_padding, safe=safe)
+
+    def write_batch(self, paths: Sequence[str], data: FlacMetadata,
+                    min_padding: int = 0, safe: bool = False):
+        metaflac.write_metadata_batch(paths, data, self.metaflac_path,
+                                      min_padding=min_padding, safe=safe)
+
+
+class MetaflacBackend(Backend):
+    """
+    Reads and writes every file with `metaflac` at `metaflac_path`, passing
+    as many files as possible to each invocation. Padding isn't restored.
+    """
+
+    name = 'metaflac'
+    pictures = True
+    batch_writes = True
+    fallback = True
+    metaflac_path: str
+
+    def __init__(self, metaflac_path: str = METAFLAC_PATH) -> None:
+        self.metaflac_path = metaflac_path
+
+    def read(self, path: str) -> FlacMetadata:
+        return metaflac.read_metadata_metaflac(path, self.metaflac_path)
+
+    def read_batch(self, paths: Sequence[str]
+                   ) -> List[Union[FlacMetadata, Exception]]:
+        return metaflac.read_metadata_batch_metaflac(paths,
+                                                     self.metaflac_path)
+
+    def write(self, path: str, data: FlacMetadata, min_padding: int = 0,
+              safe: bool = False):
+        # pylint: disable=unused-argument
+        metaflac.write_metadata_metaflac(path, data, self.metaflac_path,
+                                         safe=safe)
+
+    def write_batch(self, paths: Sequence[str], data: FlacMetadata,
+                    min_padding: int = 0, safe: bool = False):
+        # pylint: disable=unused-argument
+        metaflac.write_metadata_batch_metaflac(paths, data,
+                                               self.metaflac_path, safe=safe)
+
+
+# Parses files directly, falling back to the `metaflac` on $PATH
+DEFAULT_BACKEND = NativeBackend(METAFLAC_PATH)
+
+
+def find_metaflac(metaflac_path: Optional[str] = None) -> Optional[str]:
+    """
+    The path of the `metaflac` executable at `metaflac_path`, or on $PATH if
+    it isn't given, or None if it can't be found
+    """
+    return shutil.which(metaflac_path or METAFLAC_PATH)
+
+
+def select_backend(name: str = 'auto',
+                   metaflac_path: Optional[str] = None) -> Backend:
+    """
+    The backend `name`, one of `BACKENDS`. 'auto' picks the fastest that is
+    available: the native backend, with `metaflac` for files it can't parse
+    if `metaflac` can be found. 'native' never uses `metaflac`.
+
+    :param metaflac_path: The `metaflac` to use, instead of the one on $PATH
+    :raises BackendError: if `metaflac` is needed and can't be found.
+    """
+    if name == 'native':
+        return NativeBackend()
+
+    found = find_metaflac(metaflac_path)
+    if found is None:
+        if name == 'metaflac' or metaflac_path is not None:
+            raise BackendError(
+                f"metaflac not found at {metaflac_path}" if metaflac_path
+                else "metaflac not found on $PATH")
+        return NativeBackend()
+
+    if name == 'metaflac':
+        return MetaflacBackend(found)
+
+    return NativeBackend(found)
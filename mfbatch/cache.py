@@ -0,0 +1,107 @@
+"""
+mfbatch cache - Persistent cache of scanned file metadata
+"""
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from mfbatch.metaflac import FlacMetadata
+
+CACHE_FILE = '.mfbatch-cache'
+CACHE_VERSION = 1
+DEFAULT_MAX_ENTRIES = 500000
+
+
+class ScanCache:
+    """
+    Metadata read from files, keyed by each file's absolute path and
+    validated against its size, modification time and inode number. Any
+    change to these invalidates the entry.
+
+    Entries are kept in order of last use, when the cache is saved only the
+    `max_entries` most recently used are kept.
+    """
+
+    path: str
+    max_entries: int
+    entries: 'OrderedDict[str, list]'
+
+    def __init__(self, path: str = CACHE_FILE,
+                 max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str = CACHE_FILE,
+             max_entries: int = DEFAULT_MAX_ENTRIES) -> 'ScanCache':
+        """
+        Load the cache at `path`. A missing, unreadable or out-of-date cache
+        file results in an empty cache.
+        """
+        cache = cls(path, max_entries)
+        try:
+            with open(path, mode='r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_VERSION:
+                cache.entries.update(data['entries'])
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+        return cache
+
+    @staticmethod
+    def _validator(st: os.stat_result) -> list:
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, path: str, st: os.stat_result) -> Optional[FlacMetadata]:
+        """
+        Return the cached metadata for `path`, if the file hasn't changed
+        since it was cached.
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != self._validator(st):
+                return None
+
+            self.entries.move_to_end(key)
+            return dict(entry[1])
+
+    def put(self, path: str, st: os.stat_result, metadata: FlacMetadata):
+        """
+        Cache `metadata` for `path`, as of the file status `st`.
+        """
+        key = os.path.abspath(path)
+        with self._lock:
+            self.entries[key] = [self._validator(st), dict(metadata)]
+            self.entries.move_to_end(key)
+
+    def save(self):
+        """
+        Write the cache to its file, replacing it atomically.
+        """
+        with self._lock:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8',
+                                             dir=dirname, suffix='.tmp',
+                                             prefix=os.path.basename(
+                                                 self.path) + '.',
+                                             delete=False) as f:
+                try:
+                    json.dump({'version': CACHE_VERSION,
+                               'entries': self.entries}, f,
+                              separators=(',', ':'))
+                    f.close()
+                    os.replace(f.name, self.path)
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
@@ -3,15 +3,28 @@ mfbatch commands - commands, batchfile parser and errors
 """
 
 # from string import Template
+import copy
 import sys
 import shlex
 import shutil
 import re
 import os.path
 
-from typing import Callable, Dict, Tuple, Optional
+from typing import Callable, Dict, Iterable, List, Mapping, Pattern, \
+    Set, Tuple, Optional, Union
 
-from mfbatch.metaflac import write_metadata as flac
+from mfbatch.backend import DEFAULT_BACKEND
+from mfbatch.metaflac import prepare_comments
+from mfbatch.executor import WriteExecutor, WriteOperation, WriteResult, \
+    MetadataFunctions, WRITE_ERRORS, metadata_unchanged, perform_write
+from mfbatch.journal import Journal
+from mfbatch.picture import PICTURE_KEY, PICTURES
+from mfbatch.renames import Rename, RenamePlanError, RenameStep, \
+    blocked_renames, plan_renames, rename_of, rename_steps
+from mfbatch.report import BufferedOutput, Report, APPLIED, FAILED, \
+    RENAMED, RENAME_FAILED, SKIPPED, WOULD_SKIP, WOULD_WRITE, WRITTEN
+from mfbatch.snapshot import Snapshot
+from mfbatch.stats import STATS
 
 
 class UnrecognizedCommandError(Exception):
@@ -26,7 +39,9 @@ class UnrecognizedCommandError(Exception):
 
 class CommandArgumentError(Exception):
     """
-    A command line in the batchfile did not have the correct number of argumets
+    A command line in the batchfile did not have the correct number of
+    argumets, or its arguments couldn't be applied to a file. When a file
+    can't be evaluated, `command` is the file's line.
     """
 
     command: str
@@ -37,23 +52,50 @@ class CommandArgumentError(Exception):
         self.line = line
 
 
+def batchfile_command(min_args: int, max_args: Optional[int] = None) -> Callable:
+    """
+    Register a `BatchfileParser` method as a batchfile command, taking at least
+    `min_args` and at most `max_args` arguments (exactly `min_args` if
+    `max_args` isn't given).
+    """
+    def decorator(meth: Callable) -> Callable:
+        meth.command_arity = (min_args,
+                              min_args if max_args is None else max_args)
+        return meth
+
+    return decorator
+
+
 class CommandEnv:
     """
     Stores values and state for commands
     """
     metadatums: Dict[str, str]
     incr: Dict[str, str]
-    patterns: Dict[str, Tuple[str, str, str]]
+    patterns: Dict[str, Tuple[str, Pattern, str]]
+    pattern_results: Dict[str, Tuple[str, str]]
     onces: Dict[str, Optional[str]]
-
-    artwork_file: Optional[str]
-    artwork_desc: Optional[str]
+    last_snapshot: Optional[Snapshot]
 
     def __init__(self) -> None:
         self.metadatums = {}
         self.incr = {}
         self.patterns = {}
+        self.pattern_results = {}
         self.onces = {}
+        self.last_snapshot = None
+
+    def snapshot(self) -> Snapshot:
+        """
+        An immutable copy of the keys of the current file, sharing the keys
+        that haven't changed with the snapshot of the file before it.
+        """
+        if self.last_snapshot is None:
+            self.last_snapshot = Snapshot.of(self.metadatums)
+        else:
+            self.last_snapshot = self.last_snapshot.derive(self.metadatums)
+
+        return self.last_snapshot
 
     def unset_key(self, k):
         """
@@ -63,6 +105,7 @@ class CommandEnv:
 
         self.incr.pop(k, None)
         self.patterns.pop(k, None)
+        self.pattern_results.pop(k, None)
 
     def reset_keys(self):
         """
@@ -74,22 +117,39 @@ class CommandEnv:
             self.unset_key(key)
 
         self.patterns = {}
+        self.pattern_results = {}
         self.incr = {}
 
     def set_pattern(self, to: str, frm: str, pattern: str, repl: str):
         """
-        Establish a pattern replacement in the environment
+        Establish a pattern replacement in the environment. Raises `re.error`
+        if the pattern is invalid, or the replacement refers to a group the
+        pattern doesn't have.
         """
-        self.patterns[to] = (frm, pattern, repl)
+        compiled = re.compile(pattern)
+        try:
+            # The replacement is parsed even if nothing matches
+            compiled.sub(repl, '')
+        except IndexError as exc:
+            raise re.error(str(exc)) from exc
+
+        self.patterns[to] = (frm, compiled, repl)
+        self.pattern_results.pop(to, None)
 
     def evaluate_patterns(self):
         """
         Evaluate all patterns, this must run once and exactly once before 
-        writing file metadata.
+        writing file metadata. A pattern whose input is the same as it was for
+        the last file isn't evaluated again, its last result is reused.
         """
         for to_key, (from_key, pattern, replacement) in self.patterns.items():
             from_value = self.metadatums[from_key]
-            self.metadatums[to_key] = re.sub(pattern, replacement, from_value)
+            last = self.pattern_results.get(to_key)
+            if last is None or last[0] != from_value:
+                last = (from_value, pattern.sub(replacement, from_value))
+                self.pattern_results[to_key] = last
+
+            self.metadatums[to_key] = last[1]
 
     def set_once(self, key, value):
         """
@@ -120,13 +180,15 @@ class CommandEnv:
 
     def revert_onces(self):
         """
-        Revert all set-once keys.
+        Revert all set-once keys. A key that had a value keeps its place, so
+        the file after it can share its snapshot's base.
         """
         keys = list(self.onces)
         for key in keys:
-            del self.metadatums[key]
             if self.onces[key] is not None:
                 self.metadatums[key] = self.onces[key] or ''
+            else:
+                del self.metadatums[key]
 
             del self.onces[key]
 
@@ -139,7 +201,51 @@ class CommandEnv:
             self.metadatums[k] = self.incr[k] % (val + 1)
 
 
-class BatchfileParser:
+class ReviewGroup:
+    """
+    Consecutive files of an interactive session that are reviewed with one
+    prompt, because their metadata differs only in per-file keys. The group
+    keeps the batchfile lines it was made from and a copy of the environment
+    from before them, so that they can be evaluated again if a command is
+    entered at the prompt.
+    """
+
+    env: CommandEnv
+    lines: List[Tuple[str, int]]
+    ops: List[WriteOperation]
+
+    def __init__(self, env: CommandEnv) -> None:
+        self.env = copy.deepcopy(env)
+        self.lines = []
+        self.ops = []
+
+    @staticmethod
+    def _fixed_metadata(op: WriteOperation, env: CommandEnv
+                        ) -> Dict[str, str]:
+        return {k: v for k, v in op.metadata.items()
+                if not ((k.startswith('_') and k != PICTURE_KEY) or
+                        k in env.incr or k in env.patterns)}
+
+    def joins(self, op: WriteOperation, env: CommandEnv) -> bool:
+        """
+        True if `op` can be reviewed with this group: neither it nor the
+        group renames files, and its metadata is the same as the group's
+        except for keys set by `setinc` or `setp`.
+        """
+        first = self.ops[0]
+        return first.new_basename is None and op.new_basename is None and \
+            self._fixed_metadata(op, env) == \
+            self._fixed_metadata(first, env)
+
+    def add(self, line: Tuple[str, int], op: WriteOperation):
+        """
+        Add a file to the group
+        """
+        self.lines.append(line)
+        self.ops.append(op)
+
+
+class BatchfileParser:  # pylint: disable=too-many-instance-attributes
     """
 A batchfile is a text file of lines. Lines either begin with a '#' to denote a
 comment, a ':' to denote a Command, and if neither of these are present, the
@@ -155,76 +261,412 @@ they appear in the batchfile.
     """
 
     dry_run: bool
+    fail_fast: bool
     env: CommandEnv
     write_metadata_f: Callable
+    read_metadata_f: Optional[Callable]
+    write_executor: Optional[WriteExecutor]
+    plan: Optional[List[WriteOperation]]
+    journal: Optional[Journal]
+    review_group: Optional[ReviewGroup]
+    report: Optional[Report]
+    renames: Optional[List[Rename]]
+    planned_renames: List[Rename]
+    rename_sources: Set[str]
+    counts: Dict[str, int]
+    line_length: int
 
     COMMAND_LEADER = ':'
     COMMENT_LEADER = '#'
 
     def __init__(self):
         self.dry_run = True
+        self.fail_fast = False
         self.env = CommandEnv()
-        self.write_metadata_f = flac
+        self.write_metadata_f = DEFAULT_BACKEND.write
+        self.read_metadata_f = DEFAULT_BACKEND.read
+        self.write_executor = None
+        self.plan = None
+        self.journal = None
+        self.review_group = None
+        self.report = None
+        self.renames = None
+        self.planned_renames = []
+        self.rename_sources = set()
+        self._deferred: Dict[int, WriteOperation] = {}
+        self.counts = {'written': 0, 'skipped': 0, 'failed': 0}
         self.outstream = sys.stdout
+        self.line_length = int(shutil.get_terminal_size()[0]) - 32
+
+    @classmethod
+    def commands(cls) -> Dict[str, Tuple[int, int]]:
+        """
+        The batchfile commands of this class, by name, with the least and
+        greatest number of arguments each takes. The table is built once for
+        each class.
+        """
+        table = cls.__dict__.get('_command_table')
+        if table is None:
+            table = {}
+            for name in dir(cls):
+                arity = getattr(getattr(cls, name), 'command_arity', None)
+                if arity is not None:
+                    table[name] = arity
+
+            cls._command_table = table
+
+        return table
 
     def eval(self, line: str, lineno: int, interactive: bool):
         """
-        Accept a line from the file and act on it.
+        Accept a line from the file and act on it. In an interactive session,
+        `finish_review()` must be called after the last line.
         """
         if line.startswith(self.COMMAND_LEADER):
+            if self.review_group is not None:
+                self.review_group.lines.append((line, lineno))
             self._handle_command(line.lstrip(self.COMMAND_LEADER), lineno)
         elif line.startswith(self.COMMENT_LEADER):
             self._handle_comment(line.lstrip(self.COMMENT_LEADER))
         else:
-            self._handle_file(line, interactive)
+            self._handle_file(line, interactive, lineno)
 
-    def _handle_command(self, line, lineno):
-        args = shlex.split(line)
-        actions = [m_name for m_name in dir(self)
-                   if not (m_name.startswith('_') or m_name == 'eval')]
+    def compile(self, lines: Iterable[Tuple[str, int]]
+                ) -> List[WriteOperation]:
+        """
+        Evaluate the (line, line number) pairs of a batchfile without writing
+        anything, validating every command. Returns the plan of operations for
+        every file in the batchfile, in order.
+
+        :raises CommandArgumentError: if a command is invalid, or the
+            environment can't be evaluated for a file, e.g. a pattern's input
+            key isn't set or a `setinc` key isn't a number.
+        """
+        self.plan = []
+        try:
+            for line, lineno in lines:
+                if len(line) == 0:
+                    continue
+
+                try:
+                    self.eval(line, lineno, interactive=False)
+                except (KeyError, ValueError, TypeError, re.error) as exc:
+                    raise CommandArgumentError(command=line,
+                                               line=lineno) from exc
+
+            return self.plan
+        finally:
+            self.plan = None
+
+    def execute(self, plan: Iterable[WriteOperation]):
+        """
+        Display and perform each operation of a plan made by `compile()`. If
+        there is a `report`, each file's outcome is reported instead.
+        """
+        for op in plan:
+            if self.report is None:
+                self._print_file(op)
+            self._perform(op)
+
+    def plan_renames(self, plan: List[WriteOperation]):
+        """
+        Check that every rename in `plan` can be performed, before anything
+        is written. Files that were renamed by an earlier run are left out.
+        Unless this is a dry run, files are then renamed by `rename_files()`
+        once all of them have been written, instead of as each is written.
+
+        :raises RenamePlanError: with every rename that can't be performed.
+        """
+        ops = plan
+        if self.journal is not None:
+            ops = [self.journal.resumable(op) for op in plan
+                   if not self.journal.applied(op)]
 
-        if args[0] in actions:
+        self.planned_renames = plan_renames(ops)
+        self.rename_sources = {r.source for r in self.planned_renames}
+        if not self.dry_run:
+            self.renames = []
+
+    def _replan_renames(self, group: ReviewGroup):
+        """
+        Check the renames of the plan again, with those of `group`, as it was
+        evaluated again after a command at the prompt, in place of its files'
+        planned renames, and plan them instead.
+
+        :raises RenamePlanError: with every rename that can't be performed.
+        """
+        paths = {os.path.abspath(op.path) for op in group.ops}
+        ops = [r.op for r in self.planned_renames if r.source not in paths]
+        self.planned_renames = plan_renames(ops + group.ops)
+        self.rename_sources = {r.source for r in self.planned_renames}
+
+    def rename_files(self):
+        """
+        Rename the files written since `plan_renames()`. A file that was
+        planned to be renamed, but wasn't written, keeps its name, so the
+        files that were to be renamed to it are not renamed. Renames stop at
+        the first that fails. If it fails in the middle of a cycle of
+        renames, the renames of the cycle already made are undone, so no
+        file is left under a temporary name.
+        """
+        renames, self.renames = self.renames or [], None
+        blocked = blocked_renames(
+            renames, self.rename_sources - {r.source for r in renames})
+        for rename in blocked:
+            self._complete_rename(rename, FileExistsError(
+                f"{rename.target} was not renamed"))
+
+        blocked_sources = {r.source for r in blocked}
+        steps = rename_steps([r for r in renames
+                              if r.source not in blocked_sources])
+        cycle: List[RenameStep] = []
+        for i, step in enumerate(steps):
+            try:
+                with STATS.phase('rename'):
+                    os.rename(step.source, step.target)
+            except OSError as exc:
+                error = self._undo_renames(cycle) or exc
+                if self.fail_fast:
+                    raise error from exc
+
+                for rest in cycle + steps[i:]:
+                    if rest.rename is not None:
+                        self._complete_rename(rest.rename, error)
+                return
+
+            if step.rename is None or cycle:
+                cycle.append(step)
+                if step.rename is None or step.source != cycle[0].target:
+                    continue
+
+            for done in cycle or [step]:
+                if done.rename is not None:
+                    STATS.count('renames')
+                    self._complete_rename(done.rename)
+            cycle = []
+
+    @staticmethod
+    def _undo_renames(steps: List[RenameStep]) -> Optional[OSError]:
+        """
+        Undo `steps`, the renames made so far in a cycle, in reverse.
+
+        :returns: The error that stopped a rename being undone, if one did.
+        """
+        for step in reversed(steps):
             try:
-                getattr(self, args[0])(args[1:])
-            except KeyError as exc:
-                raise CommandArgumentError(command=args[0],
-                                           line=lineno) from exc
+                with STATS.phase('rename'):
+                    os.rename(step.target, step.source)
+            except OSError as exc:
+                return OSError(f"{step.target} couldn't be renamed back to "
+                               f"{step.source}: {exc}")
+
+        return None
+
+    def _complete_rename(self, rename: Rename,
+                         error: Optional[BaseException] = None):
+        if error is None and self.journal is not None:
+            self.journal.record_rename(rename.op, rename.target)
+
+        if self.report is not None:
+            if error is not None:
+                self.report.file(rename.op, RENAME_FAILED, error=error)
+            else:
+                self.report.file(rename.op, RENAMED, new_path=rename.target)
+        elif error is not None:
+            self.outstream.write(f"{rename.op.path}: Rename failed! "
+                                 f"{error}\n")
         else:
-            raise UnrecognizedCommandError(command=args[0], line=lineno)
+            self.outstream.write(f"{rename.op.path}: File renamed to "
+                                 f"{os.path.basename(rename.target)}\n")
+
+    def report_files(self, report: Optional[Report]) -> Callable[[], None]:
+        """
+        Report each file to `report` from now on, instead of displaying it,
+        or if `report` is None, buffer what is displayed. Prompts can't be
+        shown while output is buffered.
+
+        :returns: A function that flushes the output.
+        """
+        self.report = report
+        if report is not None:
+            return report.stream.flush
+
+        self.outstream = BufferedOutput(self.outstream)
+        return self.outstream.flush
+
+    def concurrent_writes(self, jobs: int,
+                          write_batch_f: Optional[Callable] = None
+                          ) -> WriteExecutor:
+        """
+        Write files on a pool of `jobs` threads from now on, grouping
+        consecutive files with the same metadata into one call to
+        `write_batch_f` if it is given. Files are still reported in order.
+        The returned executor must be finished or used as a context manager.
+        """
+        self.write_executor = WriteExecutor(
+            MetadataFunctions(write=self.write_metadata_f,
+                              read=self.read_metadata_f,
+                              write_batch=write_batch_f),
+            jobs, on_complete=self._complete_write)
+        return self.write_executor
+
+    def _handle_command(self, line, lineno):
+        args = shlex.split(line)
+        name = args[0] if args else ''
+        arity = self.commands().get(name)
+        if arity is None:
+            raise UnrecognizedCommandError(command=name, line=lineno)
+
+        if not arity[0] <= len(args) - 1 <= arity[1]:
+            raise CommandArgumentError(command=name, line=lineno)
+
+        try:
+            getattr(self, name)(args[1:])
+        except (KeyError, ValueError, TypeError, OSError, re.error) as exc:
+            raise CommandArgumentError(command=name, line=lineno) from exc
 
     def _handle_comment(self, _):
         pass
 
-    def _write_metadata_and_rename_impl(self, line):
-        if self.dry_run:
+    def _file_operation(self, line, lineno, snapshot: bool
+                        ) -> WriteOperation:
+        metadata: Mapping[str, str] = self.env.metadatums
+        if snapshot:
+            metadata = self.env.snapshot()
+
+        return WriteOperation(path=line, metadata=metadata,
+                              new_basename=metadata.get('_NEW_BASENAME'),
+                              line=lineno)
+
+    def _advance(self):
+        self.env.increment_all()
+        self.env.revert_onces()
+        self.env.clear_file_keys()
+
+    def _write_metadata_and_rename_impl(self, line, lineno=-1):
+        self._perform(self._file_operation(
+            line, lineno, snapshot=self.write_executor is not None))
+        self._advance()
+
+    def _print_dry_run(self, op: WriteOperation):
+        current = None
+        if self.read_metadata_f is not None:
+            try:
+                current = self.read_metadata_f(op.path)
+            except WRITE_ERRORS:
+                pass
+
+        unchanged = current is not None and \
+            metadata_unchanged(op.path, op.metadata, lambda path: current)
+        if self.report is not None:
+            self.report.file(op, WOULD_SKIP if unchanged else WOULD_WRITE)
+            return
+
+        if unchanged:
+            self.outstream.write("DRY RUN metadata unchanged, would skip "
+                                 "write.\n")
+        else:
             print("DRY RUN would write metadata here.", file=self.outstream)
+            if current is not None:
+                target = dict(prepare_comments(op.metadata))
+                for key, value in current.items():
+                    if target.get(key) != value:
+                        self.outstream.write(f"  - {key}={value}\n")
+                for key, value in target.items():
+                    if current.get(key) != value:
+                        self.outstream.write(f"  + {key}={value}\n")
+
+        if op.new_basename is not None:
+            self.outstream.write('DRY RUN would rename file here.\n')
+
+    def _already_applied(self, op: WriteOperation) -> bool:
+        if self.journal is None or not self.journal.applied(op):
+            return False
+
+        self.counts['skipped'] += 1
+        if self.report is not None:
+            self.report.file(op, APPLIED)
+        else:
+            self.outstream.write("Already written by an earlier run, "
+                                 "skipping.\n")
+        return True
+
+    def _perform(self, op: WriteOperation):
+        if self.journal is not None and not self.dry_run:
+            if self._already_applied(op):
+                return
+
+            op = self.journal.resumable(op)
+
+        if self.renames is not None and op.new_basename is not None:
+            self._deferred[op.line] = op
+            op = op._replace(new_basename=None)
 
-            if '_NEW_BASENAME' in self.env.metadatums:
-                self.outstream.write('DRY RUN would rename file here.\n')
+        if self.dry_run:
+            self._print_dry_run(op)
+        elif self.write_executor is not None:
+            self.write_executor.submit(op)
         else:
-            self.outstream.write("Writing metadata... ")
-            self.write_metadata_f(line, self.env.metadatums)
-            self.outstream.write("Complete!\n")
+            if self.report is None:
+                self.outstream.write("Writing metadata... ")
+            try:
+                result = perform_write(op, self.write_metadata_f,
+                                       self.read_metadata_f)
+            except WRITE_ERRORS as exc:
+                self._complete_write(op, exc)
+            else:
+                self._complete_write(op, result)
 
-            if '_NEW_BASENAME' in self.env.metadatums:
-                self.outstream.write("Attempting to rename... ")
-                full_old_path = os.path.abspath(line)
-                new_name = os.path.join(os.path.dirname(full_old_path),
-                                        self.env.metadatums['_NEW_BASENAME'])
+    def _complete_write(self, op: WriteOperation,
+                        result: Union[WriteResult, BaseException]):
+        deferred = self._deferred.pop(op.line, None)
+        if isinstance(result, BaseException):
+            if self.fail_fast or not isinstance(result, WRITE_ERRORS):
+                raise result
 
-                if not os.path.exists(new_name):
-                    os.rename(line, new_name)
-                    self.outstream.write('File renamed!\n')
-                else:
-                    self.outstream.write('File by new name already exists, '
-                                         'rename was not performed.\n')
+            self.counts['failed'] += 1
+        else:
+            if self.journal is not None:
+                self.journal.record(op, result)
 
-        self.env.increment_all()
-        self.env.revert_onces()
-        self.env.clear_file_keys()
+            self.counts['written' if result.written else 'skipped'] += 1
+            rename = rename_of(deferred) if deferred is not None else None
+            if rename is not None and self.renames is not None:
+                self.renames.append(rename)
+
+        if self.report is not None:
+            if isinstance(result, BaseException):
+                self.report.file(op, FAILED, error=result)
+            else:
+                self.report.file(op, WRITTEN if result.written else SKIPPED,
+                                 new_path=result.new_path)
+        else:
+            self._print_outcome(op, result)
+
+    def _print_outcome(self, op: WriteOperation,
+                       result: Union[WriteResult, BaseException]):
+        if self.write_executor is not None:
+            self.outstream.write(f"{op.path}: ")
+
+        if isinstance(result, BaseException):
+            self.outstream.write(f"Failed! {result}\n")
+            return
+
+        if result.written:
+            self.outstream.write("Complete!\n")
+        else:
+            self.outstream.write("Metadata unchanged, write skipped.\n")
+
+        if op.new_basename is not None:
+            self.outstream.write("Attempting to rename... ")
+            if result.new_path is not None:
+                self.outstream.write('File renamed!\n')
+            else:
+                self.outstream.write('File by new name already exists, '
+                                     'rename was not performed.\n')
 
     def _print_kv_columnar(self, key, value):
-        line_len = int(shutil.get_terminal_size()[0]) - 32
+        line_len = self.line_length
         value_lines = [value[i:i+line_len] for i in
                        range(0, len(value), line_len)]
 
@@ -235,45 +677,160 @@ they appear in the batchfile.
             else:
                 self.outstream.write(f"{' ' * 30}  \033[4m{l}\033[0m\n")
 
-    def _handle_file(self, line, interactive):
-        while True:
-
-            self.env.set_file_keys(line)
-            self.env.evaluate_patterns()
-
-            if self.dry_run:
-                self.outstream.write(f"\nDRY RUN File: \033[1m{line}\033[0m\n")
+    def _print_file(self, op: WriteOperation):
+        if self.dry_run:
+            self.outstream.write(f"\nDRY RUN File: \033[1m{op.path}\033[0m\n")
+        else:
+            self.outstream.write(f"\nFile: \033[1m{op.path}\033[0m\n")
+
+        for key, value in op.metadata.items():
+
+            if key.startswith('_'):
+                continue
+
+            self._print_kv_columnar(key, value)
+
+        picture = op.metadata.get(PICTURE_KEY)
+        if picture is not None:
+            self._print_kv_columnar('(picture)', picture or '(removed)')
+
+        if op.new_basename is not None:
+            msg = "File will be renamed:"
+            self.outstream.write(f"\n{msg:.<30}  "
+                                 f"\033[4m{op.new_basename}\033[0m\n\n")
+
+    def _handle_file(self, line, interactive, lineno=-1):
+        if self.plan is not None:
+            self.plan.append(self._evaluate_file(line, lineno))
+            return
+
+        if interactive:
+            self._review_file(line, lineno)
+            return
+
+        self.env.set_file_keys(line)
+        self.env.evaluate_patterns()
+        self._print_file(self._file_operation(line, lineno, snapshot=False))
+        self._write_metadata_and_rename_impl(line, lineno)
+
+    def _evaluate_file(self, line, lineno) -> WriteOperation:
+        self.env.set_file_keys(line)
+        self.env.evaluate_patterns()
+        op = self._file_operation(line, lineno, snapshot=True)
+        self._advance()
+        return op
+
+    def _review_file(self, line, lineno):
+        """
+        Add a file to the group being reviewed or, if it can't join the
+        group, prompt for the group and begin a new one.
+        """
+        before = copy.deepcopy(self.env)
+        op = self._evaluate_file(line, lineno)
+        group = self.review_group
+        if group is not None and group.joins(op, self.env) and \
+                not (self.journal is not None and self.journal.applied(op)):
+            group.add((line, lineno), op)
+            return
+
+        self.env = before
+        self.finish_review()
+
+        group = ReviewGroup(self.env)
+        op = self._evaluate_file(line, lineno)
+        if self.journal is not None and self.journal.applied(op):
+            self._print_file(op)
+            self._already_applied(op)
+            return
+
+        group.add((line, lineno), op)
+        self.review_group = group
+
+    def _replay(self, group: ReviewGroup, command: str) -> ReviewGroup:
+        """
+        Apply `command` to the environment from before `group`, then
+        evaluate the group's lines again. If a file of the group would then
+        be renamed over a file that stays, or to the same name as another
+        file, the command is refused and `group` is returned as it was.
+        """
+        after = self.env
+        self.env = copy.deepcopy(group.env)
+        self._handle_command(command, lineno=-1)
+        replayed = ReviewGroup(self.env)
+        for line, lineno in group.lines:
+            if line.startswith(self.COMMAND_LEADER):
+                replayed.lines.append((line, lineno))
+                self._handle_command(line.lstrip(self.COMMAND_LEADER),
+                                     lineno)
             else:
-                self.outstream.write(f"\nFile: \033[1m{line}\033[0m\n")
+                replayed.add((line, lineno),
+                             self._evaluate_file(line, lineno))
+
+        try:
+            self._replan_renames(replayed)
+        except RenamePlanError as exc:
+            self.outstream.write("These files can't be renamed:\n")
+            for problem in exc.problems:
+                self.outstream.write(f"  {problem}\n")
+            self.env = after
+            return group
+
+        return replayed
+
+    def finish_review(self):
+        """
+        Prompt for the files waiting to be reviewed in an interactive session,
+        if there are any, and write them if confirmed. A command entered at
+        the prompt applies to every file in the group.
+        """
+        group, self.review_group = self.review_group, None
+        while group is not None:
+            self._print_group(group.ops)
+            prompt = 'Write? [Y/n/a/:] > ' if len(group.ops) == 1 else \
+                f"Write {len(group.ops)} files? [Y/n/a/:] > "
+            val = input(prompt)
+            if val == '' or val[0].upper() == 'Y':
+                for op in group.ops:
+                    if len(group.ops) > 1:
+                        self.outstream.write(f"{op.path}: ")
+                    self._perform(op)
+                break
+            if val.startswith(self.COMMAND_LEADER):
+                group = self._replay(group, val.lstrip(self.COMMAND_LEADER))
+            elif val == 'a':
+                print("Aborting write session...", file=sys.stdout)
+                break
 
-            for key, value in self.env.metadatums.items():
+    def _print_group(self, ops: List[WriteOperation]):
+        if len(ops) == 1:
+            self._print_file(ops[0])
+            return
 
-                if key.startswith('_'):
-                    continue
-
-                self._print_kv_columnar(key, value)
-
-            if '_NEW_BASENAME' in self.env.metadatums:
-                print("")
-                msg = "File will be renamed:"
-                print(
-                    f"{msg:.<30}  \033[4m{self.env.metadatums['_NEW_BASENAME']}\033[0m\n")
-
-            if interactive:
-                val = input('Write? [Y/n/a/:] > ')
-                if val == '' or val[0].upper() == 'Y':
-                    self._write_metadata_and_rename_impl(line)
-                    break
-                if val.startswith(self.COMMAND_LEADER):
-                    self._handle_command(val.lstrip(self.COMMAND_LEADER),
-                                         lineno=-1)
-                elif val == 'a':
-                    print("Aborting write session...", file=sys.stdout)
-                    break
-            else:
-                self._write_metadata_and_rename_impl(line)
-                break
+        keys = list(dict.fromkeys(k for op in ops for k in op.metadata
+                                  if not k.startswith('_')))
+        varying = [k for k in keys if any(op.metadata.get(k) !=
+                                          ops[0].metadata.get(k)
+                                          for op in ops)]
 
+        dry_run = 'DRY RUN ' if self.dry_run else ''
+        self.outstream.write(f"\n{dry_run}Files: \033[1m{len(ops)} files, "
+                             f"lines {ops[0].line}-{ops[-1].line}\033[0m\n")
+        for key in keys:
+            if key not in varying:
+                self._print_kv_columnar(key, ops[0].metadata[key])
+
+        columns = ['File'] + varying
+        rows = [[os.path.basename(op.path)] +
+                [op.metadata.get(k, '') for k in varying] for op in ops]
+        widths = [min(max(len(row[i]) for row in rows + [columns]), 40)
+                  for i in range(len(columns))]
+        self.outstream.write('\n')
+        for row in [columns] + rows:
+            self.outstream.write('  '.join(
+                f"{value[:width]:<{width}}"
+                for value, width in zip(row, widths)).rstrip() + '\n')
+
+    @batchfile_command(2)
     def set(self, args):
         """
         set KEY VALUE
@@ -285,6 +842,7 @@ they appear in the batchfile.
         value = args[1]
         self.env.metadatums[key] = value
 
+    @batchfile_command(2)
     def set1(self, args):
         """
         set1 KEY VALUE 
@@ -295,6 +853,7 @@ they appear in the batchfile.
         value = args[1]
         self.env.set_once(key, value)
 
+    @batchfile_command(1)
     def unset(self, args):
         """
         unset KEY 
@@ -304,6 +863,7 @@ they appear in the batchfile.
         key = args[0]
         self.env.unset_key(key)
 
+    @batchfile_command(0)
     def reset(self, _):
         """
         reset 
@@ -314,6 +874,7 @@ they appear in the batchfile.
         for k in all_keys:
             self.env.unset_key(k)
 
+    @batchfile_command(2, 3)
     def setinc(self, args):
         """
         setinc KEY INITIAL [FORMAT]
@@ -333,6 +894,7 @@ they appear in the batchfile.
         self.env.metadatums[key] = fmt % (int(initial))
         self.env.incr[key] = fmt
 
+    @batchfile_command(4)
     def setp(self, args):
         """
         setp KEY INPUT PATTERN REPL
@@ -347,17 +909,21 @@ they appear in the batchfile.
         repl = args[3]
         self.env.set_pattern(key, inp, pattern, repl)
 
+    @batchfile_command(1)
     def rename(self, args):
         """
         rename NEW-BASENAME
         Renames the next file to NEW-BASENAME. The existing file is renamed
         while keeping it in the same directory by appending the dirname and 
-        NEW-BASENAME and performing an mv(1). Renaming occurs after metadata 
-        writing. If a file with NEW-BASENAME already exists in the directory,
-        the action will not be performed.
+        NEW-BASENAME and performing an mv(1). Files are renamed once every
+        file has been written. Every rename is checked before anything is
+        written: if a file with NEW-BASENAME already exists in the directory
+        and isn't renamed itself, or two files would be renamed to the same
+        name, nothing is written. Files can be renamed to each other's names.
         """
         self.env.set_once('_NEW_BASENAME', args[0])
 
+    @batchfile_command(1)
     def d(self, args):
         """
         d VALUE
@@ -366,17 +932,24 @@ they appear in the batchfile.
         val = args[0]
         self.env.set_once('DESCRIPTION', val)
 
-    # def picture(self, args):
-    #     """
-    #     picture PATH
-    #     Add PATH as a picture (flac picture type 0) to this and every
-    #     subsequent file.
-    #     """
-    #     pass
-    #
-    # def nopicture(self, args):
-    #     """
-    #     unpicture
-    #     Remove all p
-    #     """
-    #     pass
+    @batchfile_command(1)
+    def picture(self, args):
+        """
+        picture PATH
+        Add the JPEG, PNG or GIF image at PATH as the front cover picture
+        (flac picture type 3) of this and every subsequent file, replacing any
+        pictures they have. The image is read and encoded once, however many
+        files it is written to.
+        """
+        path = os.path.abspath(args[0])
+        PICTURES.block(path)
+        self.env.metadatums[PICTURE_KEY] = path
+
+    @batchfile_command(0)
+    def nopicture(self, _):
+        """
+        nopicture
+        Remove all pictures from this and every subsequent file. After
+        "unset _PICTURE" the pictures of subsequent files are left unchanged.
+        """
+        self.env.metadatums[PICTURE_KEY] = ''
@@ -0,0 +1,193 @@
+"""
+mfbatch compact - Compact batchfile entries for created batch lists
+"""
+
+import re
+import shlex
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple
+
+from mfbatch.commands import CommandEnv
+
+FlacMetadata = Dict[str, str]
+
+
+class Derivation(NamedTuple):
+    """
+    A way of deriving a value from one of the special file keys, written as
+    a `setp` command
+    """
+    source: str
+    pattern: Pattern
+    repl: str
+
+    def derive(self, keys: Dict[str, str]) -> str:
+        """
+        The value derived for a file with the special file `keys`
+        """
+        return self.pattern.sub(self.repl, keys[self.source])
+
+
+DERIVATIONS = (
+    Derivation('_FILENAME', re.compile(r'^(.*)\.[^.]*$'), r'\1'),
+    Derivation('_FILENAME', re.compile(r'^[0-9]+[ ._-]+(.*)\.[^.]*$'), r'\1'),
+    Derivation('_FOLDER', re.compile(r'^(.*)$'), r'\1'),
+)
+
+SET = 'set'
+INCREMENT = 'setinc'
+PATTERN = 'setp'
+
+
+class KeyState(NamedTuple):
+    """
+    How a key is set in the environment by the entries written so far: to
+    a fixed value, by a `setinc` counter currently at `value`, or by a `setp`
+    derivation.
+    """
+    mode: str
+    value: str = ''
+    fmt: str = '%i'
+    derivation: Optional[Derivation] = None
+
+
+def file_keys(path: str) -> Dict[str, str]:
+    """
+    The special file keys a batchfile sets for `path`
+    """
+    env = CommandEnv()
+    env.set_file_keys(path)
+    return env.metadatums
+
+
+def number_format(value: str) -> Optional[str]:
+    """
+    The `setinc` format that writes `value`, if it is a number that `setinc`
+    can count from.
+    """
+    if re.fullmatch(r'[0-9]+', value) is None:
+        return None
+
+    return f"%0{len(value)}d" if len(value) > 1 and value[0] == '0' else '%i'
+
+
+class BatchfileCompactor:
+    """
+    Writes batchfile entries for a sequence of files, using the fewest
+    commands it can find. Each key is compared with the file after it, so
+    that:
+
+    - a value that differs from the files around it is written with `set1`,
+      or `d` for a DESCRIPTION;
+    - numbers that count up from one file to the next are written with
+      `setinc`;
+    - values that can be derived from each file's name or folder are written
+      with `setp`;
+    - and other values are written with `set` and `unset` as they change.
+
+    The entries for a file are returned once the file after it is added, or
+    by `finish()`.
+    """
+
+    state: Dict[str, KeyState]
+    pending: Optional[Tuple[str, FlacMetadata]]
+
+    def __init__(self) -> None:
+        self.state = {}
+        self.pending = None
+
+    def add(self, path: str, metadata: FlacMetadata) -> str:
+        """
+        Add the next file, returning the entries for the file before it.
+        """
+        pending, self.pending = self.pending, (path, metadata)
+        if pending is None:
+            return ''
+
+        return self._entries(pending, (path, metadata))
+
+    def finish(self) -> str:
+        """
+        Return the entries for the last file added, without comparing it to
+        a file after it.
+        """
+        pending, self.pending = self.pending, None
+        if pending is None:
+            return ''
+
+        return self._entries(pending, None)
+
+    @staticmethod
+    def _predict(state: Optional[KeyState], keys: Dict[str, str]
+                 ) -> Optional[str]:
+        if state is None:
+            return None
+        if state.mode == PATTERN and state.derivation is not None:
+            return state.derivation.derive(keys)
+
+        return state.value
+
+    def _change(self, key: str, desired: str,
+                this: Tuple[str, FlacMetadata],
+                following: Optional[Tuple[str, FlacMetadata]]) -> List[str]:
+        """
+        Commands that give `key` the value `desired` for the file `this`.
+        """
+        state = self.state.get(key)
+        quoted = shlex.quote(desired)
+        clear = [f":unset {key}"] if state is not None and \
+            state.mode != SET else []
+        if following is None:
+            self.state[key] = KeyState(SET, desired)
+            return clear + [f":set {key} {quoted}"]
+
+        next_value = following[1].get(key)
+        if not clear and next_value == self._predict(state, {}):
+            return [f":d {quoted}"] if key == 'DESCRIPTION' else \
+                [f":set1 {key} {quoted}"]
+
+        fmt = number_format(desired)
+        if fmt is not None and next_value == fmt % (int(desired) + 1):
+            if state is not None and state.mode == INCREMENT:
+                clear = []
+            self.state[key] = KeyState(INCREMENT, desired, fmt)
+            return clear + [f":setinc {key} {int(desired)}" +
+                            ('' if fmt == '%i' else f" {fmt}")]
+
+        this_keys, next_keys = file_keys(this[0]), file_keys(following[0])
+        for derivation in DERIVATIONS:
+            if derivation.derive(this_keys) == desired and \
+                    desired != next_value == derivation.derive(next_keys):
+                if state is not None and state.mode == PATTERN:
+                    clear = []
+                self.state[key] = KeyState(PATTERN, derivation=derivation)
+                return clear + [
+                    f":setp {key} {derivation.source} "
+                    f"{shlex.quote(derivation.pattern.pattern)} "
+                    f"{shlex.quote(derivation.repl)}"]
+
+        self.state[key] = KeyState(SET, desired)
+        return clear + [f":set {key} {quoted}"]
+
+    def _entries(self, this: Tuple[str, FlacMetadata],
+                 following: Optional[Tuple[str, FlacMetadata]]) -> str:
+        path, metadata = this
+        keys = file_keys(path)
+        lines = []
+        for key in list(metadata) + [k for k in self.state
+                                     if k not in metadata]:
+            desired = metadata.get(key)
+            if self._predict(self.state.get(key), keys) == desired:
+                continue
+
+            if desired is None:
+                del self.state[key]
+                lines.append(f":unset {key}")
+            else:
+                lines.extend(self._change(key, desired, this, following))
+
+        for key, state in self.state.items():
+            if state.mode == INCREMENT:
+                self.state[key] = state._replace(
+                    value=state.fmt % (int(state.value) + 1))
+
+        return ''.join(line + '\n' for line in lines) + path + "\n\n"
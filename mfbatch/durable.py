@@ -0,0 +1,142 @@
+"""
+mfbatch durable - Crash-safe replacement of files
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterator
+
+from mfbatch.stats import STATS
+
+# Directories are synced once this many files in them have been replaced
+DIRECTORY_SYNC_BATCH = 256
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def copy_range(src: BinaryIO, dst: BinaryIO, offset: int) -> int:
+    """
+    Copy `src` from `offset` to its end onto the end of `dst`, in the kernel
+    where the platform allows, which on copy-on-write filesystems shares the
+    data instead of copying it.
+
+    :returns: The number of bytes copied.
+    """
+    dst.flush()
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                count = os.copy_file_range(src.fileno(), dst.fileno(),
+                                           COPY_CHUNK_SIZE, offset + copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+        dst.seek(0, os.SEEK_END)
+
+    src.seek(offset + copied)
+    before = dst.tell()
+    shutil.copyfileobj(src, dst)
+    return copied + dst.tell() - before
+
+
+def sync_directory(dirname: str):
+    """
+    Make the entries of `dirname`, like a file replaced in it, durable
+    """
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    STATS.count('directory_syncs')
+
+
+class DirectorySync:
+    """
+    The directories in which files have been replaced since they were last
+    synced. Replacing a file is only durable once its directory is synced,
+    so rather than syncing a directory for every file, each directory is
+    synced once for a batch of replacements: once `batch` files have been
+    replaced, or when `sync()` is called at the end of a run. A crash can
+    undo the replacements of the last batch, leaving those files as they
+    were before they were written, but never partly written.
+    """
+
+    batch: int
+    pending: Dict[str, int]
+
+    def __init__(self, batch: int = DIRECTORY_SYNC_BATCH) -> None:
+        self.batch = batch
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def replaced(self, path: str):
+        """
+        Record that the file at `path` has been replaced
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        with self._lock:
+            self.pending[dirname] = self.pending.get(dirname, 0) + 1
+            if sum(self.pending.values()) < self.batch:
+                return
+
+        self.sync()
+
+    def sync(self):
+        """
+        Sync every directory in which a file has been replaced
+        """
+        with self._lock:
+            pending, self.pending = self.pending, {}
+
+        for dirname in pending:
+            sync_directory(dirname)
+
+
+# The directories of the files replaced in this run
+DIRECTORIES = DirectorySync()
+
+
+def replace_durably(f: BinaryIO, new_path: str, path: str):
+    """
+    Sync and close `f`, the open new copy of a file at `new_path` beside
+    `path`, then replace `path` with it.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    STATS.count('file_syncs')
+    os.replace(new_path, path)
+    DIRECTORIES.replaced(path)
+
+
+@contextmanager
+def replacement(path: str) -> Iterator[str]:
+    """
+    A copy of the file at `path` beside it, which replaces it durably once
+    the block exits, or is removed if the block raises. Whatever happens to
+    the copy, the file at `path` is never partly written.
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, copy = tempfile.mkstemp(dir=dirname, prefix=f".{basename}.",
+                                suffix='.tmp')
+    try:
+        with open(fd, 'wb') as out, open(path, 'rb') as src:
+            STATS.count('bytes_written', copy_range(src, out, 0))
+        shutil.copymode(path, copy)
+
+        yield copy
+
+        with open(copy, 'rb+') as f:
+            replace_durably(f, copy, path)
+    except BaseException:
+        if os.path.exists(copy):
+            os.unlink(copy)
+        raise
@@ -0,0 +1,250 @@
+"""
+mfbatch executor - Concurrent execution of metadata writes and renames
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from subprocess import CalledProcessError
+from typing import Callable, Deque, List, Mapping, NamedTuple, Optional, \
+    Set, Tuple, Union
+
+from mfbatch.metaflac import comments_repeated, metadata_matches, \
+    picture_matches, prepare_comments
+from mfbatch.native import FlacFormatError
+from mfbatch.picture import PICTURE_KEY, PictureFormatError
+from mfbatch.stats import STATS
+
+_RENAME_LOCK = threading.Lock()
+
+WRITE_ERRORS = (CalledProcessError, OSError, FlacFormatError,
+                PictureFormatError)
+
+
+class WriteOperation(NamedTuple):
+    """
+    A snapshot of the metadata to write to a file and its rename target, as
+    evaluated from the batchfile.
+    """
+    path: str
+    metadata: Mapping[str, str]
+    new_basename: Optional[str]
+    line: int = -1
+
+
+class WriteResult(NamedTuple):
+    """
+    The outcome of a `WriteOperation`
+    """
+    written: bool
+    new_path: Optional[str]
+
+
+def rename_file(path: str, new_basename: str) -> Optional[str]:
+    """
+    Rename `path` to `new_basename` in the same directory, unless a file by
+    that name already exists.
+
+    :returns: The new path, or None if the file was not renamed.
+    """
+    full_old_path = os.path.abspath(path)
+    new_name = os.path.join(os.path.dirname(full_old_path), new_basename)
+
+    with STATS.phase('rename'), _RENAME_LOCK:
+        if os.path.exists(new_name):
+            return None
+
+        os.rename(path, new_name)
+
+    STATS.count('renames')
+    return new_name
+
+
+def metadata_unchanged(path: str, metadata: Mapping[str, str],
+                       read_metadata_f: Callable) -> bool:
+    """
+    True if the file at `path` already has exactly `metadata`, each key
+    once, and the picture it names. If the file can't be read it is assumed
+    to need writing.
+    """
+    try:
+        return metadata_matches(read_metadata_f(path), metadata) and \
+            picture_matches(path, metadata) and not comments_repeated(path)
+    except WRITE_ERRORS:
+        return False
+
+
+def perform_write(op: WriteOperation, write_metadata_f: Callable,
+                  read_metadata_f: Optional[Callable] = None) -> WriteResult:
+    """
+    Write the metadata of `op` to its file and rename it. If
+    `read_metadata_f` is given, the file is read first and not written if its
+    metadata wouldn't change.
+    """
+    start = time.perf_counter()
+    written = False
+    if read_metadata_f is None or \
+            not metadata_unchanged(op.path, op.metadata, read_metadata_f):
+        write_metadata_f(op.path, op.metadata)
+        written = True
+
+    new_path = None
+    if op.new_basename is not None:
+        new_path = rename_file(op.path, op.new_basename)
+
+    STATS.latency('write', time.perf_counter() - start)
+    return WriteResult(written=written, new_path=new_path)
+
+
+def perform_writes(ops: List[WriteOperation], functions: 'MetadataFunctions'
+                   ) -> List[Union[WriteResult, Exception]]:
+    """
+    Perform a group of `WriteOperation`s without renames that all write the
+    same metadata, with a single call to `functions.write_batch` if it is
+    given. If the batch write fails, each file is written individually.
+
+    :returns: The result of each operation, or the error that it failed with.
+    """
+    results: List[Union[WriteResult, Exception]] = []
+    if functions.write_batch is not None and len(ops) > 1:
+        start = time.perf_counter()
+        changed = [op.path for op in ops if functions.read is None or
+                   not metadata_unchanged(op.path, op.metadata,
+                                          functions.read)]
+        try:
+            if changed:
+                functions.write_batch(changed, ops[0].metadata)
+        except WRITE_ERRORS:
+            pass
+        else:
+            elapsed = (time.perf_counter() - start) / len(ops)
+            for _ in ops:
+                STATS.latency('write', elapsed)
+            return [WriteResult(written=op.path in changed, new_path=None)
+                    for op in ops]
+
+    for op in ops:
+        try:
+            results.append(perform_write(op, functions.write, functions.read))
+        except WRITE_ERRORS as exc:
+            results.append(exc)
+
+    return results
+
+
+class MetadataFunctions(NamedTuple):
+    """
+    The functions a `WriteExecutor` uses to read and write metadata
+    """
+    write: Callable
+    read: Optional[Callable] = None
+    write_batch: Optional[Callable] = None
+
+
+class WriteExecutor:
+    """
+    Performs `WriteOperation`s on a pool of threads. As operations complete,
+    `on_complete` is called with each operation and its `WriteResult`, or the
+    exception it failed with, in the order they were submitted.
+
+    If `functions.write_batch` is given, consecutive operations that write
+    the same metadata without renaming are grouped and written with one call.
+    Operations on a file wait for any earlier operation that touches the same
+    path. If `on_complete` raises, all pending operations are cancelled and
+    the exception is raised by `submit()` or `finish()`.
+    """
+
+    GROUP_SIZE = 64
+
+    def __init__(self, functions: MetadataFunctions, jobs: int,
+                 on_complete: Callable) -> None:
+        self.functions = functions
+        self.on_complete = on_complete
+
+        self._window = jobs * 2
+        self._pool = ThreadPoolExecutor(max_workers=jobs)
+        self._pending: Deque[Tuple[List[WriteOperation], Future]] = deque()
+        self._group: List[WriteOperation] = []
+
+    def __enter__(self) -> 'WriteExecutor':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self._cancel()
+
+    @staticmethod
+    def _touched_paths(ops: List[WriteOperation]) -> Set[str]:
+        paths = set()
+        for op in ops:
+            paths.add(os.path.abspath(op.path))
+            if op.new_basename is not None:
+                paths.add(os.path.join(
+                    os.path.dirname(os.path.abspath(op.path)),
+                    op.new_basename))
+        return paths
+
+    def _drain(self, keep: int):
+        while len(self._pending) > keep or \
+                (self._pending and self._pending[0][1].done()):
+            ops, future = self._pending.popleft()
+            exc = future.exception()
+            results = [exc] * len(ops) if exc is not None else \
+                future.result()
+            try:
+                for op, result in zip(ops, results):
+                    self.on_complete(op, result)
+            except BaseException:
+                self._cancel()
+                raise
+
+    def _cancel(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+    def _submit_group(self):
+        if not self._group:
+            return
+
+        ops, self._group = self._group, []
+        touched = self._touched_paths(ops)
+        for pending_ops, future in self._pending:
+            if touched & self._touched_paths(pending_ops):
+                future.exception()
+
+        self._pending.append((ops, self._pool.submit(perform_writes, ops,
+                                                     self.functions)))
+        self._drain(keep=self._window)
+
+    def _joins_group(self, op: WriteOperation) -> bool:
+        return bool(self._group) and op.new_basename is None and \
+            self.functions.write_batch is not None and \
+            len(self._group) < self.GROUP_SIZE and \
+            prepare_comments(op.metadata) == \
+            prepare_comments(self._group[0].metadata) and \
+            op.metadata.get(PICTURE_KEY) == \
+            self._group[0].metadata.get(PICTURE_KEY)
+
+    def submit(self, op: WriteOperation):
+        """
+        Queue `op` for writing. Blocks while the pool is full.
+        """
+        if not self._joins_group(op):
+            self._submit_group()
+
+        self._group.append(op)
+        if op.new_basename is not None or self.functions.write_batch is None:
+            self._submit_group()
+
+    def finish(self):
+        """
+        Wait for all queued operations to complete and report them.
+        """
+        self._submit_group()
+        self._drain(keep=0)
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,149 @@
+"""
+mfbatch filelist - Streaming and sorting lists of files to scan
+"""
+
+import heapq
+import json
+import os
+import shutil
+import sys
+import tempfile
+from itertools import islice
+from operator import itemgetter
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO, \
+    Tuple, TypeVar, Union
+
+from mfbatch.stats import STATS
+from mfbatch.walk import FileRecord, file_record, file_stat
+
+T = TypeVar('T')
+
+SORT_MODES = ('path', 'mtime', 'ctime', 'name', 'none')
+
+# Files are sorted in memory until their paths take about this many bytes,
+# beyond that sorted runs are written to temporary files and merged.
+SORT_MEMORY_BUDGET = 64 * 1024 * 1024
+SORT_ENTRY_OVERHEAD = 160
+
+SortKey = Union[str, float]
+
+
+def _paths(f: TextIO) -> Iterator[str]:
+    for line in f:
+        path = line.strip()
+        if path:
+            yield path
+
+
+def read_file_list(path: str) -> Iterator[str]:
+    """
+    The paths listed one per line in the file at `path`, or on stdin if
+    `path` is '-', read as they are needed. Blank lines are skipped.
+    """
+    if path == '-':
+        yield from _paths(sys.stdin)
+        return
+
+    with open(path, mode='r', encoding='utf-8') as f:
+        yield from _paths(f)
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Lists of `size` consecutive items from `iterable`, the last may be
+    shorter
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def sort_key(mode: str) -> Optional[Callable[[FileRecord], SortKey]]:
+    """
+    The key files are sorted by in `mode`, or None if they aren't sorted.
+    The status of records from `walk_flac_files()` is reused, rather than
+    read again.
+    """
+    if mode == 'path':
+        return lambda r: r.path
+    if mode == 'mtime':
+        return lambda r: file_stat(r).st_mtime
+    if mode == 'ctime':
+        return lambda r: file_stat(r).st_ctime
+    if mode == 'name':
+        return lambda r: os.path.basename(r.path)
+
+    return None
+
+
+def _write_run(entries: List[Tuple[SortKey, Union[str, FileRecord]]],
+               dirname: str, number: int) -> str:
+    path = os.path.join(dirname, f"run{number}")
+    with open(path, mode='w', encoding='utf-8') as f:
+        for key, item in entries:
+            f.write(json.dumps([key, file_record(item).path]) + '\n')
+
+    return path
+
+
+def _read_run(path: str) -> Iterator[Tuple[SortKey, str]]:
+    with open(path, mode='r', encoding='utf-8') as f:
+        for line in f:
+            key, item = json.loads(line)
+            yield key, item
+
+
+def sorted_flac_files(files: Iterable[Union[str, FileRecord]], mode: str,
+                      memory: Optional[int] = None
+                      ) -> Iterator[Union[str, FileRecord]]:
+    """
+    Sort paths or `FileRecord`s by `mode`, one of `SORT_MODES`, yielding them
+    as they're needed. With mode 'none' files are yielded as soon as they are
+    read from `files`.
+
+    Files are sorted in memory if their paths take less than about `memory`
+    bytes, by default `SORT_MEMORY_BUDGET`. Longer lists are sorted with an
+    external merge sort, and files that were written to disk are yielded as
+    paths.
+    """
+    memory = memory or SORT_MEMORY_BUDGET
+    key = sort_key(mode)
+    if key is None:
+        yield from files
+        return
+
+    buffer: List[Tuple[SortKey, Union[str, FileRecord]]] = []
+    size = 0
+    runs: List[str] = []
+    dirname = None
+    try:
+        for item in files:
+            record = file_record(item)
+            buffer.append((key(record), item))
+            size += len(record.path) + SORT_ENTRY_OVERHEAD
+            if size > memory:
+                if dirname is None:
+                    dirname = tempfile.mkdtemp(prefix='mfbatch-sort-')
+                with STATS.phase('sort'):
+                    buffer.sort(key=itemgetter(0))
+                    runs.append(_write_run(buffer, dirname, len(runs)))
+                buffer, size = [], 0
+
+        with STATS.phase('sort'):
+            buffer.sort(key=itemgetter(0))
+
+        if dirname is None:
+            yield from (item for _, item in buffer)
+            return
+
+        runs.append(_write_run(buffer, dirname, len(runs)))
+        del buffer
+        for _, item in heapq.merge(*map(_read_run, runs), key=itemgetter(0)):
+            yield item
+    finally:
+        if dirname is not None:
+            shutil.rmtree(dirname, ignore_errors=True)
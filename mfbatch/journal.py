@@ -0,0 +1,164 @@
+"""
+mfbatch journal - Record of completed writes for resuming interrupted runs
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from mfbatch.durable import DIRECTORIES, DIRECTORY_SYNC_BATCH
+from mfbatch.executor import WriteOperation, WriteResult
+from mfbatch.metaflac import prepare_comments
+from mfbatch.picture import PICTURE_KEY
+
+JOURNAL_SUFFIX = '.journal'
+
+WRITTEN = 'W'
+RENAMED = 'R'
+
+
+def operation_hash(op: WriteOperation) -> str:
+    """
+    A digest of the comments written by `op`, and the picture if it sets one
+    """
+    comments = prepare_comments(op.metadata)
+    picture = op.metadata.get(PICTURE_KEY)
+    content = json.dumps(comments if picture is None else [comments, picture])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:32]
+
+
+class Journal:
+    """
+    An append-only log of the files written by a batchfile run, kept next to
+    the batchfile. Each line records the batchfile line number of a file, a
+    hash of the metadata written to it and its path; a file that was renamed
+    has a second line with its new path.
+
+    A journal opened to resume a run loads the entries of the earlier run,
+    otherwise any earlier journal is discarded.
+
+    A `durable` journal, for files replaced with `--safe-write`, holds each
+    entry until the directory of its file has been synced by `sync()`, and
+    then syncs the journal itself, so that after a crash no file is recorded
+    that wasn't durably written.
+    """
+
+    path: str
+    entries: Dict[Tuple[int, str], Optional[str]]
+    durable: bool
+    pending: List[str]
+
+    def __init__(self, batchfile_path: str, resume: bool = False,
+                 durable: bool = False) -> None:
+        self.path = batchfile_path + JOURNAL_SUFFIX
+        self.entries = {}
+        self.durable = durable
+        self.pending = []
+        if resume:
+            self._load()
+
+        # pylint: disable=consider-using-with
+        self._file = open(self.path, mode='a' if resume else 'w',
+                          encoding='utf-8')
+
+    def __enter__(self) -> 'Journal':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _load(self):
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t', 3)
+                    if len(fields) != 4:
+                        continue
+
+                    lineno, kind, digest, path = fields
+                    key = (int(lineno), digest)
+                    if kind == WRITTEN:
+                        self.entries.setdefault(key, None)
+                    elif kind == RENAMED:
+                        self.entries[key] = path
+        except FileNotFoundError:
+            pass
+
+    def applied(self, op: WriteOperation) -> bool:
+        """
+        True if `op` was completed by an earlier run. An operation that
+        renames its file is only complete once the file has been renamed.
+        """
+        key = (op.line, operation_hash(op))
+        return key in self.entries and \
+            (op.new_basename is None or self.entries[key] is not None)
+
+    def resumable(self, op: WriteOperation) -> WriteOperation:
+        """
+        Adapt an operation that wasn't recorded as complete. If the earlier
+        run recorded its file as written but not renamed, and the file was
+        renamed before the run was interrupted, the operation writes to the
+        renamed file and does not rename it again. Any other operation is
+        left as it is, so a missing file fails.
+        """
+        key = (op.line, operation_hash(op))
+        if op.new_basename is None or key not in self.entries or \
+                self.entries[key] is not None or os.path.exists(op.path):
+            return op
+
+        new_path = os.path.join(os.path.dirname(op.path), op.new_basename)
+        if os.path.exists(new_path):
+            return op._replace(path=new_path, new_basename=None)
+
+        return op
+
+    def record(self, op: WriteOperation, result: WriteResult):
+        """
+        Record that `op` was completed.
+        """
+        digest = operation_hash(op)
+        lines = [f"{op.line}\t{WRITTEN}\t{digest}\t{op.path}\n"]
+        if result.new_path is not None:
+            lines.append(f"{op.line}\t{RENAMED}\t{digest}\t"
+                         f"{result.new_path}\n")
+        self._write(lines)
+
+    def record_rename(self, op: WriteOperation, new_path: str):
+        """
+        Record that the file of `op`, already recorded as written, was
+        renamed to `new_path`.
+        """
+        if self.durable:
+            DIRECTORIES.replaced(new_path)
+        self._write([f"{op.line}\t{RENAMED}\t{operation_hash(op)}\t"
+                     f"{new_path}\n"])
+
+    def _write(self, lines: List[str]):
+        if not self.durable:
+            self._file.writelines(lines)
+            self._file.flush()
+            return
+
+        self.pending.extend(lines)
+        if len(self.pending) >= DIRECTORY_SYNC_BATCH:
+            self.sync()
+
+    def sync(self):
+        """
+        Sync the directories of the files written so far, then write their
+        entries and sync the journal
+        """
+        pending, self.pending = self.pending, []
+        DIRECTORIES.sync()
+        self._file.writelines(pending)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """
+        Close the journal file, syncing it first if it is durable
+        """
+        if self.durable:
+            self.sync()
+        self._file.close()
@@ -2,15 +2,29 @@
 mbatch metaflac - Read/write metadata functions
 """
 
-from subprocess import run
+import os
+import tempfile
+import time
+from contextlib import ExitStack
+from subprocess import CalledProcessError, run
 from re import match
 
-from typing import Dict
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, \
+    Tuple, Union
 
-METAFLAC_PATH = '/opt/homebrew/bin/metaflac'
+from mfbatch import native
+from mfbatch.durable import replacement
+from mfbatch.native import FlacFormatError
+from mfbatch.picture import FRONT_COVER, PICTURE_KEY, requested_picture
+from mfbatch.stats import STATS
+
+# The `metaflac` on $PATH
+METAFLAC_PATH = 'metaflac'
 
 FlacMetadata = Dict[str, str]
 
+MAX_FILES_PER_INVOCATION = 1000
+
 
 def sanatize_key(k: str) -> str:
     """
@@ -37,38 +51,343 @@ def sanatize_value(v: str) -> str:
     return v.translate(str.maketrans('\n', ' '))
 
 
-def read_metadata(path: str, metaflac_path=METAFLAC_PATH) -> FlacMetadata:
+def _run(command: List[str], check: bool, **kwargs):
+    STATS.count('subprocesses')
+    with STATS.phase('metaflac'):
+        return run(command, check=check, **kwargs)
+
+
+def read_metadata(path: str, metaflac_path: Optional[str] = METAFLAC_PATH
+                  ) -> FlacMetadata:
     """
-    Read metadata from a FLAC file
+    Read metadata from a FLAC file. The metadata blocks are parsed directly,
+    if the file can't be parsed `metaflac` is used instead, unless
+    `metaflac_path` is None.
+    """
+    try:
+        return native.read_metadata(path)
+    except FlacFormatError:
+        if metaflac_path is None:
+            raise
+        return read_metadata_metaflac(path, metaflac_path)
+
+
+def _parse_comment_listing(line: str, file_metadata: FlacMetadata):
+    m = match(r'^\s+comment\[\d+\]: ([^=]+)=(.*)$', line)
+    if m is not None:
+        file_metadata[m[1]] = m[2]
+
+
+def read_metadata_metaflac(path: str,
+                           metaflac_path=METAFLAC_PATH) -> FlacMetadata:
+    """
+    Read metadata from a FLAC file with `metaflac --list`
     """
     metaflac_command = [metaflac_path, '--list']
-    result = run(metaflac_command + [path], capture_output=True, check=True)
+    result = _run(metaflac_command + [path], capture_output=True, check=True)
 
-    file_metadata = {}
+    file_metadata: FlacMetadata = {}
     for line in result.stdout.decode('utf-8').splitlines():
-        m = match(r'^\s+comment\[\d\]: ([A-Za-z]+)=(.*)$', line)
-        if m is not None:
-            file_metadata[m[1]] = m[2]
+        _parse_comment_listing(line, file_metadata)
 
     return file_metadata
 
 
-def write_metadata(path: str, data: FlacMetadata,
-                   metaflac_path=METAFLAC_PATH):
+def read_metadata_batch(paths: Sequence[str],
+                        metaflac_path: Optional[str] = METAFLAC_PATH
+                        ) -> List[Union[FlacMetadata, Exception]]:
     """
-    Write metadata to a FLAC file
+    Read metadata from many FLAC files. Files that can't be parsed directly
+    are read with as few `metaflac` invocations as possible, unless
+    `metaflac_path` is None.
+
+    :returns: The metadata of each file in `paths`, or the error that
+        prevented reading it.
     """
-    run([metaflac_path, '--remove-all-tags', path], check=True)
+    results: List[Union[FlacMetadata, Exception]] = []
+    fallback: List[int] = []
+    for path in paths:
+        start = time.perf_counter()
+        try:
+            results.append(native.read_metadata(path))
+        except FlacFormatError as exc:
+            fallback.append(len(results))
+            results.append(exc)
+        except OSError as exc:
+            results.append(exc)
+        STATS.latency('read', time.perf_counter() - start)
 
-    metadatum_f = ""
+    if fallback and metaflac_path is not None:
+        fallback_results = read_metadata_batch_metaflac(
+            [paths[i] for i in fallback], metaflac_path)
+        for i, result in zip(fallback, fallback_results):
+            results[i] = result
+
+    return results
+
+
+def _arg_max() -> int:
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = 32768
+
+    environment = sum(len(k) + len(v) + 2 for k, v in os.environ.items())
+    return max(arg_max // 2 - environment, 4096)
+
+
+def command_chunks(command: List[str],
+                   paths: Sequence[str]) -> Iterator[List[str]]:
+    """
+    Split `paths` into runs that can be appended to `command` without
+    exceeding the system's limit on the length of a command line.
+    """
+    limit = _arg_max() - sum(len(arg) + 9 for arg in command)
+    chunk: List[str] = []
+    size = 0
+    for path in paths:
+        arg_size = len(os.fsencode(path)) + 9
+        if chunk and (size + arg_size > limit or
+                      len(chunk) >= MAX_FILES_PER_INVOCATION):
+            yield chunk
+            chunk, size = [], 0
+
+        chunk.append(path)
+        size += arg_size
 
+    if chunk:
+        yield chunk
+
+
+def read_metadata_batch_metaflac(paths: Sequence[str],
+                                 metaflac_path=METAFLAC_PATH
+                                 ) -> List[Union[FlacMetadata, Exception]]:
+    """
+    Read metadata from many FLAC files, passing as many files as possible to
+    each `metaflac --list` invocation. Files that `metaflac` fails to read
+    are read again individually, to get the error for that file.
+
+    :returns: The metadata of each file in `paths`, or the error that
+        prevented reading it.
+    """
+    command = [metaflac_path, '--list', '--with-filename',
+               '--block-type=STREAMINFO,VORBIS_COMMENT']
+    results: List[Union[FlacMetadata, Exception]] = []
+    for chunk in command_chunks(command, paths):
+        result = _run(command + chunk, capture_output=True, check=False)
+
+        listed: List[Optional[FlacMetadata]] = [None] * len(chunk)
+        index = 0
+        for line in result.stdout.decode('utf-8').splitlines():
+            for i in range(index, len(chunk)):
+                prefix = chunk[i] + ':'
+                if line.startswith(prefix):
+                    index = i
+                    file_metadata = listed[i]
+                    if file_metadata is None:
+                        file_metadata = listed[i] = {}
+                    _parse_comment_listing(line[len(prefix):], file_metadata)
+                    break
+
+        for path, file_metadata in zip(chunk, listed):
+            if file_metadata is not None:
+                results.append(file_metadata)
+                continue
+
+            try:
+                results.append(read_metadata_metaflac(path, metaflac_path))
+            except (CalledProcessError, OSError) as exc:
+                results.append(exc)
+
+    return results
+
+
+def prepare_comments(data: Mapping[str, str]) -> List[Tuple[str, str]]:
+    """
+    Sanatize the keys and values of `data` for writing, omitting the internal
+    keys that begin with an underscore.
+    """
+    comments = []
     for k in data.keys():
         key = sanatize_key(k)
         val = sanatize_value(data[k])
         if key.startswith('_'):
             continue
 
+        comments.append((key, val))
+
+    return comments
+
+
+def metadata_matches(current: FlacMetadata, data: Mapping[str, str]
+                     ) -> bool:
+    """
+    True if writing `data` to a file would leave its `current` comments, as
+    read by `read_metadata()`, unchanged. Keys are compared as they would be
+    written, whatever their case in the file. Pictures are compared by
+    `picture_matches()`.
+    """
+    return dict(prepare_comments(data)) == \
+        {sanatize_key(k): v for k, v in current.items()}
+
+
+def comments_repeated(path: str) -> bool:
+    """
+    True if a key appears more than once, in any case, in the comments of
+    the FLAC file at `path`, as read by `native.read_comments()`. Writing
+    such a file leaves each key once, even if its metadata already matches.
+    A file that can't be parsed directly is assumed not to.
+    """
+    try:
+        keys = [sanatize_key(k) for k, _ in native.read_comments(path)]
+    except (OSError, FlacFormatError):
+        return False
+
+    return len(set(keys)) != len(keys)
+
+
+def picture_matches(path: str, data: Mapping[str, str]) -> bool:
+    """
+    True if writing `data` would leave the pictures of the FLAC file at
+    `path` unchanged, as read by `native.pictures_match()`. If the file can't
+    be parsed directly it is assumed to need writing.
+    """
+    picture = requested_picture(data)
+    if picture is None:
+        return True
+
+    try:
+        return native.pictures_match(path, picture)
+    except FlacFormatError:
+        return False
+
+
+def write_metadata(path: str, data: FlacMetadata,
+                   metaflac_path: Optional[str] = METAFLAC_PATH,
+                   min_padding: int = 0, safe: bool = False):
+    """
+    Write metadata to a FLAC file. The VORBIS_COMMENT block is replaced in
+    place where possible, if the file can't be parsed `metaflac` is used
+    instead, unless `metaflac_path` is None. A file left with less than
+    `min_padding` bytes of padding is rewritten to restore it, except by
+    `metaflac`.
+
+    If `data` has a `PICTURE_KEY` the picture it names replaces those in the
+    file, or they are removed if it is empty.
+
+    If `safe`, the file is never modified in place: the new file is written
+    beside it, synced, and then replaces it, so a crash can't leave it partly
+    written. `durable.DIRECTORIES` must be synced when the run ends.
+    """
+    try:
+        native.write_metadata(path, prepare_comments(data),
+                              min_padding=min_padding,
+                              picture=requested_picture(data), safe=safe)
+    except FlacFormatError:
+        if metaflac_path is None:
+            raise
+        write_metadata_metaflac(path, data, metaflac_path, safe=safe)
+
+
+def picture_commands(data: FlacMetadata,
+                     metaflac_path=METAFLAC_PATH) -> List[List[str]]:
+    """
+    The `metaflac` commands that write the picture of `data`, if it has a
+    `PICTURE_KEY`, to the files appended to each
+    """
+    picture = data.get(PICTURE_KEY)
+    if picture is None:
+        return []
+
+    commands = [[metaflac_path, '--remove', '--block-type=PICTURE']]
+    if picture:
+        commands.append([metaflac_path,
+                         f"--import-picture-from={FRONT_COVER}||||{picture}"])
+
+    return commands
+
+
+def write_metadata_metaflac(path: str, data: FlacMetadata,
+                            metaflac_path=METAFLAC_PATH, safe: bool = False):
+    """
+    Write metadata to a FLAC file with `metaflac`. If `safe`, a copy of the
+    file is written and replaces it, like `write_metadata()`.
+    """
+    if safe:
+        with replacement(path) as copy:
+            write_metadata_metaflac(copy, data, metaflac_path)
+        return
+
+    _run([metaflac_path, '--remove-all-tags', path], check=True)
+
+    metadatum_f = ""
+
+    for key, val in prepare_comments(data):
         metadatum_f = metadatum_f + f"{key}={val}\n"
 
-    run([metaflac_path, "--import-tags-from=-", path],
+    _run([metaflac_path, "--import-tags-from=-", path],
         input=metadatum_f.encode('utf-8'), check=True)
+
+    for command in picture_commands(data, metaflac_path):
+        _run(command + [path], check=True)
+
+
+def write_metadata_batch(paths: Sequence[str], data: FlacMetadata,
+                         metaflac_path: Optional[str] = METAFLAC_PATH,
+                         min_padding: int = 0, safe: bool = False):
+    """
+    Write the same metadata to many FLAC files. Files that can't be written
+    directly are written with as few `metaflac` invocations as possible. If
+    `safe`, files are replaced like `write_metadata()`.
+
+    :raises FlacFormatError: if a file can't be written directly and
+        `metaflac_path` is None. The other files are still written.
+    """
+    comments = prepare_comments(data)
+    picture = requested_picture(data)
+    fallback = []
+    error: Optional[FlacFormatError] = None
+    for path in paths:
+        try:
+            native.write_metadata(path, comments, min_padding=min_padding,
+                                  picture=picture, safe=safe)
+        except FlacFormatError as exc:
+            fallback.append(path)
+            error = error or exc
+
+    if error is not None and metaflac_path is None:
+        raise error
+
+    if fallback:
+        write_metadata_batch_metaflac(fallback, data, metaflac_path,
+                                      safe=safe)
+
+
+def write_metadata_batch_metaflac(paths: Sequence[str], data: FlacMetadata,
+                                  metaflac_path=METAFLAC_PATH,
+                                  safe: bool = False):
+    """
+    Write the same metadata to many FLAC files, passing as many files as
+    possible to each `metaflac` invocation. If `safe`, a copy of each file is
+    written and replaces it, like `write_metadata()`.
+    """
+    if safe:
+        with ExitStack() as stack:
+            write_metadata_batch_metaflac(
+                [stack.enter_context(replacement(path)) for path in paths],
+                data, metaflac_path)
+        return
+
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8',
+                                     suffix='.txt', delete=False) as f:
+        for key, val in prepare_comments(data):
+            f.write(f"{key}={val}\n")
+
+    try:
+        commands = [[metaflac_path, '--remove-all-tags',
+                     f"--import-tags-from={f.name}"]]
+        for command in commands + picture_commands(data, metaflac_path):
+            for chunk in command_chunks(command, paths):
+                _run(command + chunk, check=True)
+    finally:
+        os.unlink(f.name)
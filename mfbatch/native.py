@@ -0,0 +1,500 @@
+"""
+mfbatch native - Pure-Python FLAC metadata block reading and writing
+"""
+
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple
+
+from mfbatch.durable import copy_range, replace_durably
+from mfbatch.stats import STATS
+
+FLAC_MARKER = b'fLaC'
+ID3V2_MARKER = b'ID3'
+
+STREAMINFO = 0
+PADDING = 1
+APPLICATION = 2
+SEEKTABLE = 3
+VORBIS_COMMENT = 4
+CUESHEET = 5
+PICTURE = 6
+INVALID = 127
+
+MAX_BLOCK_LENGTH = (1 << 24) - 1
+DEFAULT_PADDING = 8192
+DEFAULT_VENDOR = 'mfbatch'
+
+UNCHANGED = 'unchanged'
+IN_PLACE = 'in place'
+REWRITTEN = 'rewritten'
+
+
+class FlacFormatError(Exception):
+    """
+    The file is not a FLAC file, or its metadata blocks could not be parsed
+    """
+
+
+class MetadataBlock(NamedTuple):
+    """
+    The header of a FLAC metadata block and its location in the file
+    """
+    block_type: int
+    offset: int
+    length: int
+    is_last: bool
+
+
+def _read_exactly(f: BinaryIO, count: int) -> bytes:
+    data = f.read(count)
+    STATS.count('bytes_read', len(data))
+    if len(data) != count:
+        raise FlacFormatError("Unexpected end of file in metadata")
+
+    return data
+
+
+def _seek_flac_marker(f: BinaryIO) -> int:
+    """
+    Position `f` just after the "fLaC" marker, skipping a leading ID3v2 tag if
+    one is present, and return the offset of the first metadata block.
+    """
+    head = f.read(10)
+    STATS.count('bytes_read', len(head) + 4)
+    offset = 0
+    if head[0:3] == ID3V2_MARKER and len(head) == 10:
+        size = 0
+        for b in head[6:10]:
+            size = (size << 7) | (b & 0x7F)
+
+        offset = 10 + size
+        if head[5] & 0x10:
+            offset += 10
+
+    f.seek(offset)
+    if f.read(4) != FLAC_MARKER:
+        raise FlacFormatError("File does not begin with a FLAC marker")
+
+    return offset + 4
+
+
+def _read_block_header(f: BinaryIO) -> MetadataBlock:
+    offset = f.tell()
+    header = _read_exactly(f, 4)
+    block_type = header[0] & 0x7F
+    if block_type == INVALID:
+        raise FlacFormatError(f"Invalid metadata block at offset {offset}")
+
+    return MetadataBlock(block_type=block_type, offset=offset,
+                         length=int.from_bytes(header[1:4], 'big'),
+                         is_last=bool(header[0] & 0x80))
+
+
+def read_block_headers(f: BinaryIO) -> Tuple[List[MetadataBlock], int]:
+    """
+    Read the headers of every metadata block in a FLAC file, without reading
+    block contents.
+
+    :returns: The list of blocks and the offset of the first audio frame.
+    """
+    f.seek(_seek_flac_marker(f))
+    blocks = []
+    while True:
+        block = _read_block_header(f)
+        blocks.append(block)
+        f.seek(block.length, 1)
+        if block.is_last:
+            break
+
+    if f.tell() > os.fstat(f.fileno()).st_size:
+        raise FlacFormatError("Metadata block overruns end of file")
+
+    return blocks, f.tell()
+
+
+def parse_vorbis_comment(data: bytes) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Parse the body of a VORBIS_COMMENT block.
+
+    :returns: The vendor string and a list of (key, value) comments, in the
+        order they appear in the block.
+    """
+    pos = 0
+
+    def take(count: int) -> bytes:
+        nonlocal pos
+        if pos + count > len(data):
+            raise FlacFormatError("Malformed VORBIS_COMMENT block")
+
+        pos += count
+        return data[pos - count:pos]
+
+    vendor = take(int.from_bytes(take(4), 'little')).decode('utf-8',
+                                                            errors='replace')
+    comments = []
+    for _ in range(int.from_bytes(take(4), 'little')):
+        entry = take(int.from_bytes(take(4), 'little')).decode(
+            'utf-8', errors='replace')
+        key, sep, value = entry.partition('=')
+        if sep:
+            comments.append((key, value))
+
+    return vendor, comments
+
+
+def read_comments(path: str) -> List[Tuple[str, str]]:
+    """
+    Read the comments of the VORBIS_COMMENT block of a FLAC file, in order,
+    including any repeated keys. Only the metadata block headers and the
+    contents of the VORBIS_COMMENT block are read.
+    """
+    with open(path, 'rb') as f:
+        f.seek(_seek_flac_marker(f))
+        while True:
+            block = _read_block_header(f)
+            if block.block_type == VORBIS_COMMENT:
+                _, comments = parse_vorbis_comment(
+                    _read_exactly(f, block.length))
+                return comments
+
+            if block.is_last:
+                return []
+
+            f.seek(block.length, 1)
+
+
+def read_metadata(path: str) -> Dict[str, str]:
+    """
+    Read the VORBIS_COMMENT metadata from a FLAC file, like
+    `read_comments()`. A repeated key has its last value.
+    """
+    return dict(read_comments(path))
+
+
+def _block_header(block_type: int, length: int, is_last: bool) -> bytes:
+    if length > MAX_BLOCK_LENGTH:
+        raise FlacFormatError("Metadata block is too large")
+
+    return bytes([block_type | (0x80 if is_last else 0)]) + \
+        length.to_bytes(3, 'big')
+
+
+def _padding(length: int, is_last: bool) -> bytes:
+    return _block_header(PADDING, length, is_last) + bytes(length)
+
+
+def build_vorbis_comment(vendor: str, comments: List[Tuple[str, str]]) -> bytes:
+    """
+    Encode the body of a VORBIS_COMMENT block.
+    """
+    vendor_bytes = vendor.encode('utf-8')
+    parts = [len(vendor_bytes).to_bytes(4, 'little'), vendor_bytes,
+             len(comments).to_bytes(4, 'little')]
+    for key, value in comments:
+        entry = f"{key}={value}".encode('utf-8')
+        parts.append(len(entry).to_bytes(4, 'little'))
+        parts.append(entry)
+
+    return b''.join(parts)
+
+
+def _fits(remainder: int, min_padding: int) -> bool:
+    """
+    True if `remainder` bytes left over can be filled with a PADDING block of
+    at least `min_padding` bytes, or left empty if no padding is required.
+    """
+    return (remainder == 0 and min_padding == 0) or \
+        remainder >= 4 + min_padding
+
+
+def _fit_span(blocks: List[MetadataBlock], first: int, last: int,
+              needed: int, min_padding: int = 0) -> Optional[bytes]:
+    """
+    Fit `needed` bytes of blocks into the space occupied by blocks[first:last],
+    filling any remainder with a PADDING block. Returns None if the blocks
+    don't fit, or if the PADDING block would be smaller than `min_padding`.
+    """
+    available = sum(4 + b.length for b in blocks[first:last])
+    remainder = available - needed
+    if _fits(remainder, min_padding):
+        return b'' if remainder == 0 else \
+            _padding(remainder - 4, blocks[last - 1].is_last)
+
+    return None
+
+
+def _adjacent_span(blocks: List[MetadataBlock], index: int
+                   ) -> Tuple[int, int]:
+    """
+    The range of blocks made up of blocks[index] and the PADDING blocks
+    around it
+    """
+    first, last = index, index + 1
+    while first > 0 and blocks[first - 1].block_type == PADDING:
+        first -= 1
+    while last < len(blocks) and blocks[last].block_type == PADDING:
+        last += 1
+
+    return first, last
+
+
+def _write_in_place(f: BinaryIO, blocks: List[MetadataBlock],
+                    body: bytes, min_padding: int = 0) -> bool:
+    """
+    Replace or insert the VORBIS_COMMENT block using only the space taken by
+    the existing block and the PADDING blocks around it, leaving at least
+    `min_padding` bytes of padding after it.
+    """
+    vc_index = next((i for i, b in enumerate(blocks)
+                     if b.block_type == VORBIS_COMMENT), None)
+
+    if vc_index is not None:
+        spans = [_adjacent_span(blocks, vc_index)]
+    else:
+        spans = [_adjacent_span(blocks, i) for i, b in enumerate(blocks)
+                 if b.block_type == PADDING]
+
+    for first, last in spans:
+        filler = _fit_span(blocks, first, last, 4 + len(body), min_padding)
+        if filler is None:
+            continue
+
+        is_last = blocks[last - 1].is_last and len(filler) == 0
+        f.seek(blocks[first].offset)
+        STATS.count('bytes_written', f.write(
+            _block_header(VORBIS_COMMENT, len(body), is_last) + body +
+            filler))
+        return True
+
+    return False
+
+
+def _arrange_blocks(f: BinaryIO, blocks: List[MetadataBlock],
+                    body: bytes, picture: Optional[bytes] = None
+                    ) -> List[Tuple[int, bytes]]:
+    """
+    Read every block other than PADDING and VORBIS_COMMENT from `f`, and
+    return them in their existing order followed by the new VORBIS_COMMENT,
+    so the VORBIS_COMMENT and any padding are always at the end.
+
+    If `picture` is given every PICTURE block is replaced by it, placed just
+    before the VORBIS_COMMENT, or removed if it is empty.
+    """
+    replaced = (PADDING, VORBIS_COMMENT) if picture is None else \
+        (PADDING, VORBIS_COMMENT, PICTURE)
+    arranged = []
+    for block in blocks:
+        if block.block_type not in replaced:
+            f.seek(block.offset + 4)
+            arranged.append((block.block_type,
+                             _read_exactly(f, block.length)))
+
+    if picture:
+        arranged.append((PICTURE, picture))
+    arranged.append((VORBIS_COMMENT, body))
+    return arranged
+
+
+def _encode_blocks(arranged: List[Tuple[int, bytes]],
+                   padding: Optional[int]) -> bytes:
+    parts = []
+    for i, (block_type, data) in enumerate(arranged):
+        is_last = padding is None and i == len(arranged) - 1
+        parts.append(_block_header(block_type, len(data), is_last) + data)
+
+    if padding is not None:
+        parts.append(_padding(padding, True))
+
+    return b''.join(parts)
+
+
+def _region_remainder(blocks: List[MetadataBlock], audio_offset: int,
+                      arranged: List[Tuple[int, bytes]]) -> int:
+    """
+    The bytes left over if the `arranged` blocks replace all metadata blocks
+    before the first audio frame, negative if they don't fit
+    """
+    available = audio_offset - blocks[0].offset
+    return available - sum(4 + len(d) for _, d in arranged)
+
+
+def _write_metadata_region(f: BinaryIO, blocks: List[MetadataBlock],
+                           audio_offset: int,
+                           arranged: List[Tuple[int, bytes]],
+                           min_padding: int = 0) -> bool:
+    """
+    Rewrite all metadata blocks in place as `arranged`, consolidating every
+    PADDING block, if they fit before the first audio frame with at least
+    `min_padding` bytes of padding.
+    """
+    remainder = _region_remainder(blocks, audio_offset, arranged)
+    if not _fits(remainder, min_padding):
+        return False
+
+    f.seek(blocks[0].offset)
+    STATS.count('bytes_written', f.write(
+        _encode_blocks(arranged, remainder - 4 if remainder else None)))
+    return True
+
+
+def _rewrite_file(path: str, f: BinaryIO, region: Tuple[int, int],
+                  metadata: bytes, safe: bool = False):
+    """
+    Write a new copy of the file with the encoded `metadata` blocks in place
+    of the metadata `region`, from the first block to the first audio frame,
+    beside the original, then replace the original. If `safe`, the copy is
+    synced before it replaces the original, and its directory is synced with
+    the next batch.
+    """
+    start, audio_offset = region
+    f.seek(0)
+    prefix = _read_exactly(f, start)
+
+    dirname, basename = os.path.split(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=dirname, prefix=f".{basename}.",
+                                     suffix='.tmp', delete=False) as out:
+        try:
+            out.write(prefix)
+            out.write(metadata)
+            STATS.count('bytes_read', copy_range(f, out, audio_offset) +
+                        len(prefix))
+            STATS.count('bytes_written', out.tell())
+            shutil.copymode(path, out.name)
+            if safe:
+                replace_durably(out, out.name, path)
+            else:
+                out.close()
+                os.replace(out.name, path)
+        except BaseException:
+            os.unlink(out.name)
+            raise
+
+
+def _vorbis_comment_body(f: BinaryIO, blocks: List[MetadataBlock]
+                         ) -> Optional[bytes]:
+    for block in blocks:
+        if block.block_type == VORBIS_COMMENT:
+            f.seek(block.offset + 4)
+            return _read_exactly(f, block.length)
+
+    return None
+
+
+def _pictures_match(f: BinaryIO, blocks: List[MetadataBlock],
+                    picture: bytes) -> bool:
+    """
+    True if the PICTURE blocks of the file are already those that writing
+    `picture` would leave: none if it is empty, or else only `picture`.
+    """
+    pictures = [b for b in blocks if b.block_type == PICTURE]
+    if not picture:
+        return not pictures
+    if len(pictures) != 1 or pictures[0].length != len(picture):
+        return False
+
+    f.seek(pictures[0].offset + 4)
+    return _read_exactly(f, len(picture)) == picture
+
+
+def pictures_match(path: str, picture: bytes) -> bool:
+    """
+    True if the PICTURE blocks of a FLAC file are already those that writing
+    `picture`, the body of a PICTURE block or empty, would leave. Only the
+    metadata block headers and the file's PICTURE block are read.
+    """
+    with open(path, 'rb') as f:
+        blocks, _ = read_block_headers(f)
+        return _pictures_match(f, blocks, picture)
+
+
+def write_metadata(path: str, comments: List[Tuple[str, str]],  # pylint: disable=too-many-arguments
+                   padding: int = DEFAULT_PADDING, min_padding: int = 0,
+                   picture: Optional[bytes] = None, *, safe: bool = False):
+    """
+    Replace the VORBIS_COMMENT metadata in a FLAC file. The vendor string of
+    the existing block is preserved.
+
+    The new block is written in place if it fits in the space of the existing
+    block and the PADDING blocks adjacent to it, or else if all of the
+    metadata blocks fit before the first audio frame. Either way at least
+    `min_padding` bytes of padding must be left after it. Only if neither is
+    possible is the whole file rewritten, with `padding` bytes of padding or
+    `min_padding` if that is larger.
+
+    If `picture` is given, the body of a PICTURE block, it replaces every
+    PICTURE block in the file, or they are removed if it is empty. A new
+    picture is placed before the VORBIS_COMMENT, so that the VORBIS_COMMENT
+    stays next to the padding and later writes can still be made in place.
+
+    If `safe`, the file is never modified in place. A new copy is always
+    written beside it, keeping the size of its metadata if the new blocks
+    fit, and replaces it only once synced, so that a crash leaves either the
+    old file or the new one.
+    """
+    with open(path, 'r+b' if not safe else 'rb') as f:
+        blocks, audio_offset = read_block_headers(f)
+        vendor = DEFAULT_VENDOR
+        existing = _vorbis_comment_body(f, blocks)
+        if existing is not None:
+            vendor, _ = parse_vorbis_comment(existing)
+
+        body = build_vorbis_comment(vendor, comments)
+        if len(body) > MAX_BLOCK_LENGTH:
+            raise FlacFormatError("VORBIS_COMMENT block is too large")
+
+        if picture is not None and _pictures_match(f, blocks, picture):
+            picture = None
+
+        if not safe and picture is None and \
+                _write_in_place(f, blocks, body, min_padding):
+            return
+
+        arranged = _arrange_blocks(f, blocks, body, picture)
+        if not safe and _write_metadata_region(f, blocks, audio_offset,
+                                               arranged, min_padding):
+            return
+
+        remainder = _region_remainder(blocks, audio_offset, arranged)
+        new_padding: Optional[int] = max(padding, min_padding)
+        if safe and _fits(remainder, min_padding):
+            new_padding = remainder - 4 if remainder else None
+
+        _rewrite_file(path, f, (blocks[0].offset, audio_offset),
+                      _encode_blocks(arranged, new_padding), safe)
+
+
+def repad(path: str, padding: int = DEFAULT_PADDING) -> str:
+    """
+    Make sure the VORBIS_COMMENT block of a FLAC file has at least `padding`
+    bytes of padding next to it, so that later writes can be made in place.
+    A file without a VORBIS_COMMENT block is given an empty one.
+
+    If the metadata blocks fit before the first audio frame with enough
+    padding they are rewritten in place, otherwise the whole file is
+    rewritten with exactly `padding` bytes of padding.
+
+    :returns: `UNCHANGED`, `IN_PLACE` or `REWRITTEN`
+    """
+    with open(path, 'r+b') as f:
+        blocks, audio_offset = read_block_headers(f)
+        body = _vorbis_comment_body(f, blocks)
+        if body is not None:
+            index = next(i for i, b in enumerate(blocks)
+                         if b.block_type == VORBIS_COMMENT)
+            first, last = _adjacent_span(blocks, index)
+            if _fit_span(blocks, first, last, 4 + len(body),
+                         padding) is not None:
+                return UNCHANGED
+        else:
+            body = build_vorbis_comment(DEFAULT_VENDOR, [])
+
+        arranged = _arrange_blocks(f, blocks, body)
+        if _write_metadata_region(f, blocks, audio_offset, arranged,
+                                  padding):
+            return IN_PLACE
+
+        _rewrite_file(path, f, (blocks[0].offset, audio_offset),
+                      _encode_blocks(arranged, padding))
+        return REWRITTEN
@@ -0,0 +1,235 @@
+"""
+mfbatch picture - Encoding and caching of FLAC PICTURE blocks
+"""
+
+import hashlib
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+
+from mfbatch.native import MAX_BLOCK_LENGTH
+from mfbatch.stats import STATS
+
+# The key holding the path of the picture to write, or '' to remove pictures
+PICTURE_KEY = '_PICTURE'
+
+FRONT_COVER = 3
+
+# Encoded pictures are kept until they take more than this many bytes
+PICTURE_CACHE_SIZE = 64 * 1024 * 1024
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+class PictureFormatError(ValueError):
+    """
+    The file is not a JPEG, PNG or GIF image that can be written as a picture
+    """
+
+
+class ImageInfo(NamedTuple):
+    """
+    The fields of a PICTURE block that describe its image
+    """
+    mime: str
+    width: int
+    height: int
+    depth: int
+    colors: int = 0
+
+
+def _png_info(data: bytes) -> ImageInfo:
+    if len(data) < 33 or data[12:16] != b'IHDR':
+        raise PictureFormatError("Malformed PNG image")
+
+    width, height, bit_depth, color_type = struct.unpack('>IIBB',
+                                                         data[16:26])
+    if color_type not in PNG_CHANNELS:
+        raise PictureFormatError("Malformed PNG image")
+
+    if color_type != 3:
+        return ImageInfo('image/png', width, height,
+                         bit_depth * PNG_CHANNELS[color_type])
+
+    pos = 8
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        if data[pos + 4:pos + 8] == b'PLTE':
+            return ImageInfo('image/png', width, height, 24, length // 3)
+        pos += 12 + length
+
+    raise PictureFormatError("PNG image has no palette")
+
+
+def _jpeg_info(data: bytes) -> ImageInfo:
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            break
+
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC) and \
+                pos + 10 <= len(data):
+            precision, height, width, components = struct.unpack(
+                '>BHHB', data[pos + 4:pos + 10])
+            return ImageInfo('image/jpeg', width, height,
+                             precision * components)
+
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+
+    raise PictureFormatError("JPEG image has no frame header")
+
+
+def _gif_info(data: bytes) -> ImageInfo:
+    if len(data) < 13:
+        raise PictureFormatError("Malformed GIF image")
+
+    width, height, packed = struct.unpack('<HHB', data[6:11])
+    colors = 1 << ((packed & 7) + 1) if packed & 0x80 else 0
+    return ImageInfo('image/gif', width, height,
+                     (((packed >> 4) & 7) + 1) * 3, colors)
+
+
+def probe_image(data: bytes) -> ImageInfo:
+    """
+    Find the MIME type and dimensions of a JPEG, PNG or GIF image from its
+    headers.
+    """
+    if data.startswith(PNG_SIGNATURE):
+        return _png_info(data)
+    if data.startswith(b'\xff\xd8'):
+        return _jpeg_info(data)
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return _gif_info(data)
+
+    raise PictureFormatError("Not a JPEG, PNG or GIF image")
+
+
+def encode_picture(data: bytes, picture_type: int = FRONT_COVER,
+                   description: str = '') -> bytes:
+    """
+    Encode the body of a PICTURE block holding the image `data`.
+    """
+    info = probe_image(data)
+    mime = info.mime.encode('ascii')
+    desc = description.encode('utf-8')
+    body = b''.join([struct.pack('>II', picture_type, len(mime)), mime,
+                     struct.pack('>I', len(desc)), desc,
+                     struct.pack('>IIIII', info.width, info.height,
+                                 info.depth, info.colors, len(data)),
+                     data])
+    if len(body) > MAX_BLOCK_LENGTH:
+        raise PictureFormatError("Image is too large for a PICTURE block")
+
+    return body
+
+
+class PictureCache:
+    """
+    Encoded PICTURE blocks, keyed by the SHA-256 of the image they hold, so
+    that an image is read and encoded once however many files it is written
+    to, and copies of an image at different paths share one block. Paths are
+    mapped to their image's hash by their size and modification time.
+
+    The least recently used blocks are evicted once the blocks take more
+    than `max_size` bytes, the most recently used block is always kept.
+    """
+
+    max_size: int
+    blocks: 'OrderedDict[str, bytes]'
+    digests: Dict[Tuple[str, int, int], str]
+    size: int
+
+    def __init__(self, max_size: int = PICTURE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.blocks = OrderedDict()
+        self.digests = {}
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def _lookup(self, digest: Optional[str]) -> Optional[bytes]:
+        block = self.blocks.get(digest) if digest is not None else None
+        if block is not None:
+            self.blocks.move_to_end(digest)
+            STATS.count('picture_cache_hits')
+
+        return block
+
+    def _store(self, digest: str, block: bytes):
+        if digest in self.blocks:
+            return
+
+        self.blocks[digest] = block
+        self.size += len(block)
+        while self.size > self.max_size and len(self.blocks) > 1:
+            evicted, old = self.blocks.popitem(last=False)
+            self.size -= len(old)
+            self.digests = {k: v for k, v in self.digests.items()
+                            if v != evicted}
+
+    def block(self, path: str) -> bytes:
+        """
+        The encoded PICTURE block for the image at `path`
+        """
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            block = self._lookup(self.digests.get(key))
+            if block is not None:
+                return block
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        STATS.count('bytes_read', len(data))
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            self.digests[key] = digest
+            block = self._lookup(digest)
+            if block is not None:
+                return block
+
+        block = encode_picture(data)
+        STATS.count('pictures_encoded')
+        with self._lock:
+            self._store(digest, block)
+
+        return block
+
+    def clear(self):
+        """
+        Forget every cached picture
+        """
+        with self._lock:
+            self.blocks.clear()
+            self.digests.clear()
+            self.size = 0
+
+
+# The pictures written in this run
+PICTURES = PictureCache()
+
+
+def requested_picture(data: Mapping[str, str]) -> Optional[bytes]:
+    """
+    The PICTURE block to write with `data`: None to leave the pictures of a
+    file as they are, empty to remove them, or else the block that replaces
+    them.
+    """
+    path = data.get(PICTURE_KEY)
+    if path is None:
+        return None
+    if path == '':
+        return b''
+
+    return PICTURES.block(path)
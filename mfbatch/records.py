@@ -0,0 +1,150 @@
+"""
+mfbatch records - Exporting and importing tags as JSON Lines or CSV records
+"""
+
+import csv
+import json
+import sys
+import tempfile
+from itertools import chain
+from typing import Dict, Iterable, Iterator, TextIO, Tuple
+
+FlacMetadata = Dict[str, str]
+Record = Tuple[str, FlacMetadata]
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+
+PATH_COLUMN = 'path'
+
+
+class RecordError(ValueError):
+    """
+    A record to import could not be read
+    """
+
+    def __init__(self, message: str, line: int) -> None:
+        super().__init__(f"line {line}: {message}")
+        self.line = line
+
+
+def write_jsonl(records: Iterable[Record], output: TextIO):
+    """
+    Write each record as a JSON object with the keys "path" and "tags", one
+    per line
+    """
+    for path, tags in records:
+        output.write(json.dumps({PATH_COLUMN: path, 'tags': tags},
+                                ensure_ascii=False) + '\n')
+
+
+def write_csv(records: Iterable[Record], output: TextIO):
+    """
+    Write the records as CSV, with a "path" column followed by a column for
+    every tag key, in the order they're first seen. A file without a tag has
+    an empty cell.
+
+    Columns can only be known once every record has been seen, so the records
+    are spooled to a temporary file first, keeping memory use flat.
+    """
+    keys: Dict[str, None] = {}
+    with tempfile.TemporaryFile(mode='w+', encoding='utf-8') as spool:
+        for path, tags in records:
+            keys.update(dict.fromkeys(tags))
+            spool.write(json.dumps([path, tags], ensure_ascii=False) + '\n')
+
+        spool.seek(0)
+        writer = csv.writer(output)
+        writer.writerow([PATH_COLUMN] + list(keys))
+        for line in spool:
+            path, tags = json.loads(line)
+            writer.writerow([path] + [tags.get(k, '') for k in keys])
+
+
+def write_records(records: Iterable[Record], output: TextIO, fmt: str):
+    """
+    Write records of (path, tags) to `output` in `fmt`, one of
+    `EXPORT_FORMATS`
+    """
+    if fmt == 'csv':
+        write_csv(records, output)
+    else:
+        write_jsonl(records, output)
+
+
+def _jsonl_records(lines: Iterable[Tuple[int, str]]) -> Iterator[
+        Tuple[int, Record]]:
+    for lineno, line in lines:
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as exc:
+            raise RecordError(exc.msg, lineno) from exc
+
+        path = record.get(PATH_COLUMN) if isinstance(record, dict) else None
+        tags = record.get('tags', {}) if isinstance(record, dict) else None
+        if not isinstance(path, str) or not isinstance(tags, dict) or \
+                not all(isinstance(v, str) for v in tags.values()):
+            raise RecordError("expected an object with a \"path\" string and "
+                              "a \"tags\" object of strings", lineno)
+
+        yield lineno, (path, tags)
+
+
+def _csv_records(lines: Iterable[Tuple[int, str]]) -> Iterator[
+        Tuple[int, Record]]:
+    last = 0
+
+    def text() -> Iterator[str]:
+        nonlocal last
+        for lineno, line in lines:
+            last = lineno
+            yield line
+
+    reader = csv.reader(text())
+    header = next(reader, None)
+    if not header or header[0] != PATH_COLUMN:
+        raise RecordError(f"the first column must be \"{PATH_COLUMN}\"", 1)
+
+    end = last
+    for row in reader:
+        # A quoted cell can span lines, a record begins after the last one
+        first, end = end + 1, last
+        if not row:
+            continue
+        if len(row) > len(header):
+            raise RecordError("more cells than columns", first)
+
+        yield first, (row[0], {k: v for k, v in zip(header[1:],
+                                                    row[1:]) if v})
+
+
+def _read_records(f: TextIO) -> Iterator[Tuple[int, Record]]:
+    lines = enumerate(f, 1)
+    first = next(lines, None)
+    if first is None:
+        return
+
+    lines = chain([first], lines)
+    if first[1].lstrip().startswith('{'):
+        yield from _jsonl_records(lines)
+    else:
+        yield from _csv_records(lines)
+
+
+def read_records(path: str) -> Iterator[Tuple[int, Record]]:
+    """
+    Read records written by `write_records()` from the file at `path`, or
+    stdin if `path` is '-', as they are needed. The format is recognized from
+    the first line. Empty CSV cells are read as tags the file doesn't have.
+
+    :returns: The line number and (path, tags) of each record.
+    :raises RecordError: when a malformed record is reached.
+    """
+    if path == '-':
+        yield from _read_records(sys.stdin)
+        return
+
+    with open(path, mode='r', encoding='utf-8', newline='') as f:
+        yield from _read_records(f)
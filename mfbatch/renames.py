@@ -0,0 +1,204 @@
+"""
+mfbatch renames - Planning and performing the renames of a batchfile
+"""
+
+import os
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from mfbatch.executor import WriteOperation
+from mfbatch.stats import STATS
+
+TEMP_PREFIX = '.mfbatch-rename-'
+
+
+class RenamePlanError(Exception):
+    """
+    The renames of a batchfile can't all be performed
+    """
+
+    def __init__(self, problems: List[str]) -> None:
+        super().__init__('\n'.join(problems))
+        self.problems = problems
+
+
+class Rename(NamedTuple):
+    """
+    A file to rename, by absolute path, and the operation that renames it
+    """
+    source: str
+    target: str
+    op: WriteOperation
+
+
+class RenameStep(NamedTuple):
+    """
+    One call to `os.rename()`. The final step of a rename has its `rename`,
+    a step that only moves a file out of the way has none.
+    """
+    source: str
+    target: str
+    rename: Optional[Rename]
+
+
+class DirectoryListings:
+    """
+    The names in each directory, listed with one `os.scandir()` the first
+    time they're needed, so that finding whether a file exists doesn't take
+    a round trip to the filesystem for every file.
+    """
+
+    listings: Dict[str, Set[str]]
+
+    def __init__(self) -> None:
+        self.listings = {}
+
+    def names(self, dirname: str) -> Set[str]:
+        """
+        The names of the entries of `dirname`, or none if it can't be listed
+        """
+        names = self.listings.get(dirname)
+        if names is None:
+            try:
+                with os.scandir(dirname) as entries:
+                    names = {entry.name for entry in entries}
+            except OSError:
+                names = set()
+            STATS.count('directories_listed')
+            self.listings[dirname] = names
+
+        return names
+
+    def exists(self, path: str) -> bool:
+        """
+        True if there is a file at the absolute `path`
+        """
+        dirname, basename = os.path.split(path)
+        return basename in self.names(dirname)
+
+
+def rename_of(op: WriteOperation) -> Optional[Rename]:
+    """
+    The rename performed by `op`, if it renames its file to a new name
+    """
+    if op.new_basename is None:
+        return None
+
+    source = os.path.abspath(op.path)
+    target = os.path.join(os.path.dirname(source), op.new_basename)
+    return Rename(source, target, op) if target != source else None
+
+
+def plan_renames(ops: Iterable[WriteOperation],
+                 listings: Optional[DirectoryListings] = None
+                 ) -> List[Rename]:
+    """
+    Collect the renames of `ops` and check that they can all be performed:
+    that no two files are renamed to the same name, no file is renamed
+    twice, and no file is renamed to the name of a file that exists and isn't
+    renamed itself. Files renamed to each other's names, in swaps or
+    rotations, are allowed.
+
+    :raises RenamePlanError: with every problem found.
+    """
+    listings = listings if listings is not None else DirectoryListings()
+    renames: List[Rename] = []
+    problems = []
+    sources: Dict[str, Rename] = {}
+    targets: Dict[str, Rename] = {}
+    for op in ops:
+        rename = rename_of(op)
+        if rename is None:
+            continue
+
+        if rename.source in sources:
+            problems.append(f"line {op.line}: {op.path} is already renamed "
+                            f"on line {sources[rename.source].op.line}")
+        elif rename.target in targets:
+            problems.append(f"line {op.line}: {op.path} would be renamed to "
+                            f"{rename.target}, like the file on line "
+                            f"{targets[rename.target].op.line}")
+        else:
+            sources[rename.source] = rename
+            targets[rename.target] = rename
+            renames.append(rename)
+
+    for rename in renames:
+        if rename.target not in sources and listings.exists(rename.target):
+            problems.append(f"line {rename.op.line}: {rename.op.path} can't "
+                            f"be renamed, {rename.target} already exists")
+
+    if problems:
+        raise RenamePlanError(problems)
+
+    return renames
+
+
+def _temporary_name(source: str, listings: DirectoryListings) -> str:
+    dirname = os.path.dirname(source)
+    names = listings.names(dirname)
+    n = 0
+    while f"{TEMP_PREFIX}{n}" in names:
+        n += 1
+
+    names.add(f"{TEMP_PREFIX}{n}")
+    return os.path.join(dirname, f"{TEMP_PREFIX}{n}")
+
+
+def blocked_renames(renames: List[Rename], staying: Set[str]
+                    ) -> List[Rename]:
+    """
+    The renames that can't be performed because their target is one of the
+    `staying` files, planned to be renamed but not being renamed after all,
+    or the source of another blocked rename.
+    """
+    staying = set(staying)
+    blocked: List[Rename] = []
+    remaining = renames
+    while True:
+        found = [r for r in remaining if r.target in staying]
+        if not found:
+            return blocked
+
+        blocked.extend(found)
+        staying.update(r.source for r in found)
+        remaining = [r for r in remaining if r.source not in staying]
+
+
+def rename_steps(renames: List[Rename],
+                 listings: Optional[DirectoryListings] = None
+                 ) -> List[RenameStep]:
+    """
+    Order `renames`, which must have distinct sources and targets, so that
+    no file is renamed over one that is still to be renamed. A file renamed
+    to the name of another is renamed once the other is out of the way,
+    and a cycle of renames is broken by first moving one file to a
+    temporary name.
+    """
+    listings = listings if listings is not None else DirectoryListings()
+    by_target = {r.target: r for r in renames}
+    sources = {r.source for r in renames}
+    done: Set[str] = set()
+    steps: List[RenameStep] = []
+
+    def follow(rename: Optional[Rename], stop: Optional[Rename] = None):
+        while rename is not None and rename is not stop and \
+                rename.source not in done:
+            steps.append(RenameStep(rename.source, rename.target, rename))
+            done.add(rename.source)
+            rename = by_target.get(rename.source)
+
+    for rename in renames:
+        if rename.target not in sources:
+            follow(rename)
+
+    for rename in renames:
+        if rename.source in done:
+            continue
+
+        temp = _temporary_name(rename.source, listings)
+        steps.append(RenameStep(rename.source, temp, None))
+        done.add(rename.source)
+        follow(by_target[rename.source], stop=rename)
+        steps.append(RenameStep(temp, rename.target, rename))
+
+    return steps
@@ -0,0 +1,195 @@
+"""
+mfbatch report - Reporting the files of a run made without prompts
+"""
+
+import json
+import sys
+from typing import Dict, List, Optional, TextIO
+
+from tqdm import tqdm
+
+from mfbatch.executor import WriteOperation
+
+REPORT_MODES = ('full', 'summary', 'jsonl')
+
+# Text written to a `BufferedOutput` is passed on in batches of this size
+OUTPUT_BUFFER_SIZE = 64 * 1024
+
+WRITTEN = 'written'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+APPLIED = 'applied'
+WOULD_WRITE = 'would_write'
+WOULD_SKIP = 'would_skip'
+RENAMED = 'renamed'
+RENAME_FAILED = 'rename_failed'
+
+
+class BufferedOutput:
+    """
+    Collects the text written to it and writes it on to `stream` once there
+    are at least `size` characters, so a run that reports many files makes
+    few writes to a pipe or terminal. `flush()` must be called when the run
+    ends.
+    """
+
+    stream: TextIO
+    size: int
+    pending: List[str]
+    length: int
+
+    def __init__(self, stream: TextIO, size: int = OUTPUT_BUFFER_SIZE) -> None:
+        self.stream = stream
+        self.size = size
+        self.pending = []
+        self.length = 0
+
+    def write(self, s: str) -> int:
+        """
+        Write `s` to the stream, once enough text is waiting
+        """
+        self.pending.append(s)
+        self.length += len(s)
+        if self.length >= self.size:
+            self.flush()
+
+        return len(s)
+
+    def flush(self):
+        """
+        Write all waiting text to the stream and flush it
+        """
+        if self.pending:
+            self.stream.write(''.join(self.pending))
+            self.pending = []
+            self.length = 0
+
+        self.stream.flush()
+
+
+class Report:
+    """
+    Reports the outcome of each file of a run instead of displaying its
+    metadata. Outcomes are counted, and `finish()` prints the counts when the
+    run ends.
+    """
+
+    stream: BufferedOutput
+    dry_run: bool
+    counts: Dict[str, int]
+
+    def __init__(self, stream: TextIO, dry_run: bool) -> None:
+        self.stream = BufferedOutput(stream)
+        self.dry_run = dry_run
+        self.counts = dict.fromkeys([WRITTEN, SKIPPED, FAILED, APPLIED,
+                                     WOULD_WRITE, WOULD_SKIP, RENAMED,
+                                     RENAME_FAILED], 0)
+
+    def file(self, op: WriteOperation, outcome: str,
+             error: Optional[BaseException] = None,
+             new_path: Optional[str] = None):
+        # pylint: disable=unused-argument
+        """
+        Report that `op` was `outcome`, one of `WRITTEN`, `SKIPPED`, `FAILED`,
+        `APPLIED` by an earlier run, or in a dry run `WOULD_WRITE` or
+        `WOULD_SKIP`. A file renamed after all files have been written is
+        reported again, as `RENAMED` or `RENAME_FAILED`.
+
+        :param error: Why the file failed
+        :param new_path: Where the file was renamed to, if it was
+        """
+        self.counts[outcome] += 1
+
+    def summary(self) -> str:
+        """
+        A line counting the files of the run
+        """
+        if self.dry_run:
+            return (f"{self.counts[WOULD_WRITE]} files would be written, "
+                    f"{self.counts[WOULD_SKIP]} skipped\n")
+
+        renamed = ''
+        if self.counts[RENAMED] or self.counts[RENAME_FAILED]:
+            renamed = (f", {self.counts[RENAMED]} renamed, "
+                       f"{self.counts[RENAME_FAILED]} not renamed")
+
+        return (f"{self.counts[WRITTEN]} files written, "
+                f"{self.counts[SKIPPED] + self.counts[APPLIED]} skipped, "
+                f"{self.counts[FAILED]} failed{renamed}\n")
+
+    def finish(self):
+        """
+        Print the counts and flush everything reported
+        """
+        self.stream.write(self.summary())
+        self.stream.flush()
+
+
+class SummaryReport(Report):
+    """
+    Shows the progress of the run, and only the files that failed, on stderr
+    """
+
+    progress: tqdm
+
+    def __init__(self, stream: TextIO, dry_run: bool,
+                 total: Optional[int] = None) -> None:
+        super().__init__(stream, dry_run)
+        self.progress = tqdm(total=total, unit='File',
+                             desc='Checking...' if dry_run else 'Writing...')
+
+    def file(self, op: WriteOperation, outcome: str,
+             error: Optional[BaseException] = None,
+             new_path: Optional[str] = None):
+        super().file(op, outcome, error, new_path)
+        if outcome in (FAILED, RENAME_FAILED):
+            tqdm.write(f"{op.path}: Failed! {error}", file=sys.stderr)
+
+        if outcome not in (RENAMED, RENAME_FAILED):
+            self.progress.update()
+
+    def finish(self):
+        self.progress.close()
+        super().finish()
+
+
+class JsonlReport(Report):
+    """
+    Writes a JSON object for each file, with its "path", batchfile "line" and
+    "outcome", and the "error" of a file that failed. A file that was renamed
+    has a "new_path". The counts are printed on stderr, so that the report
+    can be piped.
+    """
+
+    def file(self, op: WriteOperation, outcome: str,
+             error: Optional[BaseException] = None,
+             new_path: Optional[str] = None):
+        super().file(op, outcome, error, new_path)
+        record: Dict[str, object] = {'path': op.path, 'line': op.line,
+                                     'outcome': outcome}
+        if error is not None:
+            record['error'] = str(error)
+        if new_path is not None:
+            record['new_path'] = new_path
+
+        self.stream.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def finish(self):
+        self.stream.flush()
+        sys.stderr.write(self.summary())
+
+
+def make_report(mode: str, stream: TextIO, dry_run: bool,
+                total: Optional[int] = None) -> Optional[Report]:
+    """
+    The report for `mode`, one of `REPORT_MODES`, written to `stream`, or None
+    for 'full', where each file's metadata is displayed instead.
+
+    :param total: Number of files in the run, for the progress bar
+    """
+    if mode == 'summary':
+        return SummaryReport(stream, dry_run, total)
+    if mode == 'jsonl':
+        return JsonlReport(stream, dry_run)
+
+    return None
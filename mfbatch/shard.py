@@ -0,0 +1,161 @@
+"""
+mfbatch shard - Splitting a batchfile into batchfiles that run independently
+"""
+
+import bisect
+import shlex
+from typing import List, Optional, TextIO
+
+from mfbatch.commands import BatchfileParser, CommandEnv
+from mfbatch.executor import WriteOperation
+from mfbatch.renames import plan_renames, rename_of
+from mfbatch.stats import STATS
+from mfbatch.util import readline_with_escaped_newlines
+
+SHARD_SUFFIX = '.shard'
+
+
+def env_commands(env: CommandEnv) -> List[str]:
+    """
+    Batchfile commands that give a new environment the state of `env`
+    between two files: every key with its value, in the same order, and the
+    `setinc` counters and `setp` patterns that set them for the next file.
+    """
+    commands = []
+    for key, value in env.metadatums.items():
+        fmt = env.incr.get(key)
+        setting = f":set {shlex.quote(key)} {shlex.quote(value)}"
+        if fmt is None:
+            commands.append(setting)
+            continue
+
+        try:
+            start: Optional[int] = int(value)
+        except ValueError:
+            start = None
+        exact = start is not None and fmt % start == value
+        commands.append(f":setinc {shlex.quote(key)} {start if exact else 0} "
+                        f"{shlex.quote(fmt)}")
+        if not exact:
+            commands.append(setting)
+
+    for to_key, (from_key, pattern, repl) in env.patterns.items():
+        commands.append(f":setp {shlex.quote(to_key)} "
+                        f"{shlex.quote(from_key)} "
+                        f"{shlex.quote(pattern.pattern)} {shlex.quote(repl)}")
+
+    return commands
+
+
+def _allowed_boundaries(plan: List[WriteOperation]) -> List[int]:
+    """
+    The places `plan` can be split, by the number of files before each. A
+    file renamed to the name of another file that is renamed is kept in the
+    same shard as it, so that each shard can order its renames.
+    """
+    sources = {}
+    renames = []
+    for i, op in enumerate(plan):
+        rename = rename_of(op)
+        if rename is not None:
+            sources[rename.source] = i
+            renames.append((i, rename.target))
+
+    # spanned[b] counts the linked renames on both sides of boundary b
+    spanned = [0] * (len(plan) + 1)
+    for i, target in renames:
+        j = sources.get(target)
+        if j is not None and i != j:
+            spanned[min(i, j) + 1] += 1
+            spanned[max(i, j) + 1] -= 1
+
+    allowed = []
+    depth = 0
+    for b in range(1, len(plan)):
+        depth += spanned[b]
+        if depth == 0:
+            allowed.append(b)
+
+    return allowed
+
+
+def shard_boundaries(plan: List[WriteOperation], count: int) -> List[int]:
+    """
+    Where to split `plan` into at most `count` shards of about the same
+    number of files, as the number of files before each shard after the
+    first. Files that are renamed to each other's names are never split.
+    """
+    allowed = _allowed_boundaries(plan)
+    boundaries: List[int] = []
+    for k in range(1, count):
+        least = boundaries[-1] + 1 if boundaries else 1
+        at = bisect.bisect_left(allowed, max(k * len(plan) // count, least))
+        if at == len(allowed):
+            break
+        boundaries.append(allowed[at])
+
+    return boundaries
+
+
+def _open_shard(path: str, n: int, count: int, env: CommandEnv) -> TextIO:
+    # pylint: disable=consider-using-with
+    f = open(path, mode='w', encoding='utf-8')
+    f.write(f"# Shard {n} of {count}\n")
+    for command in env_commands(env):
+        f.write(command + "\n")
+    f.write("\n")
+    return f
+
+
+def shard_batch_list(batch_list_path: str, count: int) -> List[str]:
+    """
+    Split a batch list into at most `count` batch lists, written next to it
+    with `SHARD_SUFFIX` and a number, that can be written independently, on
+    different hosts or at the same time, with the same result as writing the
+    batch list. Each shard begins with the commands that set up the
+    environment as it is before its first file, followed by the lines of the
+    batch list for its files.
+
+    The batch list is validated, and its renames checked, before any shard is
+    written.
+
+    :returns: The paths of the shards.
+    :raises RenamePlanError: if the renames can't all be performed.
+    """
+    with open(batch_list_path, mode='r', encoding='utf-8') as f:
+        with STATS.phase('compile'):
+            plan = BatchfileParser().compile(readline_with_escaped_newlines(f))
+
+        plan_renames(plan)
+        boundaries = shard_boundaries(plan, count)
+        count = len(boundaries) + 1
+        width = len(str(count))
+        paths = [f"{batch_list_path}{SHARD_SUFFIX}{n:0{width}d}"
+                 for n in range(1, count + 1)]
+
+        f.seek(0)
+        parser = BatchfileParser()
+        parser.plan = []
+        files = 0
+        with STATS.phase('shard'):
+            out = _open_shard(paths[0], 1, count, parser.env)
+            try:
+                for line, lineno in readline_with_escaped_newlines(f):
+                    out.write(line + "\n")
+                    if len(line) == 0:
+                        continue
+
+                    parser.eval(line, lineno, interactive=False)
+                    if parser.plan:
+                        files += len(parser.plan)
+                        parser.plan.clear()
+                        if boundaries and files == boundaries[0]:
+                            boundaries.pop(0)
+                            out.close()
+                            n = count - len(boundaries)
+                            out = _open_shard(paths[n - 1], n, count,
+                                              parser.env)
+            finally:
+                out.close()
+
+    return paths
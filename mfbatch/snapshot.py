@@ -0,0 +1,109 @@
+"""
+mfbatch snapshot - Persistent snapshots of the keys written to each file
+"""
+
+import sys
+from collections.abc import Mapping
+from itertools import compress
+from operator import ne
+from typing import Dict, Iterator
+
+
+# Marks a key of the base that a snapshot doesn't have
+ABSENT = object()
+
+_NO_CHANGES: Dict[str, object] = {}
+
+
+class Snapshot(Mapping):
+    """
+    An immutable mapping of the keys written to one file. Snapshots of
+    consecutive files share a `base` mapping, and each records only the
+    `changes` from it: keys whose values differ, and keys it doesn't have,
+    marked `ABSENT`. When a snapshot would differ from its base in more than
+    half of the keys, it starts a new base instead.
+
+    The keys of a base are interned, and snapshots have no `__dict__`, so a
+    plan can hold one for each of millions of files. Snapshots iterate in the
+    same order as the dictionary they were made from.
+    """
+
+    __slots__ = ('base', 'changes', 'length')
+
+    base: Dict[str, str]
+    changes: Dict[str, object]
+    length: int
+
+    def __init__(self, base: Dict[str, str],
+                 changes: Dict[str, object],
+                 length: int) -> None:
+        self.base = base
+        self.changes = changes
+        self.length = length
+
+    @classmethod
+    def of(cls, metadatums: Dict[str, str]) -> 'Snapshot':
+        """
+        A snapshot of `metadatums` that is its own base
+        """
+        base = {sys.intern(k): v for k, v in metadatums.items()}
+        return cls(base, _NO_CHANGES, len(base))
+
+    def derive(self, metadatums: Dict[str, str]) -> 'Snapshot':
+        """
+        A snapshot of `metadatums` sharing the base of this snapshot. If
+        nothing has changed since this snapshot it is returned itself.
+        """
+        base = self.base
+        changes: Dict[str, object] = {
+            k: metadatums[k] for k in compress(
+                metadatums, map(ne, metadatums.values(),
+                                map(base.get, metadatums)))}
+        added = [k for k in changes if k not in base]
+        kept = len(metadatums) - len(added)
+        if kept < len(base):
+            changes.update({k: ABSENT for k in base if k not in metadatums})
+
+        if 2 * len(changes) > len(base):
+            return Snapshot.of(metadatums)
+
+        order = list(base) if kept == len(base) else \
+            [k for k in base if k in metadatums]
+        if list(metadatums) != order + added:
+            return Snapshot.of(metadatums)
+
+        if changes == self.changes:
+            return self
+
+        return Snapshot(base, changes or _NO_CHANGES, len(metadatums))
+
+    def __getitem__(self, key: str) -> str:
+        value = self.changes.get(key, None)
+        if value is None:
+            return self.base[key]
+        if value is ABSENT:
+            raise KeyError(key)
+
+        return str(value)
+
+    def __iter__(self) -> Iterator[str]:
+        changes = self.changes
+        for key in self.base:
+            if changes.get(key) is not ABSENT:
+                yield key
+
+        for key in changes:
+            if key not in self.base:
+                yield key
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __repr__(self) -> str:
+        return f"Snapshot({dict(self)!r})"
+
+    def __copy__(self) -> 'Snapshot':
+        return self
+
+    def __deepcopy__(self, memo) -> 'Snapshot':
+        return self
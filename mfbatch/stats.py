@@ -0,0 +1,200 @@
+"""
+mfbatch stats - Instrumentation of where a run spends its time
+"""
+
+import cProfile
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Dict, Iterator, List, Optional, TextIO
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: List[float], pct: int) -> float:
+    """
+    The nearest-rank percentile of sorted `values`
+    """
+    if not values:
+        return 0.0
+
+    rank = max(1, -(-len(values) * pct // 100))
+    return values[min(rank, len(values)) - 1]
+
+
+def _cpu_time() -> float:
+    """
+    CPU time of this process and of any subprocesses that have exited
+    """
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Stats:
+    """
+    Records the wall and CPU time spent in each phase of a run, counters such
+    as the number of subprocesses started and bytes read and written, and
+    the latency of each file read and written.
+
+    Phases may run on several threads at once, so the times of a phase are
+    cumulative and CPU times are for the whole process. A disabled `Stats`
+    records nothing.
+
+    If `profile_phase` names a phase, the first time that phase is entered it
+    runs under `cProfile`.
+    """
+
+    enabled: bool
+    phases: Dict[str, List[float]]
+    counters: Dict[str, int]
+    latencies: Dict[str, List[float]]
+    profile_phase: Optional[str]
+    profile: Optional[cProfile.Profile]
+
+    def __init__(self, enabled: bool = False,
+                 profile_phase: Optional[str] = None) -> None:
+        self.enabled = enabled
+        self.phases = {}
+        self.counters = {}
+        self.latencies = {}
+        self.profile_phase = profile_phase
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def phase(self, name: str) -> ContextManager:
+        """
+        A context manager that adds the time spent in it to the phase `name`
+        """
+        if not self.enabled:
+            return nullcontext()
+
+        return self._timed_phase(name)
+
+    def _start_profile(self, name: str) -> Optional[cProfile.Profile]:
+        with self._lock:
+            if name != self.profile_phase or self.profile is not None:
+                return None
+
+            self.profile = cProfile.Profile()
+            return self.profile
+
+    @contextmanager
+    def _timed_phase(self, name: str) -> Iterator[None]:
+        profile = self._start_profile(name)
+        start, start_cpu = time.perf_counter(), _cpu_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                with self._lock:
+                    self.profile_phase = None
+
+            wall = time.perf_counter() - start
+            cpu = _cpu_time() - start_cpu
+            with self._lock:
+                entry = self.phases.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+
+    def count(self, name: str, n: int = 1):
+        """
+        Add `n` to the counter `name`
+        """
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def latency(self, name: str, seconds: float):
+        """
+        Record the time taken for one file in the series `name`
+        """
+        if self.enabled:
+            with self._lock:
+                self.latencies.setdefault(name, []).append(seconds)
+
+    def report(self) -> dict:
+        """
+        Everything recorded, as a dictionary that can be encoded as JSON
+        """
+        with self._lock:
+            latencies = {}
+            for name, values in self.latencies.items():
+                values = sorted(values)
+                latencies[name] = {'count': len(values),
+                                   'max_ms': values[-1] * 1000}
+                for pct in PERCENTILES:
+                    latencies[name][f"p{pct}_ms"] = \
+                        percentile(values, pct) * 1000
+
+            return {'phases': {name: {'calls': calls, 'wall_seconds': wall,
+                                      'cpu_seconds': cpu}
+                               for name, (calls, wall, cpu) in
+                               self.phases.items()},
+                    'counters': dict(self.counters),
+                    'latency': latencies}
+
+    def print_summary(self, stream: TextIO):
+        """
+        Print a summary of the report
+        """
+        report = self.report()
+        stream.write(f"\n{'phase':<16}{'calls':>8}{'wall s':>10}"
+                     f"{'cpu s':>10}\n")
+        for name, phase in report['phases'].items():
+            stream.write(f"{name:<16}{phase['calls']:>8}"
+                         f"{phase['wall_seconds']:>10.3f}"
+                         f"{phase['cpu_seconds']:>10.3f}\n")
+
+        for name, value in sorted(report['counters'].items()):
+            stream.write(f"{name}: {value}\n")
+
+        for name, series in report['latency'].items():
+            stream.write(f"{name} latency ({series['count']} files): " +
+                         ', '.join(f"p{pct} {series[f'p{pct}_ms']:.2f} ms"
+                                   for pct in PERCENTILES) +
+                         f", max {series['max_ms']:.2f} ms\n")
+
+    def print_profile(self, stream: TextIO, limit: int = 25):
+        """
+        Print the functions that took the most time in the profiled phase
+        """
+        if self.profile is not None:
+            pstats.Stats(self.profile, stream=stream) \
+                .sort_stats('cumulative').print_stats(limit)
+
+
+class TimedStream:
+    """
+    Wraps a text stream, adding the time spent writing to it to the phase
+    `name`.
+    """
+
+    def __init__(self, stream: TextIO, stats: Stats,
+                 name: str = 'output') -> None:
+        self.stream = stream
+        self.stats = stats
+        self.name = name
+
+    def write(self, s: str) -> int:
+        """
+        Write `s` to the stream
+        """
+        with self.stats.phase(self.name):
+            return self.stream.write(s)
+
+    def flush(self):
+        """
+        Flush the stream
+        """
+        with self.stats.phase(self.name):
+            self.stream.flush()
+
+
+# The statistics of this run, recorded only once enabled
+STATS = Stats()
@@ -2,6 +2,13 @@
 mfbatch util - utility functions
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
 
 def readline_with_escaped_newlines(f):
     """
@@ -25,3 +32,30 @@ def readline_with_escaped_newlines(f):
 
         yield line, line_no
         line = ''
+
+
+def ordered_map(func: Callable[[T], R], iterable: Iterable[T], jobs: int = 1,
+                window: int = 0) -> Iterator[R]:
+    """
+    Like `map()`, but `func` is called on a pool of `jobs` threads. Results
+    are yielded in the order of `iterable`, and no more than `window` calls
+    (by default four per job) are pending at any time.
+    """
+    if jobs <= 1:
+        yield from map(func, iterable)
+        return
+
+    window = window or jobs * 4
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending: Deque = deque()
+        try:
+            for item in iterable:
+                pending.append(pool.submit(func, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
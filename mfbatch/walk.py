@@ -0,0 +1,155 @@
+"""
+mfbatch walk - Find FLAC files in a directory tree
+"""
+
+import os
+from fnmatch import fnmatch
+from typing import FrozenSet, List, NamedTuple, Optional, Sequence, Set, \
+    Tuple, Union
+
+from mfbatch.util import ordered_map
+
+
+class FileRecord(NamedTuple):
+    """
+    The path of a file and, if it is known, its status
+    """
+    path: str
+    stat: Optional[os.stat_result] = None
+
+
+def file_record(f: Union[str, FileRecord]) -> FileRecord:
+    """
+    Return `f` as a `FileRecord`, if it is a path its status is not known.
+    """
+    if isinstance(f, FileRecord):
+        return f
+
+    return FileRecord(path=f)
+
+
+def file_stat(f: FileRecord) -> os.stat_result:
+    """
+    The status of `f`, which is only read from the file system if it isn't
+    already known.
+    """
+    return f.stat if f.stat is not None else os.stat(f.path)
+
+
+class WalkOptions(NamedTuple):
+    """
+    Options for `walk_flac_files()`
+
+    :param follow_symlinks: Descend into symbolic links to directories, and
+        include symbolic links to files.
+    :param ignore_case: Match the ".flac" extension case-insensitively.
+    :param exclude: Glob patterns of files and directories to skip, matched
+        against each name and its path relative to the root.
+    """
+    follow_symlinks: bool = True
+    ignore_case: bool = False
+    exclude: Sequence[str] = ()
+
+
+def _excluded(name: str, relpath: str, options: WalkOptions) -> bool:
+    return any(fnmatch(name, pattern) or fnmatch(relpath, pattern)
+               for pattern in options.exclude)
+
+
+def _is_flac(name: str, options: WalkOptions) -> bool:
+    if options.ignore_case:
+        return name.lower().endswith('.flac')
+
+    return name.endswith('.flac')
+
+
+DirectoryId = Tuple[int, int]
+
+# A directory to scan: its path, its path relative to the root, and the ids
+# of the directory and all of its ancestors
+Directory = Tuple[str, str, FrozenSet[DirectoryId]]
+
+
+def _directory_id(st: os.stat_result) -> DirectoryId:
+    return st.st_dev, st.st_ino
+
+
+def _scan(path: str, relpath: str, ancestors: FrozenSet[DirectoryId],
+          options: WalkOptions, visited: Set[DirectoryId]
+          ) -> Tuple[List[FileRecord], List[Directory]]:
+    """
+    Scan one directory, returning the FLAC files in it and its
+    subdirectories. A subdirectory that is one of its `ancestors`, through a
+    symbolic link, or was already `visited`, is skipped.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        return files, subdirs
+
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+
+        entry_relpath = os.path.join(relpath, entry.name) if relpath \
+            else entry.name
+        if _excluded(entry.name, entry_relpath, options):
+            continue
+
+        try:
+            if entry.is_dir(follow_symlinks=options.follow_symlinks):
+                dir_id = _directory_id(
+                    entry.stat(follow_symlinks=options.follow_symlinks))
+                if dir_id not in ancestors and dir_id not in visited:
+                    visited.add(dir_id)
+                    subdirs.append((entry.path, entry_relpath,
+                                    ancestors | {dir_id}))
+            elif _is_flac(entry.name, options) and \
+                    entry.is_file(follow_symlinks=options.follow_symlinks):
+                files.append(FileRecord(
+                    path=entry.path,
+                    stat=entry.stat(follow_symlinks=options.follow_symlinks)))
+        except OSError:
+            continue
+
+    return files, subdirs
+
+
+def _walk_subtree(top: Directory, options: WalkOptions) -> List[FileRecord]:
+    records = []
+    visited = set(top[2])
+    stack = [top]
+    while stack:
+        files, subdirs = _scan(*stack.pop(), options, visited)
+        records.extend(files)
+        stack.extend(reversed(subdirs))
+
+    return records
+
+
+def walk_flac_files(root: str = '.', options: WalkOptions = WalkOptions(),
+                    jobs: int = 1) -> List[FileRecord]:
+    """
+    Find all FLAC files in the directory tree at `root` with `os.scandir`,
+    along with the status of each, read once. Like `glob`, files and
+    directories whose names begin with a '.' are skipped.
+
+    Each directory's files are listed before its subdirectories. The
+    subtrees of `root` are walked on a pool of `jobs` threads. A symbolic
+    link to a directory is not followed if it leads back to one of its own
+    ancestors, or to a directory already walked in the same subtree.
+    """
+    try:
+        root_ids = frozenset([_directory_id(os.stat(root))])
+    except OSError:
+        return []
+
+    files, subdirs = _scan(root, '', root_ids, options, set(root_ids))
+    for subtree in ordered_map(lambda top: _walk_subtree(top, options),
+                               subdirs, jobs):
+        files.extend(subtree)
+
+    return files
@@ -1,10 +1,61 @@
 "mfbatch tests"
+# pylint: disable=too-many-lines
 
+import os.path
+import glob
+import json
+import shutil
+import struct
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from itertools import islice
+from io import StringIO
+from unittest.mock import MagicMock, patch
 from typing import cast
 
-from mfbatch.commands import BatchfileParser
+from mfbatch.commands import BatchfileParser, CommandArgumentError, \
+    UnrecognizedCommandError
+from mfbatch import metaflac, native
+from mfbatch.backend import Backend, BackendError, MetaflacBackend, \
+    NativeBackend, select_backend
+from mfbatch.__main__ import WriteOptions, create_batch_list, \
+    execute_batch_list, export_tags, import_records, main, scan_chunks
+from mfbatch.executor import WriteExecutor, WriteOperation, \
+    WriteResult, MetadataFunctions, metadata_unchanged, perform_write
+from mfbatch.cache import ScanCache
+from mfbatch.compact import BatchfileCompactor
+from mfbatch.durable import DIRECTORIES
+from mfbatch.journal import Journal, operation_hash
+from mfbatch.picture import PICTURE_KEY, PictureCache, \
+    PictureFormatError, probe_image
+from mfbatch.records import RecordError, read_records
+from mfbatch.renames import RenamePlanError, blocked_renames, \
+    plan_renames, rename_steps
+from mfbatch.report import JsonlReport
+from mfbatch.shard import shard_batch_list
+from mfbatch.stats import STATS, percentile
+from mfbatch.walk import FileRecord, WalkOptions, file_record, \
+    walk_flac_files
+from mfbatch.filelist import read_file_list, sort_key, sorted_flac_files
+from mfbatch.util import readline_with_escaped_newlines
+
+from benchmarks.corpus import CorpusSpec, generate_corpus
+from benchmarks.stub_metaflac import main as stub_metaflac_main
+
+TEST_AUDIO = os.path.join(os.path.dirname(__file__), '..', 'test_audio')
+
+
+def png_image(width: int = 2, height: int = 3) -> bytes:
+    "The headers of an RGB PNG image"
+    return b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + \
+        struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0) + bytes(4)
+
+
+def write_png(path: str, width: int = 2, height: int = 3) -> str:
+    "Write the headers of an RGB PNG image to `path`"
+    with open(path, 'wb') as f:
+        f.write(png_image(width, height))
+    return path
 
 
 class BatchfileParserTests(unittest.TestCase):
@@ -59,7 +110,1130 @@ class BatchfileParserTests(unittest.TestCase):
                               self.command_parser.write_metadata_f).call_args.args,
                          ("./testfile.flac", {'VAL': 'ABC123', 'DONE': 'XABC'}))
 
+    def test_setp_reuses_result(self):
+        "Test a pattern is only evaluated again when its input changes"
+        self.command_parser.set(['VAL', 'ABC123'])
+        self.command_parser.setp(['DONE', 'VAL', r"([A-Z]+)123", r"X\1"])
+        env = self.command_parser.env
+        env.evaluate_patterns()
+        first = env.pattern_results['DONE']
+        env.evaluate_patterns()
+        self.assertIs(env.pattern_results['DONE'], first)
+
+        self.command_parser.set(['VAL', 'DEF123'])
+        env.evaluate_patterns()
+        self.assertEqual(env.metadatums['DONE'], 'XDEF')
+
+    def test_snapshots(self):
+        "Test file snapshots share unchanged keys and match the environment"
+        common = {f"KEY{i}": str(i) for i in range(10)}
+        lines = [(f":set {k} {v}", 0) for k, v in common.items()] + [
+            (":setinc TRACKNUMBER 1", 1), ("./1.flac", 2),
+            (":set1 KEY0 X", 3), ("./2.flac", 4),
+            (":unset KEY1", 5), ("./3.flac", 6),
+            (":reset", 7), (":set GENRE E", 8), ("./4.flac", 9)]
+        plan = self.command_parser.compile(lines)
+        self.assertIs(plan[1].metadata.base, plan[0].metadata.base)
+        self.assertIs(plan[2].metadata.base, plan[0].metadata.base)
+        self.assertIsNot(plan[3].metadata.base, plan[0].metadata.base)
+
+        expected = [dict(common, TRACKNUMBER='1'),
+                    dict(common, KEY0='X', TRACKNUMBER='2'),
+                    dict(common, TRACKNUMBER='3'), {'GENRE': 'E'}]
+        del expected[2]['KEY1']
+        for op, metadata in zip(plan, expected):
+            self.assertEqual([(k, v) for k, v in op.metadata.items()
+                              if not k.startswith('_')],
+                             list(metadata.items()))
+        self.assertNotIn('KEY1', plan[2].metadata)
+        self.assertEqual(len(plan[2].metadata), len(expected[2]) + 3)
+
+    def test_command_table(self):
+        "Test only registered commands are dispatched, with their arity"
+        commands = BatchfileParser.commands()
+        self.assertEqual(commands['setinc'], (2, 3))
+        self.assertNotIn('eval', commands)
+        self.assertNotIn('compile', commands)
+
+        with self.assertRaises(UnrecognizedCommandError):
+            self.command_parser.eval(":compile x", lineno=1,
+                                     interactive=False)
+        with self.assertRaises(CommandArgumentError):
+            self.command_parser.eval(":set A 1 2", lineno=2,
+                                     interactive=False)
+
+    def _review(self, lines, answers):
+        self.command_parser.outstream = StringIO()
+        with patch('builtins.input', side_effect=answers) as prompt:
+            for lineno, line in enumerate(lines, 1):
+                self.command_parser.eval(line, lineno, interactive=True)
+            self.command_parser.finish_review()
+
+        written = [call.args for call in cast(
+            MagicMock, self.command_parser.write_metadata_f).call_args_list]
+        return prompt.call_count, written
+
+    def test_review_groups(self):
+        "Test files differing only in per-file keys are reviewed together"
+        prompts, written = self._review(
+            [":set ALBUM A", ":setinc TRACK 1", "./1.flac", "./2.flac",
+             "./3.flac", ":set1 DESCRIPTION X", "./4.flac", "./5.flac"],
+            ['', '', ''])
+        self.assertEqual(prompts, 3)
+        self.assertEqual([(path, metadata['TRACK']) for path, metadata in
+                          written],
+                         [('./1.flac', '1'), ('./2.flac', '2'),
+                          ('./3.flac', '3'), ('./4.flac', '4'),
+                          ('./5.flac', '5')])
+        self.assertIn("TRACK", self.command_parser.outstream.getvalue())
+
+    def test_review_group_command(self):
+        "Test a command at a group prompt applies to every file in it"
+        prompts, written = self._review(
+            [":setinc TRACK 1", "./1.flac", "./2.flac", ":set A B",
+             "./3.flac"],
+            [':set GENRE Rock', '', ''])
+        self.assertEqual(prompts, 3)
+        self.assertEqual([(metadata['TRACK'], metadata.get('GENRE'))
+                          for _, metadata in written],
+                         [('1', 'Rock'), ('2', 'Rock'), ('3', 'Rock')])
+        self.assertEqual(written[2][1]['A'], 'B')
+
+    def test_picture_command(self):
+        "Test picture and nopicture set the picture of subsequent files"
+        with tempfile.TemporaryDirectory() as tempdir:
+            cover = write_png(os.path.join(tempdir, 'cover.png'))
+            self.command_parser.eval(f":picture {cover}", lineno=1,
+                                     interactive=False)
+            self.assertEqual(self.command_parser.env.metadatums[PICTURE_KEY],
+                             cover)
+            self.command_parser.eval(":nopicture", lineno=2,
+                                     interactive=False)
+            self.assertEqual(self.command_parser.env.metadatums[PICTURE_KEY],
+                             '')
+
+            for line in (f":picture {tempdir}/missing.png",
+                         f":picture {__file__}"):
+                with self.assertRaises(CommandArgumentError):
+                    self.command_parser.eval(line, lineno=3,
+                                             interactive=False)
+
+    def test_skip_unchanged(self):
+        "Test a file is not written if its metadata would be unchanged"
+        self.command_parser.read_metadata_f = MagicMock(
+            return_value={'X': 'Y'})
+        self.command_parser.set(['X', 'Y'])
+        self.command_parser.eval("./testfile.flac", lineno=1,
+                                 interactive=False)
+        self.assertFalse(cast(MagicMock,
+                              self.command_parser.write_metadata_f).called)
+        self.assertEqual(self.command_parser.counts['skipped'], 1)
+
+    def test_compile(self):
+        "Test compiling a batchfile into a plan without writing"
+        plan = self.command_parser.compile([
+            (":set A 1", 1), (":setinc N 1", 2), ("./a.flac", 3),
+            (":rename c.flac", 4), ("./b.flac", 5)])
+        self.assertFalse(cast(MagicMock,
+                              self.command_parser.write_metadata_f).called)
+        self.assertEqual([(op.path, op.line, op.new_basename,
+                           op.metadata['N']) for op in plan],
+                         [('./a.flac', 3, None, '1'),
+                          ('./b.flac', 5, 'c.flac', '2')])
+
+    def test_compile_validates(self):
+        "Test compiling reports bad commands before anything is written"
+        for bad_command in (":set A", ":setp A B ( X", ":setp A B (a) '\\3'",
+                            ":setp A B (a) '\\g<x>'"):
+            with self.assertRaises(CommandArgumentError) as cm:
+                self.command_parser.compile([(":set B 1", 1), ("./a.flac", 2),
+                                             (bad_command, 3)])
+            self.assertEqual(cm.exception.line, 3)
+
+        for bad_command in (":setp X NOPE a b", ":set N abc"):
+            with self.assertRaises(CommandArgumentError) as cm:
+                BatchfileParser().compile([(":setinc N 1", 1),
+                                           ("./a.flac", 2), (bad_command, 3),
+                                           ("./b.flac", 4)])
+            self.assertEqual(cm.exception.line, 4)
+
+        self.assertFalse(cast(MagicMock,
+                              self.command_parser.write_metadata_f).called)
+
+    def test_jsonl_report(self):
+        "Test a report records each file's outcome instead of displaying it"
+        self.command_parser.outstream = StringIO()
+        self.command_parser.read_metadata_f = MagicMock(
+            return_value={'A': '1'})
+        cast(MagicMock, self.command_parser.write_metadata_f).side_effect = \
+            [OSError("disk full")]
+        output = StringIO()
+        self.command_parser.report = JsonlReport(output, dry_run=False)
+        plan = self.command_parser.compile([
+            (":set A 1", 1), ("./a.flac", 2), (":set A 2", 3),
+            ("./b.flac", 4)])
+        with patch('sys.stderr', new_callable=StringIO) as err:
+            self.command_parser.execute(plan)
+            self.command_parser.report.finish()
+
+        self.assertEqual([json.loads(line) for line in
+                          output.getvalue().splitlines()],
+                         [{'path': './a.flac', 'line': 2,
+                           'outcome': 'skipped'},
+                          {'path': './b.flac', 'line': 4, 'outcome': 'failed',
+                           'error': 'disk full'}])
+        self.assertEqual(err.getvalue(),
+                         "0 files written, 1 skipped, 1 failed\n")
+        self.assertEqual(self.command_parser.outstream.getvalue(), '')
+
     def test_eval(self):
         "Test eval"
         self.command_parser.eval(":set A 1", 1, False)
         self.assertEqual(self.command_parser.env.metadatums['A'], '1')
+
+
+class MetadataReadTests(unittest.TestCase):
+    """
+    Tests reading metadata from FLAC files
+    """
+
+    def test_native_read(self):
+        "Test reading comments with the native reader"
+        metadata = native.read_metadata(os.path.join(TEST_AUDIO,
+                                                     'tone1.flac'))
+        self.assertEqual(metadata, {
+            'ALBUM': 'Test Album 1',
+            'ARTIST': 'Jamie Hardt',
+            'DESCRIPTION': 'Tone file #1, test tone 440Hz'})
+
+    def test_native_read_not_flac(self):
+        "Test the native reader rejects files that aren't FLAC"
+        with self.assertRaises(native.FlacFormatError):
+            native.read_metadata(__file__)
+
+    def test_metaflac_batch(self):
+        "Test reading many files with one metaflac invocation"
+        paths = ['./a.flac', './b.flac', './c.flac']
+        listing = "\n".join([
+            "./a.flac:METADATA block #0",
+            "./a.flac:    comment[0]: TITLE=A",
+            "./b.flac:METADATA block #0",
+            "./c.flac:METADATA block #0",
+            "./c.flac:    comment[0]: TITLE=C: the title"])
+        result = MagicMock(stdout=listing.encode('utf-8'), returncode=0)
+        with patch('mfbatch.metaflac.run', return_value=result) as run:
+            metadata = metaflac.read_metadata_batch_metaflac(paths)
+
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(run.call_args.args[0][-3:], paths)
+        self.assertEqual(metadata, [{'TITLE': 'A'}, {},
+                                    {'TITLE': 'C: the title'}])
+
+    def test_command_chunks(self):
+        "Test splitting long command lines"
+        paths = [f"./{i:04}.flac" for i in range(2500)]
+        chunks = list(metaflac.command_chunks(['metaflac'], paths))
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(sum(chunks, []), paths)
+
+    def test_metaflac_fallback(self):
+        "Test falling back to metaflac, with more than ten comments"
+        listing = "\n".join(f"    comment[{i}]: KEY_{i}={i}"
+                            for i in range(12))
+        result = MagicMock(stdout=listing.encode('utf-8'))
+        with patch('mfbatch.metaflac.run', return_value=result) as run:
+            metadata = metaflac.read_metadata(__file__)
+
+        self.assertTrue(run.called)
+        self.assertEqual(len(metadata), 12)
+        self.assertEqual(metadata['KEY_11'], '11')
+
+    def test_select_backend(self):
+        "Test backends are picked by what is available"
+        with patch('shutil.which', return_value='/usr/bin/metaflac'):
+            backend = select_backend()
+            self.assertIsInstance(backend, NativeBackend)
+            self.assertEqual(backend.metaflac_path, '/usr/bin/metaflac')
+            self.assertTrue(backend.fallback)
+            self.assertIsInstance(select_backend('metaflac'), MetaflacBackend)
+            self.assertFalse(select_backend('native').fallback)
+
+        with patch('shutil.which', return_value=None):
+            self.assertFalse(select_backend().fallback)
+            with self.assertRaises(BackendError):
+                select_backend('metaflac')
+            with self.assertRaises(BackendError):
+                select_backend('auto', '/missing/metaflac')
+
+        with patch('mfbatch.metaflac.run') as run:
+            results = NativeBackend().read_batch([__file__])
+            with self.assertRaises(native.FlacFormatError):
+                NativeBackend().write(__file__, {'TITLE': 'X'})
+        self.assertFalse(run.called)
+        self.assertIsInstance(results[0], native.FlacFormatError)
+
+    def test_backend_capabilities(self):
+        "Test backends are only used as their capabilities allow"
+        with self.assertRaises(TypeError):
+            Backend()  # pylint: disable=abstract-class-instantiated
+
+        functions = MetaflacBackend().functions(min_padding=4096)
+        self.assertIsNotNone(functions.write_batch)
+        with patch('mfbatch.metaflac.run') as run:
+            functions.write(__file__, {'TITLE': 'X'})
+        self.assertEqual(run.call_count, 2)
+
+        class SingleBackend(NativeBackend):
+            "Writes one file at a time"
+            batch_writes = False
+
+        self.assertIsNone(SingleBackend().functions().write_batch)
+        with patch('sys.argv', ['mfbatch', '-W', '-y', '--backend',
+                                'metaflac', '--min-padding', '4096']), \
+                patch('shutil.which', return_value='/usr/bin/metaflac'), \
+                patch('sys.stderr', new=StringIO()), \
+                self.assertRaises(SystemExit):
+            main()
+
+
+class MetadataWriteTests(unittest.TestCase):
+    """
+    Tests writing metadata to FLAC files with the native writer
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'tone1.flac')
+        shutil.copy(os.path.join(TEST_AUDIO, 'tone1.flac'), self.path)
+        with open(self.path, 'rb') as f:
+            _, audio_offset = native.read_block_headers(f)
+            f.seek(audio_offset)
+            self.audio = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _blocks(self):
+        with open(self.path, 'rb') as f:
+            blocks, audio_offset = native.read_block_headers(f)
+            f.seek(audio_offset)
+            self.assertEqual(f.read(), self.audio)
+
+        return blocks
+
+    def test_write_in_place(self):
+        "Test a small write is made in place using the padding"
+        size = os.path.getsize(self.path)
+        metaflac.write_metadata(self.path, {'title': 'A\nB', '_X': 'Y'})
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(native.read_metadata(self.path), {'TITLE': 'A B'})
+        self.assertEqual([b.block_type for b in self._blocks()],
+                         [native.STREAMINFO, native.VORBIS_COMMENT,
+                          native.PADDING])
+
+    def test_write_rewrites_when_too_large(self):
+        "Test a write larger than the padding rewrites the file"
+        metaflac.write_metadata(self.path, {'COMMENT': 'x' * 10000})
+        self.assertEqual(native.read_metadata(self.path)['COMMENT'],
+                         'x' * 10000)
+        blocks = self._blocks()
+        self.assertEqual(blocks[-1].block_type, native.PADDING)
+        self.assertEqual(blocks[-1].length, native.DEFAULT_PADDING)
+        self.assertEqual(os.listdir(self.tempdir), ['tone1.flac'])
+
+    def test_write_safe(self):
+        "Test a safe write replaces the file, keeping its size, and syncs"
+        size = os.path.getsize(self.path)
+        inode = os.stat(self.path).st_ino
+        with patch('os.fsync') as fsync:
+            metaflac.write_metadata(self.path, {'TITLE': 'Safe'}, safe=True)
+            self.assertEqual(fsync.call_count, 1)
+            self.assertIn(self.tempdir, DIRECTORIES.pending)
+            DIRECTORIES.sync()
+            self.assertEqual(fsync.call_count, 2)
+
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(native.read_metadata(self.path), {'TITLE': 'Safe'})
+        self.assertEqual(os.listdir(self.tempdir), ['tone1.flac'])
+        self.assertEqual(DIRECTORIES.pending, {})
+
+    def test_write_min_padding(self):
+        "Test a write that would use up the padding restores it instead"
+        path = generate_corpus(self.tempdir, 1, CorpusSpec(padding=100))[0]
+        with open(path, 'rb') as f:
+            blocks, _ = native.read_block_headers(f)
+
+        # leaves 29 bytes of padding if written in place
+        comment = 'x' * (blocks[1].length + 30)
+        metaflac.write_metadata(path, {'COMMENT': comment}, min_padding=50)
+        with open(path, 'rb') as f:
+            blocks, _ = native.read_block_headers(f)
+        self.assertEqual(native.read_metadata(path), {'COMMENT': comment})
+        self.assertEqual(blocks[-1].block_type, native.PADDING)
+        self.assertEqual(blocks[-1].length, native.DEFAULT_PADDING)
+
+    def test_repad(self):
+        "Test repadding a file without padding lets later writes fit in place"
+        path = generate_corpus(self.tempdir, 1, CorpusSpec(padding=-1))[0]
+        metadata = native.read_metadata(path)
+        self.assertEqual(native.repad(path, 1000), native.REWRITTEN)
+        self.assertEqual(native.repad(path, 1000), native.UNCHANGED)
+        self.assertEqual(native.repad(path, 500), native.UNCHANGED)
+        self.assertEqual(native.read_metadata(path), metadata)
+
+        size = os.path.getsize(path)
+        metaflac.write_metadata(path, {**metadata, 'COMMENT': 'x' * 900})
+        self.assertEqual(os.path.getsize(path), size)
+
+        self.assertEqual(native.repad(self.path, 100), native.UNCHANGED)
+        self.assertEqual(native.repad(self.path, 20000), native.REWRITTEN)
+
+    def test_write_picture(self):
+        "Test a picture is written before the comments, then left in place"
+        cover = write_png(os.path.join(self.tempdir, 'cover.png'))
+        metaflac.write_metadata(self.path, {'TITLE': 'A', PICTURE_KEY: cover})
+        self.assertEqual([b.block_type for b in self._blocks()],
+                         [native.STREAMINFO, native.PICTURE,
+                          native.VORBIS_COMMENT, native.PADDING])
+
+        size = os.path.getsize(self.path)
+        metaflac.write_metadata(self.path, {'TITLE': 'B', PICTURE_KEY: cover})
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(native.read_metadata(self.path), {'TITLE': 'B'})
+        self.assertEqual(len(self._blocks()), 4)
+
+        metaflac.write_metadata(self.path, {'TITLE': 'B', PICTURE_KEY: ''})
+        self.assertNotIn(native.PICTURE,
+                         [b.block_type for b in self._blocks()])
+
+    def test_write_unchanged(self):
+        "Test a file that already has the metadata and picture isn't written"
+        cover = write_png(os.path.join(self.tempdir, 'cover.png'))
+        other = write_png(os.path.join(self.tempdir, 'other.png'), 4, 4)
+        native.write_metadata(self.path, [('title', 'A')])
+        op = WriteOperation(self.path, {'TITLE': 'A', PICTURE_KEY: cover},
+                            None)
+        self.assertTrue(perform_write(op, metaflac.write_metadata,
+                                      native.read_metadata).written)
+        self.assertFalse(perform_write(op, metaflac.write_metadata,
+                                       native.read_metadata).written)
+        self.assertFalse(metadata_unchanged(
+            self.path, {'TITLE': 'A', PICTURE_KEY: other},
+            native.read_metadata))
+        self.assertFalse(metadata_unchanged(
+            self.path, {'TITLE': 'A', PICTURE_KEY: ''}, native.read_metadata))
+        self.assertTrue(metaflac.metadata_matches({'title': 'A'},
+                                                  {'Title': 'A'}))
+
+    def test_write_repeated_keys(self):
+        "Test a file with a repeated key is written once with each key"
+        native.write_metadata(self.path, [('ARTIST', 'A'), ('artist', 'B')])
+        op = WriteOperation(self.path, {'ARTIST': 'B'}, None)
+        self.assertTrue(perform_write(op, metaflac.write_metadata,
+                                      native.read_metadata).written)
+        self.assertEqual(native.read_comments(self.path), [('ARTIST', 'B')])
+        self.assertFalse(perform_write(op, metaflac.write_metadata,
+                                       native.read_metadata).written)
+
+    def test_write_stats(self):
+        "Test bytes, latency and renames are recorded when stats are enabled"
+        with patch.object(STATS, 'enabled', True), \
+                patch.object(STATS, 'phases', {}), \
+                patch.object(STATS, 'counters', {}), \
+                patch.object(STATS, 'latencies', {}):
+            perform_write(WriteOperation(self.path, {'TITLE': 'A'},
+                                         'renamed.flac'),
+                          metaflac.write_metadata)
+            report = STATS.report()
+
+        self.assertGreater(report['counters']['bytes_written'], 0)
+        self.assertEqual(report['counters']['renames'], 1)
+        self.assertEqual(report['phases']['rename']['calls'], 1)
+        self.assertEqual(report['latency']['write']['count'], 1)
+        self.assertEqual(percentile([1.0, 2.0, 3.0, 4.0], 50), 2.0)
+        self.assertEqual(percentile([1.0, 2.0, 3.0, 4.0], 99), 4.0)
+
+
+class PictureTests(unittest.TestCase):
+    """
+    Tests probing images and caching PICTURE blocks
+    """
+
+    def test_probe(self):
+        "Test the type and dimensions of images are read from their headers"
+        jpeg = b'\xff\xd8\xff\xe0' + struct.pack('>H', 4) + bytes(2) + \
+            b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, 30, 40, 3)
+        gif = b'GIF89a' + struct.pack('<HHBBB', 5, 6, 0xF2, 0, 0)
+
+        self.assertEqual(tuple(probe_image(png_image(2, 3))),
+                         ('image/png', 2, 3, 24, 0))
+        self.assertEqual(tuple(probe_image(jpeg)),
+                         ('image/jpeg', 40, 30, 24, 0))
+        self.assertEqual(tuple(probe_image(gif)), ('image/gif', 5, 6, 24, 8))
+        with self.assertRaises(PictureFormatError):
+            probe_image(b'not an image')
+
+    def test_cache(self):
+        "Test identical images share a block and old blocks are evicted"
+        with tempfile.TemporaryDirectory() as tempdir:
+            first = write_png(os.path.join(tempdir, 'a.png'))
+            copy = write_png(os.path.join(tempdir, 'b.png'))
+            other = write_png(os.path.join(tempdir, 'c.png'), 4, 4)
+
+            cache = PictureCache(max_size=100)
+            block = cache.block(first)
+            self.assertIs(cache.block(copy), block)
+            self.assertEqual(len(cache.blocks), 1)
+
+            cache.block(other)
+            self.assertEqual(len(cache.blocks), 1)
+            self.assertEqual(cache.block(first), block)
+
+
+class CreateBatchListTests(unittest.TestCase):
+    """
+    Tests creating batchfiles
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.flac_files = []
+        for name in ('tone1.flac', 'tone2.flac', 'tone3.flac'):
+            self.flac_files.append(os.path.join(self.tempdir, name))
+            shutil.copy(os.path.join(TEST_AUDIO, name), self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _create(self, **kwargs) -> str:
+        path = os.path.join(self.tempdir, 'MFBATCH_LIST')
+        create_batch_list(self.flac_files * 4, path, **kwargs)
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def test_create(self):
+        "Test creating a batchfile"
+        batchfile = self._create()
+        self.assertIn(":set ALBUM 'Test Album 1'\n", batchfile)
+        self.assertEqual(batchfile.count('tone2.flac\n'), 4)
+
+    def test_create_not_flac(self):
+        "Test a file the native backend can't parse is noted in the batchfile"
+        corrupt = os.path.join(self.tempdir, 'corrupt.flac')
+        with open(corrupt, 'wb') as f:
+            f.write(b'not a flac file')
+        self.flac_files.append(corrupt)
+
+        batchfile = self._create(backend=NativeBackend())
+        self.assertIn("# !!! ERROR (", batchfile)
+        self.assertIn(f"from the file {corrupt}\n", batchfile)
+
+    def test_create_jobs(self):
+        "Test reading concurrently creates the same batchfile"
+        self.assertEqual(self._create(jobs=4), self._create())
+
+    def test_create_cached(self):
+        "Test unchanged files are not read again with a scan cache"
+        cache_path = os.path.join(self.tempdir, '.mfbatch-cache')
+        cache = ScanCache(cache_path)
+        batchfile = self._create(cache=cache)
+        cache.save()
+
+        cache = ScanCache.load(cache_path)
+        self.assertEqual(len(cache.entries), 3)
+        with patch('mfbatch.metaflac.read_metadata_batch',
+                   return_value=[]) as read_metadata_batch:
+            self.assertEqual(self._create(cache=cache), batchfile)
+            self.assertEqual(read_metadata_batch.call_args.args[0], [])
+
+        os.utime(self.flac_files[0], ns=(0, 0))
+        with patch('mfbatch.metaflac.read_metadata_batch',
+                   side_effect=lambda paths, _: [{}] * len(paths)
+                   ) as read_metadata_batch:
+            self._create(cache=cache)
+            self.assertEqual(read_metadata_batch.call_args.args[0],
+                             [self.flac_files[0]] * 4)
+
+    def test_create_streamed(self):
+        "Test creating from a file list read as needed, sorted on disk"
+        list_path = os.path.join(self.tempdir, 'files.txt')
+        with open(list_path, mode='w', encoding='utf-8') as f:
+            f.write('\n'.join(reversed(self.flac_files * 4)) + '\n\n')
+
+        batchfile = self._create()
+        path = os.path.join(self.tempdir, 'MFBATCH_LIST')
+        with patch('mfbatch.filelist.SORT_MEMORY_BUDGET', 500):
+            create_batch_list(read_file_list(list_path), path)
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), batchfile)
+
+        create_batch_list(iter(self.flac_files * 4), path, sort_mode='none')
+        with open(path, encoding='utf-8') as f:
+            self.assertIn('tone3.flac\n', f.read())
+
+    def test_compact(self):
+        "Test compacted entries compile back to the metadata of every file"
+        files = []
+        for album in ('Album A', 'Album B'):
+            for track in range(1, 12):
+                metadata = {'ALBUM': album, 'ARTIST': 'Artist',
+                            'TRACKNUMBER': f"{track:02d}",
+                            'TITLE': f"Song {track}"}
+                if track == 5:
+                    metadata['DESCRIPTION'] = 'Live'
+                if track == 7:
+                    metadata['ARTIST'] = 'Guest'
+                if track != 9:
+                    metadata['GENRE'] = 'Jazz'
+                files.append((f"/music/{album}/{track:02d} Song {track}.flac",
+                              metadata))
+        files.append(('/music/Loose/extra.flac', {'TITLE': 'extra'}))
+
+        compactor = BatchfileCompactor()
+        batchfile = ''.join(compactor.add(path, metadata)
+                            for path, metadata in files) + compactor.finish()
+        self.assertIn(":d Live\n", batchfile)
+        self.assertIn(":set1 ARTIST Guest\n", batchfile)
+        self.assertIn(":setinc TRACKNUMBER 1 %02d\n", batchfile)
+        self.assertIn(":setp TITLE _FILENAME", batchfile)
+        self.assertEqual(batchfile.count(":set TITLE"), 1)
+
+        plan = BatchfileParser().compile(
+            readline_with_escaped_newlines(StringIO(batchfile)))
+        self.assertEqual([op.path for op in plan], [p for p, _ in files])
+        for op, (_, metadata) in zip(plan, files):
+            self.assertEqual({k: v for k, v in op.metadata.items()
+                              if not k.startswith('_')}, metadata)
+
+    def test_export_import(self):
+        "Test exported records import back, in either format"
+        for fmt in ('jsonl', 'csv'):
+            output = StringIO()
+            export_tags(scan_chunks(self.flac_files), output, fmt)
+            description = native.read_metadata(
+                self.flac_files[1])['DESCRIPTION']
+            records_path = os.path.join(self.tempdir, f"tags.{fmt}")
+            with open(records_path, mode='w', encoding='utf-8') as f:
+                f.write(output.getvalue().replace(description, f"Tone {fmt}"))
+
+            records = list(read_records(records_path))
+            self.assertEqual([path for _, (path, _) in records],
+                             self.flac_files)
+            self.assertNotIn('DESCRIPTION', records[2][1][1])
+
+            counts = import_records(records_path, dry_run=True)
+            self.assertEqual((counts['written'], counts['skipped']), (1, 2))
+            counts = import_records(records_path, dry_run=False)
+            self.assertEqual((counts['written'], counts['skipped']), (1, 2))
+            self.assertEqual(
+                native.read_metadata(self.flac_files[1])['DESCRIPTION'],
+                f"Tone {fmt}")
+
+        with open(records_path, mode='w', encoding='utf-8') as f:
+            f.write('{"path": "./a.flac", "tags": {"A": "1"}}\n{"tags": {}}\n')
+        with self.assertRaises(RecordError) as context:
+            list(read_records(records_path))
+        self.assertEqual(context.exception.line, 2)
+
+        with open(records_path, mode='w', encoding='utf-8') as f:
+            f.write('path,A\n"./a\n.flac",1\n./b.flac,2\n./c.flac,3,4\n')
+        records = read_records(records_path)
+        self.assertEqual([lineno for lineno, _ in islice(records, 2)], [2, 4])
+        with self.assertRaises(RecordError) as context:
+            next(records)
+        self.assertEqual(context.exception.line, 5)
+
+    def test_external_sort(self):
+        "Test sorting more files than fit in memory"
+        paths = [f"/{(i * 7919) % 1000:04d}/{i % 13}.flac"
+                 for i in range(1000)]
+        records = [FileRecord(path) for path in paths]
+        for mode in ('path', 'name'):
+            key = sort_key(mode)
+            self.assertEqual(
+                [file_record(f).path for f in
+                 sorted_flac_files(records, mode, memory=5000)],
+                [r.path for r in sorted(records, key=key)])
+
+        self.assertEqual(list(sorted_flac_files(paths, 'none')), paths)
+
+
+class WriteExecutorTests(unittest.TestCase):
+    """
+    Tests writing files concurrently
+    """
+
+    def setUp(self):
+        self.write_metadata_f = MagicMock()
+        self.completed = []
+
+    def _ops(self, count):
+        return [WriteOperation(path=f"./{i}.flac", metadata={'N': str(i)},
+                               new_basename=None) for i in range(count)]
+
+    def _run(self, functions, count, jobs=4):
+        with WriteExecutor(functions, jobs,
+                           lambda op, result: self.completed.append(
+                               (op.path, result))) as ex:
+            for op in self._ops(count):
+                ex.submit(op)
+
+    def test_ordered_completion(self):
+        "Test all writes are made and completed in order"
+        self._run(MetadataFunctions(self.write_metadata_f), 20)
+        self.assertEqual(self.write_metadata_f.call_count, 20)
+        self.assertEqual([path for path, _ in self.completed],
+                         [f"./{i}.flac" for i in range(20)])
+
+    def test_failures(self):
+        "Test failures are passed on and don't stop other writes"
+        self.write_metadata_f.side_effect = \
+            lambda path, _: path == './3.flac' and 1 / 0
+        self._run(MetadataFunctions(self.write_metadata_f), 10)
+        failed = [path for path, result in self.completed
+                  if isinstance(result, BaseException)]
+        self.assertEqual(failed, ['./3.flac'])
+
+    def test_skip_unchanged(self):
+        "Test files that already have the metadata are not written"
+        read_metadata_f = MagicMock(return_value={'N': '3'})
+        self._run(MetadataFunctions(self.write_metadata_f, read_metadata_f),
+                  20)
+        self.assertEqual(read_metadata_f.call_count, 20)
+        self.assertEqual([path for path, result in self.completed
+                          if not result.written], ['./3.flac'])
+
+    def test_grouped_writes(self):
+        "Test files with the same metadata are written with one call"
+        write_batch = MagicMock()
+        ops = [WriteOperation(path=f"./{i}.flac", metadata={'A': '1'},
+                              new_basename=None) for i in range(10)]
+        with WriteExecutor(MetadataFunctions(self.write_metadata_f,
+                                             write_batch=write_batch), 4,
+                           lambda op, result: self.completed.append(
+                               result)) as ex:
+            for op in ops:
+                ex.submit(op)
+
+        self.assertFalse(self.write_metadata_f.called)
+        self.assertEqual(write_batch.call_args.args,
+                         ([op.path for op in ops], {'A': '1'}))
+        self.assertTrue(all(result.written for result in self.completed))
+
+    def test_serial_batch_list(self):
+        "Test a batch list written with one job writes files in batches"
+        functions = MetadataFunctions(write=MagicMock(),
+                                      write_batch=MagicMock())
+        backend = MagicMock()
+        backend.functions.return_value = functions
+        with tempfile.TemporaryDirectory() as tempdir:
+            batchfile = os.path.join(tempdir, 'MFBATCH_LIST')
+            with open(batchfile, 'w', encoding='utf-8') as f:
+                f.write(":set A 1\n./1.flac\n./2.flac\n./3.flac\n"
+                        ":set A 2\n./4.flac\n")
+            with patch('sys.stdout', new=StringIO()):
+                execute_batch_list(batchfile, dry_run=False,
+                                   interactive=False,
+                                   options=WriteOptions(jobs=1,
+                                                        backend=backend))
+
+        paths, metadata = functions.write_batch.call_args.args
+        self.assertEqual((paths, metadata['A']),
+                         (['./1.flac', './2.flac', './3.flac'], '1'))
+        path, metadata = functions.write.call_args.args
+        self.assertEqual((path, metadata['A']), ('./4.flac', '2'))
+        self.assertEqual(functions.write_batch.call_count +
+                         functions.write.call_count, 2)
+
+    def test_stop(self):
+        "Test an error raised on completion stops the session"
+        self.write_metadata_f.side_effect = ZeroDivisionError
+
+        def on_complete(_, result):
+            raise result
+
+        with self.assertRaises(ZeroDivisionError):
+            with WriteExecutor(MetadataFunctions(self.write_metadata_f), 2,
+                               on_complete) as ex:
+                for op in self._ops(100):
+                    ex.submit(op)
+
+        self.assertLess(self.write_metadata_f.call_count, 100)
+
+
+class JournalTests(unittest.TestCase):
+    """
+    Tests recording and resuming write runs
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.batchfile = os.path.join(self.tempdir, 'MFBATCH_LIST')
+        self.lines = [(":set A 1", 1), (":setinc N 1", 2), ("./a.flac", 3),
+                      ("./b.flac", 4), ("./c.flac", 5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _run(self, resume, fail_on=None):
+        parser = BatchfileParser()
+        parser.dry_run = False
+        parser.outstream = StringIO()
+        parser.read_metadata_f = None
+        parser.write_metadata_f = MagicMock(
+            side_effect=lambda path, _: path == fail_on and 1 / 0)
+        with Journal(self.batchfile, resume=resume) as journal:
+            parser.journal = journal
+            plan = parser.compile(self.lines)
+            try:
+                parser.execute(plan)
+            except ZeroDivisionError:
+                pass
+
+        return [call.args for call in
+                parser.write_metadata_f.call_args_list]
+
+    def test_resume(self):
+        "Test a resumed run skips files written by the interrupted run"
+        self._run(resume=False, fail_on='./b.flac')
+        calls = self._run(resume=True)
+        self.assertEqual([(path, metadata['N']) for path, metadata in calls],
+                         [('./b.flac', '2'), ('./c.flac', '3')])
+        self.assertEqual(self._run(resume=True), [])
+        self.assertEqual(len(self._run(resume=False)), 3)
+
+    def test_resume_picture(self):
+        "Test a file is written again if its picture changed since the run"
+        op = WriteOperation(path='./a.flac', metadata={'A': '1'},
+                            new_basename=None, line=3)
+        hashes = {operation_hash(op._replace(metadata={'A': '1', **picture}))
+                  for picture in ({}, {PICTURE_KEY: ''},
+                                  {PICTURE_KEY: 'a.png'},
+                                  {PICTURE_KEY: 'b.png'})}
+        self.assertEqual(len(hashes), 4)
+        with Journal(self.batchfile) as journal:
+            journal.record(op, WriteResult(written=True, new_path=None))
+        with Journal(self.batchfile, resume=True) as journal:
+            self.assertTrue(journal.applied(op))
+            self.assertFalse(journal.applied(op._replace(
+                metadata={'A': '1', PICTURE_KEY: 'a.png'})))
+
+    def test_resume_renamed(self):
+        "Test a file renamed before the run was interrupted isn't renamed"
+        with open(os.path.join(self.tempdir, 'b.flac'), 'wb'):
+            pass
+        op = WriteOperation(path=os.path.join(self.tempdir, 'a.flac'),
+                            metadata={}, new_basename='b.flac')
+        with Journal(self.batchfile) as journal:
+            self.assertEqual(journal.resumable(op), op)
+            journal.record(op, WriteResult(written=True, new_path=None))
+
+        with Journal(self.batchfile, resume=True) as journal:
+            self.assertEqual(journal.resumable(op),
+                             op._replace(path=os.path.join(self.tempdir,
+                                                           'b.flac'),
+                                         new_basename=None))
+            other = op._replace(metadata={'A': '1'})
+            self.assertEqual(journal.resumable(other), other)
+
+    def test_durable(self):
+        "Test a durable journal records files once their directory is synced"
+        events = []
+        with patch('mfbatch.journal.DIRECTORIES') as directories, \
+                patch('os.fsync', side_effect=lambda _: events.append(
+                    'fsync')):
+            directories.sync.side_effect = lambda: events.append('sync')
+            with Journal(self.batchfile, durable=True) as journal:
+                op = WriteOperation(path='./a.flac', metadata={'A': '1'},
+                                    new_basename=None, line=3)
+                journal.record(op, WriteResult(written=True, new_path=None))
+                with open(journal.path, encoding='utf-8') as f:
+                    self.assertEqual(f.read(), '')
+
+        self.assertEqual(events, ['sync', 'fsync'])
+        with Journal(self.batchfile, resume=True) as journal:
+            self.assertTrue(journal.applied(op))
+
+
+class RenameTests(unittest.TestCase):
+    """
+    Tests planning and performing the renames of a batchfile
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for name in ('a.flac', 'b.flac', 'c.flac', 'd.flac'):
+            with open(os.path.join(self.tempdir, name), 'w',
+                      encoding='utf-8') as f:
+                f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _op(self, name, new_basename, line):
+        return WriteOperation(path=os.path.join(self.tempdir, name),
+                              metadata={}, new_basename=new_basename,
+                              line=line)
+
+    def _contents(self):
+        contents = {}
+        for name in sorted(os.listdir(self.tempdir)):
+            with open(os.path.join(self.tempdir, name), encoding='utf-8') as f:
+                contents[name] = f.read()
+        return contents
+
+    def test_plan_problems(self):
+        "Test collisions and duplicate targets are all found up front"
+        with self.assertRaises(RenamePlanError) as cm:
+            plan_renames([self._op('a.flac', 'b.flac', 1),
+                          self._op('c.flac', 'e.flac', 2),
+                          self._op('d.flac', 'e.flac', 3),
+                          self._op('c.flac', 'f.flac', 4)])
+
+        self.assertEqual([problem.split(':')[0] for problem in
+                          cm.exception.problems],
+                         ['line 3', 'line 4', 'line 1'])
+
+    def test_rotation(self):
+        "Test files renamed to each other's names are renamed in turn"
+        parser = BatchfileParser()
+        parser.dry_run = False
+        parser.outstream = StringIO()
+        parser.read_metadata_f = None
+        parser.write_metadata_f = MagicMock()
+        plan = [self._op('a.flac', 'b.flac', 1),
+                self._op('b.flac', 'c.flac', 2),
+                self._op('c.flac', 'a.flac', 3),
+                self._op('d.flac', 'e.flac', 4)]
+        parser.plan_renames(plan)
+        parser.execute(plan)
+        self.assertEqual(self._contents(), {'a.flac': 'a.flac',
+                                            'b.flac': 'b.flac',
+                                            'c.flac': 'c.flac',
+                                            'd.flac': 'd.flac'})
+        parser.rename_files()
+        self.assertEqual(self._contents(), {'a.flac': 'c.flac',
+                                            'b.flac': 'a.flac',
+                                            'c.flac': 'b.flac',
+                                            'e.flac': 'd.flac'})
+
+    def test_failed_swap(self):
+        "Test a swap that fails partway is undone"
+        parser = BatchfileParser()
+        parser.dry_run = False
+        parser.outstream = StringIO()
+        parser.read_metadata_f = None
+        parser.write_metadata_f = MagicMock()
+        plan = [self._op('a.flac', 'b.flac', 1),
+                self._op('b.flac', 'a.flac', 2)]
+        parser.plan_renames(plan)
+        parser.execute(plan)
+
+        rename = os.rename
+        calls = []
+
+        def fail_second(source, target):
+            calls.append((source, target))
+            if len(calls) == 2:
+                raise PermissionError(13, 'Permission denied')
+            rename(source, target)
+
+        with patch('os.rename', side_effect=fail_second):
+            parser.rename_files()
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self._contents(), {'a.flac': 'a.flac',
+                                            'b.flac': 'b.flac',
+                                            'c.flac': 'c.flac',
+                                            'd.flac': 'd.flac'})
+        self.assertEqual(parser.outstream.getvalue().count('Rename failed!'),
+                         2)
+
+    def test_prompt_rename(self):
+        "Test a rename entered at the prompt can't overwrite another file"
+        parser = BatchfileParser()
+        parser.dry_run = False
+        parser.outstream = StringIO()
+        parser.read_metadata_f = None
+        parser.write_metadata_f = MagicMock()
+        lines = [(os.path.join(self.tempdir, 'a.flac'), 1)]
+        parser.plan_renames(parser.compile(lines))
+        with patch('builtins.input', side_effect=[':rename b.flac',
+                                                  ':rename e.flac', '']) \
+                as prompt:
+            for line, lineno in lines:
+                parser.eval(line, lineno, interactive=True)
+            parser.finish_review()
+        parser.rename_files()
+
+        self.assertEqual(prompt.call_count, 3)
+        self.assertIn("b.flac already exists", parser.outstream.getvalue())
+        self.assertEqual(self._contents(), {'b.flac': 'b.flac',
+                                            'c.flac': 'c.flac',
+                                            'd.flac': 'd.flac',
+                                            'e.flac': 'a.flac'})
+
+    def test_blocked(self):
+        "Test a file isn't renamed over one that failed and kept its name"
+        renames = plan_renames([self._op('a.flac', 'b.flac', 1),
+                                self._op('b.flac', 'e.flac', 2),
+                                self._op('d.flac', 'a.flac', 3)])
+        self.assertEqual(
+            [r.op.line for r in blocked_renames(
+                renames[:1] + renames[2:], {renames[1].source})],
+            [1, 3])
+        self.assertEqual(
+            [(os.path.basename(step.source), os.path.basename(step.target))
+             for step in rename_steps(renames)],
+            [('b.flac', 'e.flac'), ('a.flac', 'b.flac'),
+             ('d.flac', 'a.flac')])
+
+
+class ShardTests(unittest.TestCase):
+    """
+    Tests splitting a batchfile into shards
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.batchfile = os.path.join(self.tempdir, 'MFBATCH_LIST')
+        lines = [":set ALBUM 'Album A'", ":setinc TRACKNUMBER 8 %02d",
+                 ":setp TITLE _FILENAME '^(.*)\\.flac$' '\\1'",
+                 ":set _DISC 1"]
+        for n in range(12):
+            if n == 4:
+                lines += [":unset _DISC", ":set ALBUM 'Album B'",
+                          ":setinc TRACKNUMBER 1"]
+            if n == 6:
+                lines += [":set1 GENRE Jazz", ":d 'Track six'"]
+            if n in (5, 6):
+                lines.append(f":rename {11 - n:02d}.flac")
+            lines += [os.path.join(self.tempdir, f"{n:02d}.flac"), '']
+        with open(self.batchfile, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    @staticmethod
+    def _plan(path):
+        with open(path, encoding='utf-8') as f:
+            return [(op.path, dict(op.metadata), op.new_basename) for op in
+                    BatchfileParser().compile(
+                        readline_with_escaped_newlines(f))]
+
+    def test_shards_match_batchfile(self):
+        "Test the shards together write what the batchfile writes"
+        paths = shard_batch_list(self.batchfile, 4)
+        self.assertEqual(len(paths), 4)
+        plans = [self._plan(path) for path in paths]
+        self.assertEqual(sum(plans, []), self._plan(self.batchfile))
+        # files 5 and 6 swap names, so they are kept in one shard
+        self.assertEqual([len(plan) for plan in plans], [3, 4, 2, 3])
+
+        paths = shard_batch_list(self.batchfile, 12)
+        plans = [self._plan(path) for path in paths]
+        self.assertEqual(len(paths), 11)
+        self.assertEqual(sum(plans, []), self._plan(self.batchfile))
+
+
+class WalkTests(unittest.TestCase):
+    """
+    Tests finding FLAC files
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for path in ('a.flac', 'b.FLAC', '.hidden.flac', 'x.txt',
+                     'sub/c.flac', 'sub/skip/d.flac', '.hid/e.flac',
+                     'sub2/f.flac'):
+            path = os.path.join(self.tempdir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb'):
+                pass
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _walk(self, **kwargs):
+        return sorted(os.path.relpath(record.path, self.tempdir) for record in
+                      walk_flac_files(self.tempdir, WalkOptions(**kwargs)))
+
+    def test_walk_like_glob(self):
+        "Test the walker finds the same files as a recursive glob"
+        found = sorted(os.path.relpath(path, self.tempdir) for path in
+                       glob.glob(os.path.join(self.tempdir, '**/*.flac'),
+                                 recursive=True))
+        self.assertEqual(self._walk(), found)
+
+    def test_walk_options(self):
+        "Test case-insensitive matching and excludes"
+        self.assertEqual(self._walk(ignore_case=True, exclude=['skip', 'a*']),
+                         ['b.FLAC', 'sub/c.flac', 'sub2/f.flac'])
+
+    def test_walk_jobs(self):
+        "Test walking subtrees concurrently finds files in the same order"
+        records = walk_flac_files(self.tempdir, jobs=4)
+        self.assertEqual(records, walk_flac_files(self.tempdir))
+        self.assertTrue(all(record.stat is not None for record in records))
+
+    def test_walk_loop(self):
+        "Test symbolic links back to the root or an ancestor aren't followed"
+        found = self._walk()
+        os.symlink(self.tempdir, os.path.join(self.tempdir, 'sub', 'root'))
+        os.symlink(os.path.join(self.tempdir, 'sub'),
+                   os.path.join(self.tempdir, 'sub', 'skip', 'up'))
+        self.assertEqual(self._walk(), found)
+        self.assertEqual(sorted(record.path for record in
+                                walk_flac_files(self.tempdir, jobs=4)),
+                         [os.path.join(self.tempdir, path) for path in
+                          ('a.flac', 'sub/c.flac', 'sub/skip/d.flac',
+                           'sub2/f.flac')])
+
+
+class BenchmarkCorpusTests(unittest.TestCase):
+    """
+    Tests the benchmark corpus generator and stub metaflac
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_corpus(self):
+        "Test generated files are readable and rewritable FLAC files"
+        paths = generate_corpus(self.tempdir, 14, CorpusSpec(
+            tags=8, padding=-1, picture_size=300))
+        self.assertEqual(len(paths), 14)
+        metadata = native.read_metadata(paths[13])
+        self.assertEqual((metadata['ALBUM'], metadata['TRACKNUMBER']),
+                         ('Album 1', '2'))
+        self.assertEqual(len(metadata), 8)
+
+        with open(paths[0], 'rb') as f:
+            blocks, _ = native.read_block_headers(f)
+        self.assertEqual([b.block_type for b in blocks],
+                         [native.STREAMINFO, native.PICTURE,
+                          native.VORBIS_COMMENT])
+
+        metaflac.write_metadata(paths[0], {'TITLE': 'X'})
+        self.assertEqual(native.read_metadata(paths[0]), {'TITLE': 'X'})
+
+    def test_stub_metaflac(self):
+        "Test the stub metaflac lists and imports tags like metaflac"
+        paths = generate_corpus(self.tempdir, 2, CorpusSpec())
+        tags = os.path.join(self.tempdir, 'tags.txt')
+        with open(tags, mode='w', encoding='utf-8') as f:
+            f.write("TITLE=Stub\n")
+
+        self.assertEqual(stub_metaflac_main(
+            ['--remove-all-tags', f"--import-tags-from={tags}"] + paths), 0)
+        self.assertEqual(native.read_metadata(paths[1]), {'TITLE': 'Stub'})
+
+        with patch('sys.stdout', new_callable=StringIO) as out:
+            stub_metaflac_main(['--list', '--block-type=VORBIS_COMMENT',
+                                paths[0]])
+        self.assertIn("    comment[0]: TITLE=Stub\n", out.getvalue())